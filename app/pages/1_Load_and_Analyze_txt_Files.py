@@ -15,6 +15,8 @@ Analysis will generate three .xlsx files:
 
 import streamlit as st
 import os
+import time
+import numpy as np
 from stqdm import stqdm
 
 from src.utils import (
@@ -24,7 +26,12 @@ from src.utils import (
     get_selected_folder_info,
 )
 
+from src.analysis import AnalysisConfig
 from src.experiment import RawFolder
+from src.plotting import plot_trial_traces
+from src.session import SessionIndex
+from src.significance import SignificanceTest
+from src.watch import LiveSession
 
 import pdb
 
@@ -49,6 +56,40 @@ def initialize_states():
         st.session_state.run_type = False
     if "drop_trial" not in st.session_state:
         st.session_state.drop_trial = False
+    if "n_workers" not in st.session_state:
+        st.session_state.n_workers = 1
+    if "pool_type" not in st.session_state:
+        st.session_state.pool_type = "thread"
+    if "use_cache" not in st.session_state:
+        st.session_state.use_cache = True
+    if "sustained_frames" not in st.session_state:
+        st.session_state.sustained_frames = 1
+    if "rename_files" not in st.session_state:
+        st.session_state.rename_files = False
+    if "low_memory" not in st.session_state:
+        st.session_state.low_memory = False
+    if "save_raw_means" not in st.session_state:
+        st.session_state.save_raw_means = True
+    if "precision" not in st.session_state:
+        st.session_state.precision = "float64"
+    if "precision_report" not in st.session_state:
+        st.session_state.precision_report = False
+    if "save_trial_metrics" not in st.session_state:
+        st.session_state.save_trial_metrics = False
+    if "analysis_workers" not in st.session_state:
+        st.session_state.analysis_workers = 1
+    if "analysis_config" not in st.session_state:
+        st.session_state.analysis_config = AnalysisConfig()
+    if "significance_test" not in st.session_state:
+        st.session_state.significance_test = None
+    if "watch_folder" not in st.session_state:
+        st.session_state.watch_folder = False
+    if "review_data" not in st.session_state:
+        st.session_state.review_data = None
+    if "review_table" not in st.session_state:
+        st.session_state.review_table = None
+    if "saved_drops" not in st.session_state:
+        st.session_state.saved_drops = []
 
 
 def prompt_dir():
@@ -91,6 +132,213 @@ def choose_sample_type() -> str:
     return choice
 
 
+def choose_advanced_options() -> (
+    tuple[int, str, bool, int, bool, bool, bool, str, bool, bool, int]
+):
+    """Prompts user for how to read the .txt files and detect responses.
+
+    Returns:
+        A tuple containing the number of workers, the pool type, whether
+        to use the session cache, the number of frames a response must
+        stay above the onset threshold, whether to rename the .txt files
+        on disk, whether to use low-memory mode, whether to save the
+        _raw_means files, the precision of the trial data in memory,
+        whether to report the differences from full precision, whether to
+        save the per-trial metrics, and the number of processes analyzing
+        blocks of samples.
+    """
+
+    with st.expander("Advanced options"):
+        n_workers = st.number_input(
+            "Number of .txt files to read at the same time",
+            min_value=1,
+            max_value=os.cpu_count() or 1,
+            value=st.session_state.n_workers,
+        )
+        analysis_workers = st.number_input(
+            "Number of processes analyzing blocks of samples, e.g. for Grid",
+            min_value=1,
+            max_value=os.cpu_count() or 1,
+            value=st.session_state.analysis_workers,
+        )
+        pool_choice = st.radio(
+            "Read .txt files using:",
+            ("Threads (network drives)", "Processes (local drives)"),
+        )
+        use_cache = st.checkbox(
+            "Reuse cached trial data if the .txt files haven't changed",
+            value=st.session_state.use_cache,
+        )
+        sustained_frames = st.number_input(
+            "Number of consecutive frames a response must stay above 5% of "
+            "DeltaF to count as response onset",
+            min_value=1,
+            value=st.session_state.sustained_frames,
+        )
+        rename_files = st.checkbox(
+            "Rename the .txt files in the folder to the ..._000.txt, "
+            "..._001.txt etc. format",
+            value=st.session_state.rename_files,
+        )
+        low_memory = st.checkbox(
+            "Low-memory mode for very wide sessions, e.g. Grid (reads one "
+            "trial at a time and doesn't use the cache)",
+            value=st.session_state.low_memory,
+        )
+        save_raw_means = st.checkbox(
+            "Save the _raw_means files",
+            value=st.session_state.save_raw_means,
+        )
+        save_trial_metrics = st.checkbox(
+            "Analyze every trial and save the per-trial values to a "
+            "_trial_metrics.parquet file",
+            value=st.session_state.save_trial_metrics,
+        )
+        precision_choice = st.radio(
+            "Keep trial data in memory as:",
+            ("Full precision (float64)", "Compact (float32, half the memory)"),
+            index=0 if st.session_state.precision == "float64" else 1,
+        )
+        precision_report = False
+        if precision_choice == "Compact (float32, half the memory)":
+            precision_report = st.checkbox(
+                "Report the largest differences from full precision (reads "
+                "the .txt files again)",
+                value=st.session_state.precision_report,
+            )
+
+    if pool_choice == "Threads (network drives)":
+        pool_type = "thread"
+    elif pool_choice == "Processes (local drives)":
+        pool_type = "process"
+
+    if precision_choice == "Full precision (float64)":
+        precision = "float64"
+    elif precision_choice == "Compact (float32, half the memory)":
+        precision = "float32"
+
+    return (
+        n_workers,
+        pool_type,
+        use_cache,
+        sustained_frames,
+        rename_files,
+        low_memory,
+        save_raw_means,
+        precision,
+        precision_report,
+        save_trial_metrics,
+        analysis_workers,
+    )
+
+
+def choose_analysis_config() -> AnalysisConfig:
+    """Prompts user for the frame windows and frame rate of the analysis.
+
+    Returns:
+        The selected analysis settings.
+    """
+
+    config = st.session_state.analysis_config
+
+    with st.expander("Analysis windows"):
+        baseline_last = st.number_input(
+            "Last baseline frame (baseline starts at frame 1)",
+            min_value=1,
+            value=config.baseline_frames[1],
+        )
+        peak_first = st.number_input(
+            "First frame searched for the peak",
+            min_value=1,
+            value=config.peak_frames[0],
+        )
+        peak_last = st.number_input(
+            "Last frame searched for the peak and response onset",
+            min_value=1,
+            value=config.peak_frames[1],
+        )
+        auc_last = st.number_input(
+            "Last frame of the area under curve (starts at frame 1)",
+            min_value=1,
+            value=config.auc_frames[1],
+        )
+        odor_onset_frame = st.number_input(
+            "Odor onset frame",
+            min_value=1,
+            value=config.odor_onset_frame,
+        )
+        frame_period = st.number_input(
+            "Time between frames (s)",
+            min_value=0.0001,
+            value=config.frame_period,
+            format="%.4f",
+        )
+
+    try:
+        config = AnalysisConfig(
+            baseline_frames=(1, baseline_last),
+            peak_frames=(peak_first, peak_last),
+            auc_frames=(1, auc_last),
+            odor_onset_frame=odor_onset_frame,
+            frame_period=frame_period,
+        )
+    except ValueError as error_msg:
+        st.error(f"{error_msg}: Check the analysis windows.")
+        st.stop()
+
+    return config
+
+
+def choose_significance_test() -> SignificanceTest | None:
+    """Prompts user for whether and how to test each odor's trials against
+    the blank's trials.
+
+    Returns:
+        The selected test settings, or None if no test is run.
+    """
+
+    test = st.session_state.significance_test
+    methods = ("None", "Permutation", "Bootstrap")
+
+    with st.expander("Trial significance test"):
+        method = st.radio(
+            "Test each odor's trial DeltaF values against the blank's with:",
+            methods,
+            index=0 if test is None else methods.index(test.method.title()),
+        )
+        if test is None:
+            test = SignificanceTest()
+        n_resamples = st.number_input(
+            "Number of resamples",
+            min_value=100,
+            step=1000,
+            value=test.n_resamples,
+        )
+        alpha = st.number_input(
+            "False discovery rate",
+            min_value=0.001,
+            max_value=0.5,
+            value=test.alpha,
+            format="%.3f",
+        )
+        n_workers = st.number_input(
+            "Number of processes drawing resamples",
+            min_value=1,
+            max_value=os.cpu_count() or 1,
+            value=test.n_workers,
+        )
+
+    if method == "None":
+        return None
+
+    return SignificanceTest(
+        method=method.lower(),
+        n_resamples=n_resamples,
+        alpha=alpha,
+        n_workers=n_workers,
+    )
+
+
 def choose_run_type() -> str:
     """Asks user whether they want to export the solenoid info as csv or do
     the analysis as normal.
@@ -119,6 +367,20 @@ def run_analysis(
     sample_type: str,
     run_type: str,
     drop_trial: bool,
+    n_workers: int = 1,
+    pool_type: str = "thread",
+    use_cache: bool = True,
+    sustained_frames: int = 1,
+    session_index: SessionIndex = None,
+    rename_files: bool = False,
+    low_memory: bool = False,
+    save_raw_means: bool = True,
+    precision: str = "float64",
+    precision_report: bool = False,
+    analysis_config: AnalysisConfig = None,
+    save_trial_metrics: bool = False,
+    significance_test: SignificanceTest = None,
+    analysis_workers: int = 1,
 ):
     """Runs the analysis for one imaging session.
 
@@ -130,9 +392,51 @@ def run_analysis(
         sample_type: Type of sample being analysed.
         run_type: Type of analysis to run.
         drop_trial: Whether to drop trials.
+        n_workers: The number of .txt files to read at the same time.
+        pool_type: "thread" or "process" pool for reading .txt files.
+        use_cache: Whether to reuse cached trial data.
+        sustained_frames: The number of consecutive frames a response must
+            stay above the onset threshold.
+        session_index: The files in the folder, if already listed.
+        rename_files: Whether to rename the .txt files on disk to the
+            _000.txt format.
+        low_memory: Whether to read the trials one at a time into per-odor
+            sums instead of keeping them all in memory.
+        save_raw_means: Whether to save the _raw_means files.
+        precision: The dtype of the trial data in memory, "float64" or
+            "float32".
+        precision_report: Whether to report the largest differences from
+            full precision.
+        analysis_config: The frame windows and frame rate, the defaults if
+            None.
+        save_trial_metrics: Whether to analyze every trial and save the
+            per-trial values.
+        significance_test: The settings of the resampling test against the
+            blank, or None to skip it.
+        analysis_workers: The number of processes analyzing blocks of
+            samples.
     """
 
-    data = RawFolder(folder_path, date, animal, ROI, sample_type, drop_trial)
+    data = RawFolder(
+        folder_path,
+        date,
+        animal,
+        ROI,
+        sample_type,
+        drop_trial,
+        n_workers,
+        pool_type,
+        use_cache,
+        sustained_frames,
+        session_index,
+        low_memory,
+        save_raw_means,
+        precision,
+        analysis_config,
+        save_trial_metrics,
+        significance_test,
+        analysis_workers,
+    )
     # data.get_solenoid_order()  # gets odor order from solenoid txt file
 
     with st.status("Analyzing data...", expanded=True) as status:
@@ -160,11 +464,7 @@ def run_analysis(
 
         elif run_type == "analysis":
             # display error message if no txt files present
-            data_files = [
-                x
-                for x in os.listdir(data.session_path)
-                if "solenoid" not in x and ".txt" in x
-            ]
+            data_files = data.session_index.trial_files
             if len(data_files) == 0:
                 status.update(
                     label="Please make sure the Ca imaging txt files are present in "
@@ -173,12 +473,18 @@ def run_analysis(
                     expanded=False,
                 )
             else:
-                data.rename_txt(
-                    status
-                )  # adds _000.txt to end of first trial file
-                file_paths = data.get_txt_file_paths()
                 try:
-                    data_df = data.iterate_txt_files(file_paths)
+                    # matches .txt files to trials, leaving files untouched
+                    data.map_trial_files()
+                    if rename_files:
+                        # adds _000.txt to end of first trial file etc.
+                        data.rename_txt()
+                    file_paths = data.get_txt_file_paths()
+                    if low_memory:
+                        # averages trials as they are read, skipping drops
+                        data.stream_trial_files(file_paths)
+                    else:
+                        trial_cube = data.load_trial_cube(file_paths)
                 except Exception as error_msg:
                     st.error(
                         f"{error_msg}: Check that the contents of the "
@@ -191,21 +497,36 @@ def run_analysis(
                         expanded=True,
                     )
                     st.stop()
-                data.organize_all_data_df(data_df)
-
-                # Drop trials from the data set.
-                if drop_trial:
-                    data.drop_trials()
-
-                # sort all data by neuron/glomerulus
-                # adds progress bar
-                bar = stqdm(
-                    range(data.total_n),
-                    desc=f"Analyzing {sample_type}",
-                )
-                for n_count in bar:
-                    bar_text = data.process_txt_data(n_count, sample_type)
-                    bar.set_description(bar_text, refresh=True)
+                if not low_memory:
+                    data.organize_all_data_df(trial_cube)
+
+                    # Drop trials from the data set.
+                    if drop_trial:
+                        data.drop_trials()
+
+                # sort all data by odor and analyze all samples at once
+                data.group_trials()
+                data.analyze_all_samples()
+
+                save_outputs(data, sample_type)
+
+                if precision_report:
+                    st.write("Largest differences from full precision:")
+                    st.dataframe(data.make_precision_report())
+                data.remove_raw_cube()
+
+                # keeps the loaded trials for reviewing drops, except in
+                # low-memory mode where they aren't all loaded
+                if low_memory:
+                    st.session_state.review_data = None
+                else:
+                    st.session_state.review_data = data
+                    st.session_state.review_table = data.make_trial_table()
+                    st.session_state.saved_drops = sorted(
+                        data.drop_trials_list
+                    )
+                    # forgets the edits made to the last session's trials
+                    st.session_state.pop("review_trial_table", None)
 
                 status.update(
                     label="Analysis finished.",
@@ -214,6 +535,223 @@ def run_analysis(
                 )
 
 
+def save_outputs(data: RawFolder, sample_type: str):
+    """Saves the .xlsx and .parquet outputs of an analyzed session and
+    remembers the run for later runs.
+
+    Args:
+        data: The analyzed session.
+        sample_type: Type of sample being analysed.
+    """
+
+    # save all data by neuron/glomerulus
+    # adds progress bar
+    bar = stqdm(
+        range(data.total_n),
+        desc=f"Analyzing {sample_type}",
+    )
+    with data.open_workbooks():
+        for n_count in bar:
+            bar_text = data.process_txt_data(n_count, sample_type)
+            bar.set_description(bar_text, refresh=True)
+
+    # saves typed copies of the outputs for faster loading
+    data.save_columnar_outputs()
+
+    # remembers this run so re-runs only update what changed
+    data.save_last_run()
+
+
+def review_trials(data: RawFolder):
+    """Shows the trials of the last analyzed session so they can be dropped
+    or restored without loading the session again.
+
+    Only the odors whose trials changed are averaged and analyzed again,
+    from the trials kept in memory. The per-trial traces of one sample and
+    odor are plotted to spot e.g. motion artifacts. The outputs are only
+    saved again when the user confirms.
+
+    Args:
+        data: The analyzed session, with all of its trials loaded.
+    """
+
+    st.subheader("Review trials")
+    st.markdown(
+        "Tick **Dropped** to drop a trial or untick it to restore it. The "
+        "values below update right away, but the output files only change "
+        "when you save them."
+    )
+
+    trial_table = st.data_editor(
+        st.session_state.review_table,
+        disabled=["Trial", "Odor", "File", "Frames"],
+        hide_index=True,
+        key="review_trial_table",
+    )
+    drop_list = trial_table.loc[trial_table["Dropped"], "Trial"].tolist()
+
+    try:
+        changed_odors = data.update_dropped_trials(drop_list)
+    except Exception as error_msg:
+        st.error(f"{error_msg}: Keep at least one trial.")
+        st.stop()
+    if len(changed_odors) > 0:
+        st.write(
+            "Analyzed again odors "
+            f"{', '.join(str(x) for x in changed_odors)}."
+        )
+
+    sample = st.selectbox(
+        f"Select {data.sample_type.lower()} to display:",
+        data.n_column_labels,
+    )
+    odor = st.selectbox(
+        "Select odor to display:", np.unique(data.all_odor_ids).tolist()
+    )
+    n_count = data.n_column_labels.index(sample)
+
+    avg_trace = None
+    if odor in data.trial_groups.odors:
+        avg_trace = data.trial_groups.avg_means(n_count)[odor]
+    st.plotly_chart(
+        plot_trial_traces(
+            data.get_trial_traces(n_count, odor),
+            data.drop_trials_list,
+            avg_trace,
+        )
+    )
+
+    sample_test_results = None
+    if data.test_results is not None:
+        sample_test_results = data.test_results[n_count]
+    st.dataframe(
+        data.make_analysis_df(
+            data.analysis_results[n_count],
+            data.trial_groups.odors,
+            sample_test_results,
+        ).astype(str)
+    )
+
+    if sorted(data.drop_trials_list) == st.session_state.saved_drops:
+        st.info("The output files match these trials.")
+    elif st.button("Save outputs with these trials"):
+        save_outputs(data, data.sample_type)
+        st.session_state.saved_drops = sorted(data.drop_trials_list)
+        drops = ",".join(str(x) for x in data.drop_trials_list)
+        st.success(
+            "Outputs saved. Dropped trials: " + (drops or "none") + "."
+        )
+
+
+def watch_session(
+    folder_path: str,
+    date: str,
+    animal: str,
+    ROI: str,
+    sample_type: str,
+    drop_trial: bool,
+    sustained_frames: int = 1,
+    analysis_config: AnalysisConfig = None,
+    poll_seconds: int = 5,
+    idle_minutes: int = 30,
+):
+    """Analyzes the trials of an imaging session as they are saved, and shows
+    the running results until every trial in the solenoid order is in.
+
+    The progress message is updated on every check of the folder, which is
+    also where Streamlit can stop the loop after "Stop watching" is clicked.
+
+    Args:
+        folder_path: Path to the folder to watch.
+        date: Date of the experiment (YYYYMMDD).
+        animal: Name of the animal being analysed.
+        ROI: Region of Interest.
+        sample_type: Type of sample being analysed.
+        drop_trial: Whether to drop trials.
+        sustained_frames: The number of consecutive frames a response must
+            stay above the onset threshold.
+        analysis_config: The frame windows and frame rate, the defaults if
+            None.
+        poll_seconds: How often to check the folder for new .txt files.
+        idle_minutes: How long to wait for a new .txt file before watching
+            stops, e.g. if acquisition was aborted.
+    """
+
+    data = RawFolder(
+        folder_path,
+        date,
+        animal,
+        ROI,
+        sample_type,
+        drop_trial,
+        sustained_frames=sustained_frames,
+        analysis_config=analysis_config,
+    )
+
+    try:
+        data.get_solenoid_order()
+        live = LiveSession(data)
+    except Exception as error_msg:
+        st.error(
+            f"{error_msg}: Check that the contents of the solenoid order file "
+            "look correct."
+        )
+        st.stop()
+
+    # clicking any button reruns the page, which stops the loop below
+    st.button("Stop watching")
+    progress = st.empty()
+    deltaF_F_table = st.empty()
+    significance_table = st.empty()
+    progress.write(
+        f"Waiting for .txt files in {os.path.basename(folder_path)}"
+    )
+
+    last_added = time.monotonic()
+    last_file = None
+
+    while not live.is_complete:
+        try:
+            new_files = live.poll()
+        except Exception as error_msg:
+            st.error(f"{error_msg}: Stopped watching the folder.")
+            st.stop()
+
+        if new_files:
+            last_added = time.monotonic()
+            last_file = new_files[-1]
+            deltaF_F_df, significance_df = live.make_tables()
+            with deltaF_F_table.container():
+                st.write("Blank-subtracted DeltaF/F(%)")
+                st.dataframe(deltaF_F_df)
+            with significance_table.container():
+                st.write("Significant response?")
+                st.dataframe(significance_df)
+
+        # writing on every check lets Streamlit stop the loop on a rerun
+        progress_msg = (
+            f"Checked at {time.strftime('%H:%M:%S')}, "
+            f"{len(live.added_files)} of {live.n_trials} trials in"
+        )
+        if last_file:
+            progress_msg += f", last added: {last_file}"
+        progress.write(progress_msg)
+
+        if live.is_complete:
+            break
+
+        if time.monotonic() - last_added > idle_minutes * 60:
+            st.warning(
+                f"No new .txt files in {idle_minutes} minutes: Stopped "
+                "watching the folder."
+            )
+            st.stop()
+
+        time.sleep(poll_seconds)
+
+    st.success("All trials are in. Running the full analysis.")
+
+
 def main():
     set_webapp_params()
     initialize_states()
@@ -226,7 +764,9 @@ def main():
 
         if date:
             # if folder has been selected properly, proceed
-            solenoid_file = check_solenoid_file(st.session_state.dir_path)
+            # lists the folder's files once for all the steps below
+            session_index = SessionIndex(st.session_state.dir_path)
+            solenoid_file = check_solenoid_file(session_index)
 
             # if solenoid file is present and correctly named, proceed
             if solenoid_file:
@@ -244,12 +784,49 @@ def main():
                             "Enter trial number to drop, separated by comma if "
                             "there are multiple, e.g. 1,2,5,6"
                         )
+                    (
+                        st.session_state.n_workers,
+                        st.session_state.pool_type,
+                        st.session_state.use_cache,
+                        st.session_state.sustained_frames,
+                        st.session_state.rename_files,
+                        st.session_state.low_memory,
+                        st.session_state.save_raw_means,
+                        st.session_state.precision,
+                        st.session_state.precision_report,
+                        st.session_state.save_trial_metrics,
+                        st.session_state.analysis_workers,
+                    ) = choose_advanced_options()
+                    st.session_state.analysis_config = (
+                        choose_analysis_config()
+                    )
+                    st.session_state.significance_test = (
+                        choose_significance_test()
+                    )
+                    st.session_state.watch_folder = st.checkbox(
+                        "Watch the folder and analyze trials as they are "
+                        "saved during acquisition",
+                        value=st.session_state.watch_folder,
+                    )
+                else:
+                    st.session_state.watch_folder = False
 
-                st.warning(
-                    "If this is a re-run, please delete all the .xlsx files "
-                    " from the previous run through before clicking Go!"
-                )
                 if st.button("Go!"):
+                    if st.session_state.watch_folder:
+                        watch_session(
+                            st.session_state.dir_path,
+                            date,
+                            animal_id,
+                            roi,
+                            st.session_state.sample_type,
+                            st.session_state.drop_trial,
+                            st.session_state.sustained_frames,
+                            st.session_state.analysis_config,
+                        )
+                        # picks up the files saved while watching
+                        session_index = SessionIndex(
+                            st.session_state.dir_path
+                        )
                     run_analysis(
                         st.session_state.dir_path,
                         date,
@@ -258,8 +835,30 @@ def main():
                         st.session_state.sample_type,
                         st.session_state.run_type,
                         st.session_state.drop_trial,
+                        st.session_state.n_workers,
+                        st.session_state.pool_type,
+                        st.session_state.use_cache,
+                        st.session_state.sustained_frames,
+                        session_index,
+                        st.session_state.rename_files,
+                        st.session_state.low_memory,
+                        st.session_state.save_raw_means,
+                        st.session_state.precision,
+                        st.session_state.precision_report,
+                        st.session_state.analysis_config,
+                        st.session_state.save_trial_metrics,
+                        st.session_state.significance_test,
+                        st.session_state.analysis_workers,
                     )
 
+                # only reviews the session that was last analyzed
+                review_data = st.session_state.review_data
+                if (
+                    review_data is not None
+                    and review_data.session_path == st.session_state.dir_path
+                ):
+                    review_trials(review_data)
+
 
 if __name__ == "__main__":
     main()
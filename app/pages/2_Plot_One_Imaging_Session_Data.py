@@ -50,7 +50,9 @@ def prompt_file():
     st.markdown(
         "Please select the .xlsx file containing the mean amplitudes that you "
         "want to plot. The file should be named in the format "
-        "YYMMDD--123456-7-8_ROIX_avg_means.xlsx."
+        "YYMMDD--123456-7-8_ROIX_avg_means.xlsx. The "
+        "YYMMDD--123456-7-8_ROIX_avg_means.parquet file saved with it can be "
+        "selected instead and loads faster."
     )
     st.session_state.file = st.file_uploader(
         label="Choose a file", label_visibility="collapsed"
@@ -64,7 +66,8 @@ def check_file():
         if "avg_means" not in st.session_state.file.name:
             st.error(
                 "Please make sure that the correct file with name "
-                "ending in 'avg_means.xlsx' has been uploaded."
+                "ending in 'avg_means.xlsx' or 'avg_means.parquet' has been "
+                "uploaded."
             )
             st.session_state.pg2_load_data = False
             st.session_state.file = False
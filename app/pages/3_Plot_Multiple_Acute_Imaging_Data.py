@@ -11,6 +11,7 @@ drop-down menu). Analysis will generate compiled_dataset_analysis.xlsx file
 containing the summary statistics for all imaging sessions in the dataset.
 """
 
+import os
 import plotly.io as pio
 
 pio.templates.default = "plotly_white"
@@ -67,6 +68,9 @@ def initialize_states():
     if "selected_odor" not in st.session_state:
         st.session_state.selected_odor = False
 
+    if "load_workers" not in st.session_state:
+        st.session_state.load_workers = os.cpu_count() or 1
+
     # measures to plot
     st.session_state.measures = [
         "Baseline",
@@ -110,6 +114,13 @@ def upload_dataset():
         accept_multiple_files=True,
     )
 
+    st.session_state.load_workers = st.number_input(
+        "Number of .xlsx files to load at the same time",
+        min_value=1,
+        max_value=os.cpu_count() or 1,
+        value=st.session_state.load_workers,
+    )
+
 
 def get_data(status: st.status) -> list:
     """Gets data from uploaded .xlsx files and drops non-significant response
@@ -128,7 +139,9 @@ def get_data(status: st.status) -> list:
         f"files..."
     )
     dict_list, df_list = import_all_excel_data(
-        "acute", st.session_state.acute_files
+        "acute",
+        st.session_state.acute_files,
+        st.session_state.load_workers,
     )
 
     sample_type = df_list[0].index.name
@@ -11,6 +11,7 @@ drop-down menu). Analysis will generate compiled_dataset_analysis.xlsx file
 containing the summary statistics for all imaging sessions in the dataset.
 """
 
+import os
 import plotly.io as pio
 
 pio.templates.default = "plotly_white"
@@ -72,6 +73,9 @@ def initialize_states():
     if "selected_odor" not in st.session_state:
         st.session_state.selected_odor = False
 
+    if "load_workers" not in st.session_state:
+        st.session_state.load_workers = os.cpu_count() or 1
+
     # measures to plot
     st.session_state.measures = [
         "Baseline",
@@ -115,6 +119,13 @@ def upload_dataset():
         accept_multiple_files=True,
     )
 
+    st.session_state.load_workers = st.number_input(
+        "Number of .xlsx files to load at the same time",
+        min_value=1,
+        max_value=os.cpu_count() or 1,
+        value=st.session_state.load_workers,
+    )
+
 
 def get_data(status: st.status) -> list:
     """Gets data from uploaded .xlsx files and drops non-significant response
@@ -131,7 +142,9 @@ def get_data(status: st.status) -> list:
     )
 
     dict_list, df_list = import_all_excel_data(
-        "chronic", st.session_state.chronic_files
+        "chronic",
+        st.session_state.chronic_files,
+        st.session_state.load_workers,
     )
     sample_type = df_list[0].index.name
 
@@ -0,0 +1,947 @@
+"""Contains vectorized functions for analyzing the trial-averaged
+fluorescence values of all samples at once.
+
+The functions work on an avg_cube array with shape (samples, odors, frames),
+where the last odor is the blank. Reductions are taken along the contiguous
+frames axis and skip NaN values, which gives the same numbers as the pandas
+reductions used on one sample's avg_means DataFrame.
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from src.utils import attach_shared_array, share_array
+
+# Structured dtype holding the analysis values for one sample and odor
+ANALYSIS_DTYPE = np.dtype(
+    [
+        ("baseline", np.float64),
+        ("peak", np.float64),
+        ("deltaF", np.float64),
+        ("baseline_stdx3", np.float64),
+        ("deltaF_blank", np.float64),
+        ("blank_sub_deltaF", np.float64),
+        ("blank_sub_deltaF_F_perc", np.float64),
+        ("significant", np.bool_),
+        ("auc", np.float64),
+        ("auc_blank", np.float64),
+        ("blank_sub_auc", np.float64),
+        ("peak_time", np.float64),
+        ("odor_onset", np.float64),
+        ("response_onset", np.float64),
+        ("latency", np.float64),
+        ("time_to_peak", np.float64),
+    ]
+)
+
+# Labels of the analysis values in the _analysis output files
+ANALYSIS_LABELS = {
+    "baseline": "Baseline",
+    "peak": "Peak",
+    "deltaF": "DeltaF",
+    "baseline_stdx3": "3 std of baseline",
+    "deltaF_blank": "DeltaF(BLANK)",
+    "blank_sub_deltaF": "Blank-subtracted DeltaF",
+    "blank_sub_deltaF_F_perc": "Blank-subtracted DeltaF/F(%)",
+    "significant": "Significant response?",
+    "auc": "Area under curve",
+    "auc_blank": "Blank area under curve",
+    "blank_sub_auc": "Blank sub AUC",
+    "peak_time": "Time at peak (s)",
+    "odor_onset": "Odor onset",
+    "response_onset": "Response onset (s)",
+    "latency": "Latency (s)",
+    "time_to_peak": "Time to peak (s)",
+}
+
+# Analysis values that are only reported for significant responses
+SIG_ONLY_FIELDS = (
+    "blank_sub_auc",
+    "peak_time",
+    "response_onset",
+    "latency",
+    "time_to_peak",
+)
+
+# Structured dtype holding the analysis values for one sample and trial
+TRIAL_DTYPE = np.dtype(
+    [
+        ("baseline", np.float64),
+        ("peak", np.float64),
+        ("deltaF", np.float64),
+        ("deltaF_F_perc", np.float64),
+        ("baseline_stdx3", np.float64),
+        ("auc", np.float64),
+        ("peak_time", np.float64),
+        ("response_onset", np.float64),
+        ("latency", np.float64),
+    ]
+)
+
+# Labels of the per-trial analysis values in the _trial_metrics output file
+TRIAL_LABELS = {
+    "baseline": "Baseline",
+    "peak": "Peak",
+    "deltaF": "DeltaF",
+    "deltaF_F_perc": "DeltaF/F(%)",
+    "baseline_stdx3": "3 std of baseline",
+    "auc": "Area under curve",
+    "peak_time": "Time at peak (s)",
+    "response_onset": "Response onset (s)",
+    "latency": "Latency (s)",
+}
+
+# Number of sample blocks per worker, so workers that finish early can take
+# another block
+BLOCKS_PER_WORKER = 4
+
+# Structured dtype holding the window sweep values for one sample and odor
+SWEEP_DTYPE = np.dtype(
+    [
+        ("baseline", np.float64),
+        ("peak", np.float64),
+        ("deltaF", np.float64),
+        ("baseline_stdx3", np.float64),
+        ("blank_sub_deltaF", np.float64),
+        ("blank_sub_deltaF_F_perc", np.float64),
+        ("significant", np.bool_),
+        ("auc", np.float64),
+        ("blank_sub_auc", np.float64),
+    ]
+)
+
+
+class AnalysisConfig(object):
+    """The frame windows and frame rate used to analyze responses.
+
+    Frames are numbered from 1 and windows include their first and last
+    frames, e.g. the default baseline is frames #1-52.
+
+    Attributes:
+        baseline_frames (tuple): The first and last frames of the baseline.
+        peak_frames (tuple): The first and last frames searched for the
+            peak. Response onset is searched from odor onset to the last
+            peak frame.
+        auc_frames (tuple): The first and last frames of the area under
+            curve.
+        odor_onset_frame (int): The frame of odor onset.
+        frame_period (float): The time between frames, in seconds.
+    """
+
+    def __init__(
+        self,
+        baseline_frames: tuple = (1, 52),
+        peak_frames: tuple = (53, 300),
+        auc_frames: tuple = (1, 300),
+        odor_onset_frame: int = 57,
+        frame_period: float = 0.0661,
+    ):
+        """Initializes an instance of AnalysisConfig().
+
+        Args:
+            baseline_frames: The first and last frames of the baseline.
+            peak_frames: The first and last frames searched for the peak.
+            auc_frames: The first and last frames of the area under curve.
+            odor_onset_frame: The frame of odor onset.
+            frame_period: The time between frames, in seconds.
+        """
+
+        self.baseline_frames = tuple(int(x) for x in baseline_frames)
+        self.peak_frames = tuple(int(x) for x in peak_frames)
+        self.auc_frames = tuple(int(x) for x in auc_frames)
+        self.odor_onset_frame = int(odor_onset_frame)
+        self.frame_period = float(frame_period)
+
+        for name in ["baseline_frames", "peak_frames", "auc_frames"]:
+            first, last = getattr(self, name)
+            if first < 1 or last < first:
+                raise ValueError(f"{name} must be 1 <= first <= last")
+        if self.odor_onset_frame < 1 or self.frame_period <= 0:
+            raise ValueError("odor_onset_frame and frame_period must be > 0")
+
+    @staticmethod
+    def get_slice(frames: tuple) -> slice:
+        """Gets the slice of the frames axis for a window of frames.
+
+        Args:
+            frames: The first and last frames of the window.
+
+        Returns:
+            The slice selecting the window.
+        """
+
+        return slice(frames[0] - 1, frames[1])
+
+    def to_dict(self) -> dict:
+        """Gets the settings as a dict that can be saved as JSON.
+
+        Returns:
+            The settings, with attribute names as keys.
+        """
+
+        return {
+            "baseline_frames": list(self.baseline_frames),
+            "peak_frames": list(self.peak_frames),
+            "auc_frames": list(self.auc_frames),
+            "odor_onset_frame": self.odor_onset_frame,
+            "frame_period": self.frame_period,
+        }
+
+
+def analyze_responses(
+    avg_cube: np.ndarray,
+    sustained_frames: int = 1,
+    config: AnalysisConfig = None,
+) -> np.ndarray:
+    """Analyzes the mean fluorescence values of all samples and odors.
+
+    Args:
+        avg_cube: The mean of mean fluorescence values, with shape
+            (samples, odors, frames).
+        sustained_frames: The number of consecutive frames a response must
+            stay above the onset threshold for its first frame to count as
+            the response onset.
+        config: The frame windows and frame rate, the defaults if None.
+
+    Returns:
+        A structured array with ANALYSIS_DTYPE and shape (samples, odors).
+        Values that are only calculated for significant responses are NaN
+        for non-significant responses.
+    """
+
+    if config is None:
+        config = AnalysisConfig()
+
+    avg_cube = np.ascontiguousarray(avg_cube, dtype=np.float64)
+    results = np.empty(avg_cube.shape[:2], dtype=ANALYSIS_DTYPE)
+
+    (
+        results["baseline"],
+        results["peak"],
+        results["deltaF"],
+        results["baseline_stdx3"],
+        results["deltaF_blank"],
+        results["blank_sub_deltaF"],
+        results["blank_sub_deltaF_F_perc"],
+    ) = calculate_initial_nums(avg_cube, config)
+
+    # Determines whether response is significant by checking whether
+    # blank_sub_deltaF is greater than baseline_stdx3.
+    results["significant"] = (
+        results["blank_sub_deltaF"] > results["baseline_stdx3"]
+    )
+
+    results["auc"], results["auc_blank"] = calc_auc(
+        avg_cube, baseline=results["baseline"], config=config
+    )
+
+    (
+        results["blank_sub_auc"],
+        results["peak_time"],
+        results["odor_onset"],
+        results["response_onset"],
+        results["latency"],
+        results["time_to_peak"],
+    ) = analyze_sig_responses(
+        significant=results["significant"],
+        avg_cube=avg_cube,
+        auc=results["auc"],
+        auc_blank=results["auc_blank"],
+        deltaF=results["deltaF"],
+        baseline=results["baseline"],
+        sustained_frames=sustained_frames,
+        config=config,
+    )
+
+    return results
+
+
+def analyze_trials(
+    trial_cube: np.ndarray,
+    sustained_frames: int = 1,
+    config: AnalysisConfig = None,
+) -> np.ndarray:
+    """Analyzes the fluorescence values of every trial of every sample at
+    once, without averaging trials or subtracting the blank.
+
+    Response onset is the first frame from odor onset where the
+    baseline-subtracted trace reaches 5% of the trial's deltaF, and is
+    found for all trials, since there is no per-trial significance test.
+
+    Args:
+        trial_cube: The fluorescence values of the trials, with shape
+            (trials, frames, samples). float32 values are analyzed in
+            float64.
+        sustained_frames: The number of consecutive frames a response must
+            stay above the onset threshold.
+        config: The frame windows and frame rate, the defaults if None.
+
+    Returns:
+        A structured array with TRIAL_DTYPE and shape (trials, samples).
+    """
+
+    if config is None:
+        config = AnalysisConfig()
+
+    # views the frames as the last axis, like avg_cube
+    traces = np.moveaxis(trial_cube, 1, -1)
+    results = np.empty(traces.shape[:2], dtype=TRIAL_DTYPE)
+
+    def window(frames):
+        return traces[..., frames].astype(np.float64)
+
+    baseline_window = window(config.get_slice(config.baseline_frames))
+    baseline = nanmean(baseline_window)
+    results["baseline"] = baseline
+    results["baseline_stdx3"] = nanstd(baseline_window) * 3
+    del baseline_window
+
+    peak_window = window(config.get_slice(config.peak_frames))
+    results["peak"] = nanmax(peak_window)
+    results["deltaF"] = results["peak"] - baseline
+    results["deltaF_F_perc"] = results["deltaF"] / baseline * 100
+    max_frames = nanargmax(peak_window) + config.peak_frames[0]
+    results["peak_time"] = max_frames * config.frame_period
+    del peak_window
+
+    first, last = config.auc_frames
+    auc_sum = nansum(window(config.get_slice(config.auc_frames)))
+    auc = (auc_sum - baseline * (last - first + 1)) * config.frame_period
+    results["auc"] = np.where(auc < 0, 0.0, auc)
+
+    onset_frame = config.odor_onset_frame
+    onset_window = window(slice(onset_frame - 1, config.peak_frames[1]))
+    onset_idx = find_response_onset(
+        onset_window - baseline[..., np.newaxis],
+        results["deltaF"] * 0.05,
+        sustained_frames,
+    )
+    results["response_onset"] = np.where(
+        onset_idx >= 0, (onset_idx + onset_frame) * config.frame_period, np.nan
+    )
+    results["latency"] = (
+        results["response_onset"] - onset_frame * config.frame_period
+    )
+
+    return results
+
+
+def update_responses(
+    results: np.ndarray,
+    avg_cube: np.ndarray,
+    odor_mask: np.ndarray,
+    sustained_frames: int = 1,
+    config: AnalysisConfig = None,
+) -> np.ndarray:
+    """Analyzes again only the odors selected by odor_mask, keeping earlier
+    results for the others.
+
+    The blank odor is analyzed with the selected odors since their
+    blank-subtracted values depend on it. If the blank itself is selected,
+    all odors are analyzed again.
+
+    Args:
+        results: The earlier analysis values, a structured array with
+            ANALYSIS_DTYPE and shape (samples, odors).
+        avg_cube: The mean of mean fluorescence values, with shape
+            (samples, odors, frames).
+        odor_mask: Which odors to analyze again.
+        sustained_frames: The number of consecutive frames a response must
+            stay above the onset threshold.
+        config: The frame windows and frame rate, the defaults if None.
+
+    Returns:
+        The updated analysis values, with the same shape as results.
+    """
+
+    if odor_mask[-1]:
+        return analyze_responses(avg_cube, sustained_frames, config)
+
+    results = results.copy()
+    odor_cols = np.append(np.flatnonzero(odor_mask), avg_cube.shape[1] - 1)
+    results[:, odor_cols] = analyze_responses(
+        avg_cube[:, odor_cols], sustained_frames, config
+    )
+
+    return results
+
+
+def analyze_sample_blocks(
+    analyze,
+    cube: np.ndarray,
+    sample_axis: int,
+    result_axis: int,
+    args: tuple = (),
+    n_workers: int = 1,
+) -> np.ndarray:
+    """Runs an analysis function on blocks of samples across a process pool.
+
+    The cube is shared with the workers through share_array(), so each
+    worker copies only its own block of samples instead of receiving a
+    pickled copy of the cube. Samples are analyzed independently, so the
+    results match analyzing all samples at once, except that very narrow
+    blocks can change the order of sums in the last few digits.
+
+    Args:
+        analyze: The analysis function, e.g. analyze_responses() or
+            analyze_trials(), taking the cube as its first argument.
+        cube: The values to analyze, e.g. avg_cube or a trial cube.
+        sample_axis: The axis of cube holding the samples.
+        result_axis: The axis of the results holding the samples.
+        args: The other arguments of analyze.
+        n_workers: The number of processes. 1 analyzes all samples at once
+            in this process.
+
+    Returns:
+        The results of all samples, as returned by analyze.
+    """
+
+    n_samples = cube.shape[sample_axis]
+    n_blocks = min(n_samples, n_workers * BLOCKS_PER_WORKER)
+    if n_workers <= 1 or n_blocks <= 1:
+        return analyze(cube, *args)
+
+    bounds = np.linspace(0, n_samples, n_blocks + 1).astype(int)
+    blocks = [slice(start, stop) for start, stop in zip(bounds, bounds[1:])]
+
+    with share_array(cube) as handle, ProcessPoolExecutor(
+        max_workers=n_workers
+    ) as executor:
+        futures = [
+            executor.submit(
+                analyze_shared_block, analyze, handle, sample_axis, x, args
+            )
+            for x in blocks
+        ]
+        results = [future.result() for future in futures]
+
+    return np.concatenate(results, axis=result_axis)
+
+
+def analyze_shared_block(
+    analyze, handle: dict, sample_axis: int, block: slice, args: tuple
+) -> np.ndarray:
+    """Runs an analysis function in a worker process on one block of
+    samples of a shared cube.
+
+    Args:
+        analyze: The analysis function.
+        handle: The dict describing the shared cube.
+        sample_axis: The axis of the cube holding the samples.
+        block: The samples to analyze.
+        args: The other arguments of analyze.
+
+    Returns:
+        The results of the block's samples.
+    """
+
+    cube, shm = attach_shared_array(handle)
+    try:
+        index = [slice(None)] * cube.ndim
+        index[sample_axis] = block
+        values = np.array(cube[tuple(index)])
+    finally:
+        del cube
+        if shm is not None:
+            shm.close()
+
+    return analyze(values, *args)
+
+
+class WindowIndex(object):
+    """Cumulative sums over the frames of avg_cube, so the sum, mean and
+    standard deviation of any window of frames take O(1) per sample and
+    odor, for many windows at once.
+
+    Each trace is shifted by its mean before its squares are summed, which
+    keeps the one-pass standard deviation accurate. NaN values are skipped.
+    Values can differ from nanmean() and nanstd() in the last few digits.
+
+    Attributes:
+        shift (np.ndarray): The mean of each trace, with shape (samples,
+            odors).
+        sums (np.ndarray): The cumulative sums of the shifted values, with
+            shape (samples, odors, frames + 1) and 0 before the first frame.
+        sq_sums (np.ndarray): The cumulative sums of the squared shifted
+            values, with the same shape as sums.
+        counts (np.ndarray): The cumulative counts of non-NaN values, with
+            the same shape as sums.
+    """
+
+    def __init__(self, avg_cube: np.ndarray):
+        """Initializes an instance of WindowIndex() for one session.
+
+        Args:
+            avg_cube: The mean of mean fluorescence values, with shape
+                (samples, odors, frames).
+        """
+
+        avg_cube = np.asarray(avg_cube, dtype=np.float64)
+        is_value = ~np.isnan(avg_cube)
+
+        self.shift = np.nan_to_num(nanmean(avg_cube))
+        shifted = np.where(is_value, avg_cube - self.shift[..., None], 0.0)
+
+        pad = ((0, 0), (0, 0), (1, 0))
+        self.sums = np.pad(np.cumsum(shifted, axis=-1), pad)
+        self.sq_sums = np.pad(np.cumsum(shifted**2, axis=-1), pad)
+        self.counts = np.pad(
+            np.cumsum(is_value, axis=-1, dtype=np.int64), pad
+        )
+
+    def get_window_totals(
+        self, windows: np.ndarray
+    ) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """Gets the totals of the shifted values in each window.
+
+        Args:
+            windows: The first and last frames of each window, with shape
+                (windows, 2). Frames are numbered from 1.
+
+        Returns:
+            A tuple containing the sums, sums of squares and counts of
+            non-NaN values, each with shape (samples, odors, windows).
+        """
+
+        windows = np.asarray(windows).reshape(-1, 2)
+        n_frames = self.sums.shape[-1] - 1
+        starts = np.minimum(windows[:, 0] - 1, n_frames)
+        ends = np.minimum(windows[:, 1], n_frames)
+
+        return tuple(
+            totals[..., ends] - totals[..., starts]
+            for totals in (self.sums, self.sq_sums, self.counts)
+        )
+
+    def window_sum(self, windows: np.ndarray) -> np.ndarray:
+        """Sums the values in each window, treating NaN as zero.
+
+        Args:
+            windows: The first and last frames of each window, with shape
+                (windows, 2).
+
+        Returns:
+            The sums, with shape (samples, odors, windows).
+        """
+
+        sums, _, counts = self.get_window_totals(windows)
+
+        return sums + counts * self.shift[..., None]
+
+    def window_mean(self, windows: np.ndarray) -> np.ndarray:
+        """Takes the mean of the values in each window, skipping NaN values.
+
+        Args:
+            windows: The first and last frames of each window, with shape
+                (windows, 2).
+
+        Returns:
+            The means, with shape (samples, odors, windows). NaN where all
+            values are NaN.
+        """
+
+        sums, _, counts = self.get_window_totals(windows)
+
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return sums / counts + self.shift[..., None]
+
+    def window_std(self, windows: np.ndarray, ddof: int = 1) -> np.ndarray:
+        """Takes the standard deviation of the values in each window,
+        skipping NaN values.
+
+        Args:
+            windows: The first and last frames of each window, with shape
+                (windows, 2).
+            ddof: Delta degrees of freedom.
+
+        Returns:
+            The standard deviations, with shape (samples, odors, windows).
+            NaN where there are not more than ddof values.
+        """
+
+        sums, sq_sums, counts = self.get_window_totals(windows)
+
+        with np.errstate(invalid="ignore", divide="ignore"):
+            variance = (sq_sums - sums**2 / counts) / (counts - ddof)
+        variance = np.where(
+            counts - ddof > 0, np.maximum(variance, 0), np.nan
+        )
+
+        return np.sqrt(variance)
+
+
+def sweep_windows(avg_cube: np.ndarray, configs: list) -> np.ndarray:
+    """Calculates the window-based values of all samples and odors for
+    several analysis configs in one batched pass.
+
+    Baselines, baseline standard deviations and AUCs of every config come
+    from one WindowIndex. Peaks can't be taken from cumulative sums, so
+    each distinct peak window is searched once.
+
+    Args:
+        avg_cube: The mean of mean fluorescence values, with shape
+            (samples, odors, frames). The last odor is the blank.
+        configs: The AnalysisConfig of each setting to try.
+
+    Returns:
+        A structured array with SWEEP_DTYPE and shape (configs, samples,
+        odors).
+    """
+
+    avg_cube = np.ascontiguousarray(avg_cube, dtype=np.float64)
+    index = WindowIndex(avg_cube)
+
+    baseline_windows = np.array([x.baseline_frames for x in configs])
+    auc_windows = np.array([x.auc_frames for x in configs])
+    auc_lengths = auc_windows[:, 1] - auc_windows[:, 0] + 1
+    frame_periods = np.array([x.frame_period for x in configs])
+
+    # moves the configs axis first
+    baseline = np.moveaxis(index.window_mean(baseline_windows), -1, 0)
+    baseline_std = np.moveaxis(index.window_std(baseline_windows), -1, 0)
+    auc_sum = np.moveaxis(index.window_sum(auc_windows), -1, 0)
+
+    peak_windows = sorted({x.peak_frames for x in configs})
+    window_peaks = {
+        window: nanmax(avg_cube[..., AnalysisConfig.get_slice(window)])
+        for window in peak_windows
+    }
+    peak = np.stack([window_peaks[x.peak_frames] for x in configs])
+
+    results = np.empty((len(configs), *avg_cube.shape[:2]), SWEEP_DTYPE)
+    results["baseline"] = baseline
+    results["peak"] = peak
+    results["deltaF"] = peak - baseline
+    results["baseline_stdx3"] = baseline_std * 3
+    results["blank_sub_deltaF"] = (
+        results["deltaF"] - results["deltaF"][..., -1:]
+    )
+    results["blank_sub_deltaF_F_perc"] = (
+        results["blank_sub_deltaF"] / baseline * 100
+    )
+    results["significant"] = (
+        results["blank_sub_deltaF"] > results["baseline_stdx3"]
+    )
+
+    auc_baseline = baseline * auc_lengths[:, None, None]
+    auc = (auc_sum - auc_baseline) * frame_periods[:, None, None]
+    results["auc"] = np.where(auc < 0, 0.0, auc)
+    results["blank_sub_auc"] = np.where(
+        results["significant"],
+        results["auc"] - results["auc"][..., -1:],
+        np.nan,
+    )
+
+    return results
+
+
+def calculate_initial_nums(
+    avg_cube: np.ndarray, config: AnalysisConfig
+) -> tuple[np.ndarray, ...]:
+    """Performs initial calculations for mean fluorescence values.
+
+    Args:
+        avg_cube: The mean of mean fluorescence values, with shape
+            (samples, odors, frames).
+        config: The frame windows and frame rate.
+
+    Returns:
+        A tuple containing the following arrays, with shape (samples, odors):
+            baseline: The fluorescence values from defined baseline period.
+            peak: The max fluorescence value during trial period.
+            deltaF: The change in fluorescence value from peak and baseline.
+            baseline_stdx3: Three standard deviations of baseline.
+            deltaF_blank: The deltaF value of the blank odor (last odor).
+            blank_sub_deltaF: The deltaF value with the blank odor's
+                deltaF subtracted to remove blank response.
+            blank_sub_deltaF_F_perc: The blank-subtracted deltaF as a
+                percent of baseline.
+    """
+
+    baseline_window = avg_cube[..., config.get_slice(config.baseline_frames)]
+    baseline = nanmean(baseline_window)
+
+    # Calculates peak using max value from frames #53-300 by default
+    peak = nanmax(avg_cube[..., config.get_slice(config.peak_frames)])
+    deltaF = peak - baseline
+    baseline_stdx3 = nanstd(baseline_window) * 3
+
+    deltaF_blank = np.repeat(deltaF[:, -1:], deltaF.shape[1], axis=1)
+    blank_sub_deltaF = deltaF - deltaF_blank
+    blank_sub_deltaF_F_perc = blank_sub_deltaF / baseline * 100
+
+    return (
+        baseline,
+        peak,
+        deltaF,
+        baseline_stdx3,
+        deltaF_blank,
+        blank_sub_deltaF,
+        blank_sub_deltaF_F_perc,
+    )
+
+
+def calc_auc(
+    avg_cube: np.ndarray, baseline: np.ndarray, config: AnalysisConfig
+) -> tuple[np.ndarray, np.ndarray]:
+    """Calculates area under curve (AUC).
+
+    Args:
+        avg_cube: The mean of mean fluorescence values, with shape
+            (samples, odors, frames).
+        baseline: Baseline fluorescence values, with shape (samples, odors).
+        config: The frame windows and frame rate.
+
+    Returns:
+        A tuple containing the AUC values for each odor and the AUC value of
+        the blank odor repeated for each odor, both with shape
+        (samples, odors).
+    """
+
+    # Calculates AUC using sum of values from frames # 1-300 by default
+    first, last = config.auc_frames
+    auc_sum = nansum(avg_cube[..., config.get_slice(config.auc_frames)])
+    auc = (auc_sum - (baseline * (last - first + 1))) * config.frame_period
+    auc = np.where(auc < 0, 0.0, auc)  # Sets negative AUC values to 0
+
+    # Gets AUC_blank from AUC of the last odor
+    auc_blank = np.repeat(auc[:, -1:], auc.shape[1], axis=1)
+
+    return auc, auc_blank
+
+
+def analyze_sig_responses(
+    significant: np.ndarray,
+    avg_cube: np.ndarray,
+    auc: np.ndarray,
+    auc_blank: np.ndarray,
+    deltaF: np.ndarray,
+    baseline: np.ndarray,
+    sustained_frames: int = 1,
+    config: AnalysisConfig = None,
+) -> tuple[np.ndarray, ...]:
+    """Analyzes odor responses, keeping values for significant responses only.
+
+    Response onset is the first frame from odor onset where the
+    baseline-subtracted signal reaches 5% of deltaF (and stays there for
+    sustained_frames frames). Responses that never reach it have NaN
+    response onset, latency and time to peak.
+
+    Args:
+        significant: Whether each response is significant, with shape
+            (samples, odors).
+        avg_cube: The mean of mean fluorescence values, with shape
+            (samples, odors, frames).
+        auc: The area under curve values for all odors.
+        auc_blank: The area under curve values for the blank odor.
+        deltaF: The deltaF values for all odors.
+        baseline: The baseline fluorescence values for all odors.
+        sustained_frames: The number of consecutive frames the signal must
+            stay above the onset threshold.
+        config: The frame windows and frame rate, the defaults if None.
+
+    Returns:
+        A tuple containing the following arrays, with shape (samples, odors)
+        and NaN for non-significant responses:
+            blank_sub_auc: The AUC, minus the blank AUC.
+            peak_times: The times of peak fluorescence.
+            odor_onset: The odor onset time (frame 57 by default).
+            response_onset: The response onset times.
+            latency: The latency to response onset from odor onset.
+            time_to_peak: The times from response onset to response peak.
+    """
+
+    if config is None:
+        config = AnalysisConfig()
+    frame_period = config.frame_period
+    onset_frame = config.odor_onset_frame
+    not_significant = ~significant
+
+    # Calculates blank-subtracted AUC only if response is present
+    blank_sub_auc = auc - auc_blank
+
+    # Calculates time at signal peak using frames #53-300 by default
+    peak_slice = config.get_slice(config.peak_frames)
+    max_frames = nanargmax(avg_cube[..., peak_slice]) + config.peak_frames[0]
+    peak_times = max_frames * frame_period
+
+    # Get odor onset - Frame 57 by default
+    odor_onset = np.full(significant.shape, onset_frame * frame_period)
+
+    # Calculate response onset only for significant odors
+    # Window doesn't start at the first peak frame because it can't precede
+    # odor onset
+    onset_slice = slice(onset_frame - 1, config.peak_frames[1])
+    baseline_subtracted = (
+        avg_cube[significant, onset_slice]
+        - baseline[significant, np.newaxis]
+    )
+    onset_amp = deltaF[significant] * 0.05
+    onset_idx = find_response_onset(
+        baseline_subtracted, onset_amp, sustained_frames
+    )
+
+    response_onset = np.full(significant.shape, np.nan)
+    response_onset[significant] = np.where(
+        onset_idx >= 0, (onset_idx + onset_frame) * frame_period, np.nan
+    )
+
+    latency = response_onset - odor_onset
+    time_to_peak = peak_times - response_onset
+
+    for values in (
+        blank_sub_auc,
+        peak_times,
+        response_onset,
+        latency,
+        time_to_peak,
+    ):
+        values[not_significant] = np.nan
+
+    return (
+        blank_sub_auc,
+        peak_times,
+        odor_onset,
+        response_onset,
+        latency,
+        time_to_peak,
+    )
+
+
+def find_response_onset(
+    traces: np.ndarray, threshold: np.ndarray, sustained_frames: int = 1
+) -> np.ndarray:
+    """Finds the first frame where each trace reaches its threshold.
+
+    With sustained_frames > 1, the trace must stay at or above the threshold
+    for that many consecutive frames. Runs are found from a cumulative count
+    of frames above threshold, without looping over traces.
+
+    Args:
+        traces: The traces to search, with frames as the last axis.
+        threshold: The threshold for each trace, with the shape of traces
+            without the last axis.
+        sustained_frames: The number of consecutive frames the trace must
+            stay at or above the threshold.
+
+    Returns:
+        The position of the onset frame in each trace, or -1 for traces that
+        never reach the threshold.
+    """
+
+    crossed = traces >= threshold[..., np.newaxis]
+
+    if sustained_frames > 1:
+        # number of frames above threshold up to and including each frame
+        counts = np.cumsum(crossed, axis=-1, dtype=np.int32)
+        counts = np.concatenate(
+            [np.zeros((*counts.shape[:-1], 1), dtype=np.int32), counts],
+            axis=-1,
+        )
+        crossed = (
+            counts[..., sustained_frames:] - counts[..., :-sustained_frames]
+            == sustained_frames
+        )
+
+    if crossed.shape[-1] == 0:
+        return np.full(crossed.shape[:-1], -1)
+
+    onset_idx = np.argmax(crossed, axis=-1)
+
+    return np.where(crossed.any(axis=-1), onset_idx, -1)
+
+
+def nansum(values: np.ndarray) -> np.ndarray:
+    """Sums values along the last axis, treating NaN as zero.
+
+    Args:
+        values: The values to sum.
+
+    Returns:
+        The sums, with the last axis removed.
+    """
+
+    mask = np.isnan(values)
+    if mask.any():
+        values = np.where(mask, 0.0, values)
+
+    return values.sum(axis=-1)
+
+
+def nanmean(values: np.ndarray) -> np.ndarray:
+    """Takes the mean along the last axis, skipping NaN values.
+
+    Args:
+        values: The values to average.
+
+    Returns:
+        The means, with the last axis removed. NaN where all values are NaN.
+    """
+
+    count = np.count_nonzero(~np.isnan(values), axis=-1)
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return nansum(values) / count
+
+
+def nanstd(values: np.ndarray, ddof: int = 1) -> np.ndarray:
+    """Takes the standard deviation along the last axis, skipping NaN values.
+
+    Uses the same two-pass algorithm as pandas.
+
+    Args:
+        values: The values to take the standard deviation of.
+        ddof: Delta degrees of freedom.
+
+    Returns:
+        The standard deviations, with the last axis removed. NaN where there
+        are not more than ddof values.
+    """
+
+    mask = np.isnan(values)
+    count = np.count_nonzero(~mask, axis=-1)
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        avg = nansum(values) / count
+        sqr = (avg[..., np.newaxis] - values) ** 2
+        if mask.any():
+            sqr = np.where(mask, 0.0, sqr)
+        variance = sqr.sum(axis=-1) / (count - ddof)
+
+    variance = np.where(count - ddof > 0, variance, np.nan)
+
+    return np.sqrt(variance)
+
+
+def nanmax(values: np.ndarray) -> np.ndarray:
+    """Takes the max along the last axis, skipping NaN values.
+
+    Args:
+        values: The values to take the max of.
+
+    Returns:
+        The max values, with the last axis removed. NaN where all values are
+        NaN.
+    """
+
+    filled = np.where(np.isnan(values), -np.inf, values)
+    result = filled.max(axis=-1, initial=-np.inf)
+
+    return np.where(np.isneginf(result), np.nan, result)
+
+
+def nanargmax(values: np.ndarray) -> np.ndarray:
+    """Finds the position of the first max along the last axis, skipping NaN
+    values.
+
+    Args:
+        values: The values to search.
+
+    Returns:
+        The positions of the max values, with the last axis removed.
+    """
+
+    filled = np.where(np.isnan(values), -np.inf, values)
+
+    return filled.argmax(axis=-1)
@@ -0,0 +1,509 @@
+"""Runs the .txt file analysis for every imaging session under a root folder,
+without the Streamlit app.
+
+Session folders are found by their YYMMDD--123456-7-8_ROIX names, then
+checked and analyzed across a process pool, one session per process. A
+batch_summary.csv file listing which sessions succeeded, failed or were
+skipped is saved to the root folder.
+
+Run from the app folder, e.g.:
+    python -m src.batch /Users/Bob/Documents/GCaMP6s --sample-type Cell
+"""
+
+import argparse
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import datetime
+from pathlib import Path
+
+import pandas as pd
+from streamlit import config
+
+from src.analysis import AnalysisConfig
+from src.experiment import RawFolder
+from src.session import SessionIndex
+from src.significance import SignificanceTest
+from src.utils import check_solenoid_file, get_session_info, save_to_csv
+
+
+def hide_streamlit_warning():
+    """Stops Streamlit from warning that the app isn't run with
+    `streamlit run` when st.write() etc. are called outside the app.
+    """
+
+    config.set_option("global.showWarningOnDirectExecution", False)
+
+
+def find_session_folders(root_path: str) -> list:
+    """Finds all imaging session folders under a root folder.
+
+    Any folder with "--" in its name is taken as a session folder, the same
+    way the Load and Analyze txt Files page expects folders to be named.
+    Folders inside a session folder are not searched.
+
+    Args:
+        root_path: Path to the folder containing the session folders.
+
+    Returns:
+        A sorted list of paths to the session folders.
+    """
+
+    session_paths = []
+    for dir_path, dir_names, _ in os.walk(root_path):
+        session_names = [x for x in dir_names if "--" in x]
+        session_paths.extend(Path(dir_path, x) for x in session_names)
+
+        # doesn't walk into session folders
+        dir_names[:] = [x for x in dir_names if "--" not in x]
+
+    return sorted(session_paths)
+
+
+def check_session(session_index: SessionIndex) -> tuple[tuple, str]:
+    """Checks that a session folder can be analyzed.
+
+    Args:
+        session_index: The listed files of the session folder.
+
+    Returns:
+        A tuple containing the date, animal ID and ROI of the session, or
+        None if the session can't be analyzed, and the reason it can't be
+        analyzed.
+    """
+
+    folder = os.path.basename(session_index.session_path)
+    try:
+        session_info = get_session_info(folder)
+    except IndexError:
+        return None, "Folder name isn't in the YYMMDD--123456-7-8_ROIX format."
+
+    if check_solenoid_file(session_index) is None:
+        return None, "No solenoid order file found."
+
+    if len(session_index.trial_files) == 0:
+        return None, "No Ca imaging .txt files found."
+
+    return session_info, ""
+
+
+def analyze_session(
+    session_path: str,
+    sample_type: str,
+    use_cache: bool = True,
+    sustained_frames: int = 1,
+    rename_files: bool = False,
+    low_memory: bool = False,
+    save_raw_means: bool = True,
+    precision: str = "float64",
+    precision_report: bool = False,
+    analysis_config: AnalysisConfig = None,
+    save_trial_metrics: bool = False,
+    significance_test: SignificanceTest = None,
+    analysis_workers: int = 1,
+) -> tuple[str, str]:
+    """Checks and runs the RawFolder analysis for one imaging session.
+
+    Args:
+        session_path: Path to the session folder.
+        sample_type: The sample type, e.g. "Cell", "Glomerulus", or "Grid".
+        use_cache: Whether to reuse cached trial data.
+        sustained_frames: The number of consecutive frames a response must
+            stay above the onset threshold.
+        rename_files: Whether to rename the .txt files on disk to the
+            _000.txt format.
+        low_memory: Whether to read the trials one at a time into per-odor
+            sums instead of keeping them all in memory.
+        save_raw_means: Whether to save the _raw_means files.
+        precision: The dtype of the trial data in memory, "float64" or
+            "float32".
+        precision_report: Whether to save a report of the largest
+            differences from full precision.
+        analysis_config: The frame windows and frame rate, the defaults if
+            None.
+        save_trial_metrics: Whether to analyze every trial and save the
+            _trial_metrics file.
+        significance_test: The settings of the resampling test against the
+            blank, or None to skip it.
+        analysis_workers: The number of processes analyzing blocks of
+            samples.
+
+    Returns:
+        A tuple containing the status of the session, "succeeded" or
+        "skipped", and a message describing the result.
+    """
+
+    session_index = SessionIndex(session_path)
+    session_info, message = check_session(session_index)
+    if session_info is None:
+        return "skipped", message
+
+    date, animal_id, roi = session_info
+    data = RawFolder(
+        session_path,
+        date,
+        animal_id,
+        roi,
+        sample_type,
+        drop_trials=False,
+        use_cache=use_cache,
+        sustained_frames=sustained_frames,
+        session_index=session_index,
+        low_memory=low_memory,
+        save_raw_means=save_raw_means,
+        precision=precision,
+        analysis_config=analysis_config,
+        save_trial_metrics=save_trial_metrics,
+        significance_test=significance_test,
+        analysis_workers=analysis_workers,
+    )
+
+    data.get_solenoid_order()
+    data.map_trial_files()
+    if rename_files:
+        data.rename_txt()
+    file_paths = data.get_txt_file_paths()
+    if low_memory:
+        data.stream_trial_files(file_paths)
+    else:
+        trial_cube = data.load_trial_cube(file_paths)
+        data.organize_all_data_df(trial_cube)
+
+    data.group_trials()
+    data.analyze_all_samples()
+
+    with data.open_workbooks():
+        for n_count in range(data.total_n):
+            data.process_txt_data(n_count, sample_type)
+    data.save_columnar_outputs()
+    data.save_last_run()
+    if precision_report:
+        data.make_precision_report()
+    data.remove_raw_cube()
+
+    return "succeeded", f"Analyzed {data.total_n} {sample_type} samples."
+
+
+def run_batch(
+    root_path: str,
+    sample_type: str,
+    n_workers: int = 1,
+    use_cache: bool = True,
+    sustained_frames: int = 1,
+    rename_files: bool = False,
+    low_memory: bool = False,
+    save_raw_means: bool = True,
+    precision: str = "float64",
+    precision_report: bool = False,
+    analysis_config: AnalysisConfig = None,
+    save_trial_metrics: bool = False,
+    significance_test: SignificanceTest = None,
+    analysis_workers: int = 1,
+) -> pd.DataFrame:
+    """Analyzes all imaging sessions under a root folder across a process
+    pool and saves a summary of the results.
+
+    Args:
+        root_path: Path to the folder containing the session folders.
+        sample_type: The sample type, e.g. "Cell", "Glomerulus", or "Grid".
+        n_workers: The number of sessions to analyze at the same time.
+        use_cache: Whether to reuse cached trial data.
+        sustained_frames: The number of consecutive frames a response must
+            stay above the onset threshold.
+        rename_files: Whether to rename the .txt files on disk to the
+            _000.txt format.
+        low_memory: Whether to read the trials one at a time into per-odor
+            sums instead of keeping them all in memory.
+        save_raw_means: Whether to save the _raw_means files.
+        precision: The dtype of the trial data in memory, "float64" or
+            "float32".
+        precision_report: Whether to save a report of the largest
+            differences from full precision for each session.
+        analysis_config: The frame windows and frame rate, the defaults if
+            None.
+        save_trial_metrics: Whether to analyze every trial and save the
+            _trial_metrics file for each session.
+        significance_test: The settings of the resampling test against the
+            blank, or None to skip it.
+        analysis_workers: The number of processes analyzing blocks of
+            samples in each session.
+
+    Returns:
+        A DataFrame with the Session, Status and Message of every session
+        folder found.
+    """
+
+    summary = []
+    futures = {}
+
+    with ProcessPoolExecutor(
+        max_workers=n_workers, initializer=hide_streamlit_warning
+    ) as executor:
+        for session_path in find_session_folders(root_path):
+            future = executor.submit(
+                analyze_session,
+                session_path,
+                sample_type,
+                use_cache,
+                sustained_frames,
+                rename_files,
+                low_memory,
+                save_raw_means,
+                precision,
+                precision_report,
+                analysis_config,
+                save_trial_metrics,
+                significance_test,
+                analysis_workers,
+            )
+            futures[future] = session_path.name
+
+        for future in as_completed(futures):
+            session = futures[future]
+            try:
+                status, message = future.result()
+            except Exception as error_msg:
+                status, message = "failed", str(error_msg)
+
+            summary.append([session, status, message])
+            print(f"{session} {status}: {message}")
+
+    summary_df = pd.DataFrame(
+        summary, columns=["Session", "Status", "Message"]
+    )
+    summary_df.sort_values(by=["Session"], inplace=True)
+    save_to_csv("batch_summary.csv", root_path, summary_df)
+
+    return summary_df
+
+
+def add_window_arguments(parser: argparse.ArgumentParser):
+    """Adds the options for the frame windows and frame rate of the
+    analysis to a command-line parser.
+
+    Args:
+        parser: The parser to add the options to.
+    """
+
+    defaults = AnalysisConfig()
+    parser.add_argument(
+        "--baseline-frames",
+        type=int,
+        nargs=2,
+        default=defaults.baseline_frames,
+        metavar=("FIRST", "LAST"),
+        help="First and last baseline frames, counting from 1.",
+    )
+    parser.add_argument(
+        "--peak-frames",
+        type=int,
+        nargs=2,
+        default=defaults.peak_frames,
+        metavar=("FIRST", "LAST"),
+        help="First and last frames searched for the peak.",
+    )
+    parser.add_argument(
+        "--auc-frames",
+        type=int,
+        nargs=2,
+        default=defaults.auc_frames,
+        metavar=("FIRST", "LAST"),
+        help="First and last frames of the area under curve.",
+    )
+    parser.add_argument(
+        "--odor-onset-frame",
+        type=int,
+        default=defaults.odor_onset_frame,
+    )
+    parser.add_argument(
+        "--frame-period",
+        type=float,
+        default=defaults.frame_period,
+        help="Time between frames in seconds.",
+    )
+
+
+def get_analysis_config(args: argparse.Namespace) -> AnalysisConfig:
+    """Makes the analysis settings from the command-line options.
+
+    Args:
+        args: The parsed options, including those from
+            add_window_arguments().
+
+    Returns:
+        The frame windows and frame rate of the analysis.
+    """
+
+    return AnalysisConfig(
+        baseline_frames=args.baseline_frames,
+        peak_frames=args.peak_frames,
+        auc_frames=args.auc_frames,
+        odor_onset_frame=args.odor_onset_frame,
+        frame_period=args.frame_period,
+    )
+
+
+def add_test_arguments(parser: argparse.ArgumentParser):
+    """Adds the options for the resampling test against the blank to a
+    command-line parser.
+
+    Args:
+        parser: The parser to add the options to.
+    """
+
+    defaults = SignificanceTest()
+    parser.add_argument(
+        "--significance-test",
+        choices=["permutation", "bootstrap"],
+        help="Test each odor's trial DeltaF values against the blank's and "
+        "add p-values and FDR q-values to the _analysis files.",
+    )
+    parser.add_argument(
+        "--resamples",
+        type=int,
+        default=defaults.n_resamples,
+        help="Number of permutations or bootstrap resamples.",
+    )
+    parser.add_argument(
+        "--fdr-alpha",
+        type=float,
+        default=defaults.alpha,
+        help="False discovery rate at which a response is significant.",
+    )
+    parser.add_argument(
+        "--test-workers",
+        type=int,
+        default=defaults.n_workers,
+        help="Number of processes drawing resamples for each session.",
+    )
+
+
+def get_significance_test(args: argparse.Namespace) -> SignificanceTest:
+    """Makes the resampling test settings from the command-line options.
+
+    Args:
+        args: The parsed options, including those from
+            add_test_arguments().
+
+    Returns:
+        The test settings, or None if no test was chosen.
+    """
+
+    if args.significance_test is None:
+        return None
+
+    return SignificanceTest(
+        method=args.significance_test,
+        n_resamples=args.resamples,
+        alpha=args.fdr_alpha,
+        n_workers=args.test_workers,
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Analyze the .txt files of every imaging session under "
+        "a root folder."
+    )
+    parser.add_argument(
+        "root_path", help="Folder containing the YYMMDD--123456-7-8_ROIX "
+        "session folders."
+    )
+    parser.add_argument(
+        "--sample-type",
+        choices=["Cell", "Glomerulus", "Grid"],
+        default="Cell",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=os.cpu_count() or 1,
+        help="Number of sessions to analyze at the same time.",
+    )
+    parser.add_argument(
+        "--sustained-frames",
+        type=int,
+        default=1,
+        help="Number of consecutive frames a response must stay above 5%% of "
+        "DeltaF to count as response onset.",
+    )
+    parser.add_argument(
+        "--rename-files",
+        action="store_true",
+        help="Rename the .txt files to the ..._000.txt, ..._001.txt etc. "
+        "format.",
+    )
+    parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="Don't reuse or save cached trial data.",
+    )
+    parser.add_argument(
+        "--low-memory",
+        action="store_true",
+        help="Read one trial at a time into per-odor sums, for very wide "
+        "Grid sessions. The cache isn't used.",
+    )
+    parser.add_argument(
+        "--no-raw-means",
+        action="store_true",
+        help="Don't save the _raw_means files.",
+    )
+    parser.add_argument(
+        "--precision",
+        choices=["float64", "float32"],
+        default="float64",
+        help="Keep trial data in memory as float64, or float32 for half the "
+        "memory.",
+    )
+    parser.add_argument(
+        "--precision-report",
+        action="store_true",
+        help="Save a _precision_report.csv of the largest differences from "
+        "float64 for each session.",
+    )
+    parser.add_argument(
+        "--trial-metrics",
+        action="store_true",
+        help="Analyze every trial and save a _trial_metrics.parquet file.",
+    )
+    parser.add_argument(
+        "--analysis-workers",
+        type=int,
+        default=1,
+        help="Number of processes analyzing blocks of samples in each "
+        "session, for very wide Grid sessions.",
+    )
+    add_window_arguments(parser)
+    add_test_arguments(parser)
+    args = parser.parse_args()
+    hide_streamlit_warning()
+
+    start = datetime.now()
+    summary_df = run_batch(
+        args.root_path,
+        args.sample_type,
+        n_workers=args.workers,
+        use_cache=not args.no_cache,
+        sustained_frames=args.sustained_frames,
+        rename_files=args.rename_files,
+        low_memory=args.low_memory,
+        save_raw_means=not args.no_raw_means,
+        precision=args.precision,
+        precision_report=args.precision_report,
+        analysis_config=get_analysis_config(args),
+        save_trial_metrics=args.trial_metrics,
+        significance_test=get_significance_test(args),
+        analysis_workers=args.analysis_workers,
+    )
+
+    counts = summary_df["Status"].value_counts()
+    print(
+        f"{counts.get('succeeded', 0)} succeeded, "
+        f"{counts.get('failed', 0)} failed, "
+        f"{counts.get('skipped', 0)} skipped in {datetime.now() - start}. "
+        f"Summary saved to {Path(args.root_path, 'batch_summary.csv')}"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -1,4 +1,5 @@
-"""Contains classes for loading either .txt files or .xlsx summary files."""
+"""Contains classes for loading either .txt files or .xlsx/.parquet summary
+files."""
 
 import pandas as pd
 import streamlit as st
@@ -6,9 +7,44 @@ from pathlib import Path
 import re
 import os
 import numpy as np
+import json
+from contextlib import contextmanager
+from itertools import chain
 import pdb
 
-from src.utils import read_txt_file, save_to_excel, save_to_csv
+from src.analysis import (
+    AnalysisConfig,
+    analyze_responses,
+    analyze_sample_blocks,
+    analyze_trials,
+    update_responses,
+    ANALYSIS_DTYPE,
+    ANALYSIS_LABELS,
+    TRIAL_DTYPE,
+    SIG_ONLY_FIELDS,
+    TRIAL_LABELS,
+)
+from src.session import SessionIndex
+from src.significance import (
+    SignificanceTest,
+    TEST_LABELS,
+    test_against_blank,
+    update_tests,
+)
+from src.trials import OdorGroups, RunningOdorMeans
+from src.utils import (
+    read_txt_files,
+    read_txt_files_in_order,
+    get_max_differences,
+    ExcelSheetWriter,
+    save_to_csv,
+    save_to_parquet,
+    save_blocks_to_parquet,
+    find_parquet_file,
+)
+
+# Bump when the layout of the cached trial data changes
+CACHE_VERSION = 2
 
 
 class RawFolder(object):
@@ -29,12 +65,74 @@ class RawFolder(object):
             experiment.
         solenoid_df (pd.DataFrame): The solenoid order, with Trial and Odor as
             columns.
-        total_n (int): The total number of trials in the experiment.
+        solenoid_path (Path): The path to the solenoid order file.
+        trial_numbers (dict): The trial # of each .txt file, starting from 0,
+            with file names as keys.
+        trial_files (list): The name of the .txt file of each trial, in
+            trial order.
+        trial_frames (list): The number of frames in each trial.
+        fingerprints (dict): The fingerprints of the trial .txt files and
+            solenoid file, if the session cache is used.
+        total_n (int): The total number of samples in the experiment.
         n_column_labels (list): The sheet names for exported .xlsx.
-        all_data_df (pd.DataFrame): The df holding the collected fluorescence
-            values from every frame for every trial and odor for all .txt files.
+        trial_cube (np.ndarray): The collected fluorescence values from all
+            .txt files, with shape (trials, frames, samples). In low-memory
+            mode, a memory-mapped file with the trials sorted by odor, or
+            None if raw means aren't saved.
+        trial_ids (np.ndarray): The trial # of each row in trial_cube.
+        odor_ids (np.ndarray): The odor # of each row in trial_cube.
+        all_trial_cube (np.ndarray): The fluorescence values of all loaded
+            trials, including dropped ones, so trials can be dropped or
+            restored without reading the .txt files again. None in
+            low-memory mode.
+        all_trial_ids (np.ndarray): The trial # of each row in
+            all_trial_cube.
+        all_odor_ids (np.ndarray): The odor # of each row in
+            all_trial_cube.
+        running_means (RunningOdorMeans): The per-odor sums of the trials
+            read in low-memory mode.
+        trial_groups (OdorGroups): The trials of trial_cube grouped by odor.
+        avg_cube (np.ndarray): The mean of mean fluorescence values for each
+            odor, with shape (samples, odors, frames).
+        analysis_results (np.ndarray): The analysis values for each sample
+            and odor, a structured array with shape (samples, odors).
+        last_run (dict): The inputs, avg_cube and analysis_results of the
+            last analysis of the session, if saved.
+        changed_odors (np.ndarray): The odors whose trials changed since the
+            last run, or None if all odors are analyzed again.
+        workbooks (dict): The open _raw_means, _avg_means and _analysis
+            .xlsx files, while saving.
         session_path (str): The path to the selected folder.
         drop_trials_list (list): Trials to drop, if selected.
+        n_workers (int): The number of .txt files to parse at the same time.
+        pool_type (str): "thread" or "process" pool for parsing .txt files.
+        use_cache (bool): Whether to read and write the session cache.
+        sustained_frames (int): The number of consecutive frames a response
+            must stay above the onset threshold.
+        session_index (SessionIndex): The trial, solenoid and output files in
+            the folder.
+        low_memory (bool): Whether to read the trials one at a time into
+            per-odor sums instead of keeping them all in memory.
+        save_raw_means (bool): Whether to save the _raw_means files.
+        precision (str): The dtype of the trial data in memory, "float64",
+            or "float32" for half the memory.
+        precision_report (pd.DataFrame): The largest differences between
+            this run's values and full precision values, if made.
+        analysis_config (AnalysisConfig): The frame windows and frame rate
+            used to analyze responses.
+        save_trial_metrics (bool): Whether to analyze every trial and save
+            the _trial_metrics file.
+        trial_results (np.ndarray): The analysis values for each trial and
+            sample, a structured array with shape (trials, samples) and
+            trials in the order of trial_groups, if analyzed.
+        significance_test (SignificanceTest): The settings of the
+            resampling test of each odor's trials against the blank's, or
+            None to skip the test.
+        test_results (np.ndarray): The p-values, q-values and significance
+            of the resampling test for each sample and odor, a structured
+            array with shape (samples, odors), if tested.
+        analysis_workers (int): The number of processes analyzing blocks of
+            samples at the same time.
 
     """
 
@@ -46,6 +144,18 @@ class RawFolder(object):
         ROI_id: str,
         sample_type: str,
         drop_trials: bool,
+        n_workers: int = 1,
+        pool_type: str = "thread",
+        use_cache: bool = True,
+        sustained_frames: int = 1,
+        session_index: SessionIndex = None,
+        low_memory: bool = False,
+        save_raw_means: bool = True,
+        precision: str = "float64",
+        analysis_config: AnalysisConfig = None,
+        save_trial_metrics: bool = False,
+        significance_test: SignificanceTest = None,
+        analysis_workers: int = 1,
     ):
         """Initializes an instance of RawFolder() for the selected folder.
 
@@ -56,6 +166,27 @@ class RawFolder(object):
             ROI: Region of Interest.
             sample_type: Type of sample being analysed.
             drop_trial: Whether to drop trials.
+            n_workers: The number of .txt files to parse at the same time.
+            pool_type: "thread" or "process" pool for parsing .txt files.
+            use_cache: Whether to read and write the session cache.
+            sustained_frames: The number of consecutive frames a response
+                must stay above the onset threshold.
+            session_index: The files in the folder, if already listed.
+            low_memory: Whether to read the trials one at a time into
+                per-odor sums instead of keeping them all in memory. The
+                session cache isn't used in low-memory mode.
+            save_raw_means: Whether to save the _raw_means files.
+            precision: The dtype of the trial data in memory, "float64",
+                or "float32" for half the memory. Averages and analysis
+                values are always calculated in float64.
+            analysis_config: The frame windows and frame rate used to
+                analyze responses, the defaults if None.
+            save_trial_metrics: Whether to analyze every trial and save
+                the _trial_metrics file.
+            significance_test: The settings of the resampling test of each
+                odor's trials against the blank's, or None to skip it.
+            analysis_workers: The number of processes analyzing blocks of
+                samples at the same time, for very wide sessions.
         """
         self.date = date
         self.animal_id = animal_id
@@ -64,14 +195,56 @@ class RawFolder(object):
         self.sample_type = sample_type
         self.solenoid_order = []
         self.solenoid_df = None
+        self.solenoid_path = None
+        self.trial_numbers = None
+        self.trial_files = None
+        self.trial_frames = None
+        self.fingerprints = None
         self.total_n = None
         self.n_column_labels = None
-        self.all_data_df = None
+        self.trial_cube = None
+        self.trial_ids = None
+        self.odor_ids = None
+        self.all_trial_cube = None
+        self.all_trial_ids = None
+        self.all_odor_ids = None
+        self.running_means = None
+        self.trial_groups = None
+        self.avg_cube = None
+        self.analysis_results = None
+        self.last_run = None
+        self.changed_odors = None
+        self.workbooks = None
+        self.precision_report = None
+        self.trial_results = None
+        self.test_results = None
 
         # Sets path to folder holding all the txt files for analysis.
         self.session_path = folder_path
+        if session_index is None:
+            session_index = SessionIndex(folder_path)
+        self.session_index = session_index
+
+        self.n_workers = n_workers
+        self.pool_type = pool_type
+        self.use_cache = use_cache
+        self.sustained_frames = sustained_frames
+        self.low_memory = low_memory
+        self.save_raw_means = save_raw_means
+
+        if precision not in ["float64", "float32"]:
+            raise ValueError(f"Unknown precision {precision}")
+        self.precision = precision
+
+        if analysis_config is None:
+            analysis_config = AnalysisConfig()
+        self.analysis_config = analysis_config
+        self.save_trial_metrics = save_trial_metrics
+        self.significance_test = significance_test
+        self.analysis_workers = analysis_workers
 
         # determines whether trials need to be dropped
+        self.drop_trials_list = []
         if drop_trials:
             temp_drops = drop_trials.split(",")
             self.drop_trials_list = [int(x) for x in temp_drops]
@@ -79,66 +252,50 @@ class RawFolder(object):
     def get_solenoid_order(self):
         """Reads .csv or .txt solenoid file to get solenoid order."""
 
-        for filename in os.listdir(self.session_path):
-            solenoid_path = Path(self.session_path, filename)
-
-            # This ignores temp files if csv file is open in Excel
-            if ".~lock" not in filename and "._" not in filename:
-                # For new delivery code with solenoid_order.csv file
-                if "solenoid_order" in filename:
-                    solenoid_data = pd.read_csv(solenoid_path)
-                    self.solenoid_df = solenoid_data
-
-                    temp_solenoid_df = solenoid_data.copy()
-                    temp_solenoid_df.sort_values(by=["Trial"], inplace=True)
-                    self.solenoid_order = temp_solenoid_df.iloc[:, 0].tolist()
-
-                # For Beichen's old code with solenoid_info.txt file
-                elif "solenoid_info.txt" in filename:
-                    with open(solenoid_path) as f:
-                        solenoid_data = f.readline()
-                        # removes non-numeric characters from solenoid order string
-                        solenoid_order_num = re.sub(
-                            "[^0-9]", "", solenoid_data
-                        )
-                        self.solenoid_order = [
-                            int(x) for x in solenoid_order_num
-                        ]
-
-                        # makes df of solenoid info for export as csv
-                        solenoid_info_df = pd.DataFrame(
-                            {"Odor": self.solenoid_order}
-                        )
-                        solenoid_info_df["Trial"] = range(
-                            1, len(solenoid_info_df) + 1
-                        )
-                        solenoid_info_df.sort_values(by=["Odor"], inplace=True)
-                        self.solenoid_df = solenoid_info_df
-
-    def rename_correct_format(
-        self, m: re.Match, filename: str, _ext: str, first: bool = False
-    ):
-        """Renames .txt files to the correct format.
+        # Temp files, e.g. if csv file is open in Excel, aren't in the list
+        for filename in self.session_index.solenoid_files:
+            solenoid_path = self.session_index.get_path(filename)
+
+            # For new delivery code with solenoid_order.csv file
+            if "solenoid_order" in filename:
+                solenoid_data = pd.read_csv(solenoid_path)
+                self.solenoid_df = solenoid_data
+                self.solenoid_path = solenoid_path
+
+                temp_solenoid_df = solenoid_data.copy()
+                temp_solenoid_df.sort_values(by=["Trial"], inplace=True)
+                self.solenoid_order = temp_solenoid_df.iloc[:, 0].tolist()
+
+            # For Beichen's old code with solenoid_info.txt file
+            elif "solenoid_info.txt" in filename:
+                self.solenoid_path = solenoid_path
+                with open(solenoid_path) as f:
+                    solenoid_data = f.readline()
+                    # removes non-numeric characters from solenoid order string
+                    solenoid_order_num = re.sub("[^0-9]", "", solenoid_data)
+                    self.solenoid_order = [int(x) for x in solenoid_order_num]
+
+                    # makes df of solenoid info for export as csv
+                    solenoid_info_df = pd.DataFrame(
+                        {"Odor": self.solenoid_order}
+                    )
+                    solenoid_info_df["Trial"] = range(
+                        1, len(solenoid_info_df) + 1
+                    )
+                    solenoid_info_df.sort_values(by=["Odor"], inplace=True)
+                    self.solenoid_df = solenoid_info_df
+
+    def get_canonical_name(self, trial_num: int) -> str:
+        """Gets the correctly formatted name of a trial .txt file.
 
         Args:
-            m: A regex match object for re-numbering .txt file names.
-            filename: The original file name.
-            _ext: The extension of the file.
-            first: Whether the file being renamed is the first trial.
-        """
+            trial_num: The trial # of the file, starting from 0.
 
-        if first:
-            file_number = str(0).zfill(3)
-        else:
-            file_number = m.group(1).zfill(3)
+        Returns:
+            The file name, ending in _000.txt for the first trial.
+        """
 
-        os.rename(
-            Path(self.session_path, filename),
-            Path(
-                self.session_path,
-                f"{self._exp_name}_{file_number}{_ext}",
-            ),
-        )
+        return f"{self._exp_name}_{str(trial_num).zfill(3)}.txt"
 
     @property
     def _exp_name(self):
@@ -150,138 +307,612 @@ class RawFolder(object):
         """str: The file name for exporting .csv file."""
         return f"{self.file_prefix}_solenoid_info.csv"
 
-    def rename_txt(self, status: st.status):
-        """Renames .txt files if needed.
+    @property
+    def _cache_dir(self):
+        """Path: The folder holding the cached trial data."""
+        return Path(self.session_path, ".roi_analysis_cache")
+
+    @property
+    def _cache_cube_path(self):
+        """Path: The .npy file holding the cached trial_cube."""
+        return Path(self._cache_dir, f"{self.file_prefix}_trial_cube.npy")
+
+    @property
+    def _cache_manifest_path(self):
+        """Path: The .json file describing the cached trial_cube."""
+        return Path(self._cache_dir, f"{self.file_prefix}_manifest.json")
+
+    @property
+    def _raw_cube_glob(self):
+        """str: The pattern matching the memory-mapped raw trial files."""
+        return f"{self.file_prefix}_raw_cube_*.npy"
+
+    @property
+    def _last_run_path(self):
+        """Path: The .json file describing the inputs of the last run."""
+        return Path(self._cache_dir, f"{self.file_prefix}_last_run.json")
+
+    @property
+    def _last_avg_cube_path(self):
+        """Path: The .npy file holding the avg_cube of the last run."""
+        return Path(self._cache_dir, f"{self.file_prefix}_last_avg_cube.npy")
+
+    @property
+    def _last_analysis_path(self):
+        """Path: The .npy file holding the analysis_results of the last run."""
+        return Path(self._cache_dir, f"{self.file_prefix}_last_analysis.npy")
+
+    @property
+    def _needs_trial_results(self):
+        """bool: Whether every trial is analyzed, for the trial metrics or
+        the resampling test."""
+        return self.save_trial_metrics or self.significance_test is not None
+
+    def map_trial_files(self, verbose: bool = True):
+        """Works out the trial # of each .txt file from its name, without
+        renaming the files.
+
+        The first trial file has no number at the end of its name, and the
+        others end in _001.txt, _002.txt, etc. Files already renamed to
+        _000.txt etc. are numbered the same way.
 
         Args:
-            status: st.status container to update progress message
+            verbose: Whether to say on the page if the file names are in the
+                correct format.
         """
 
-        # pulls out txt file names, excluding solenoid file
-        data_files = [
-            x
-            for x in os.listdir(self.session_path)
-            if "solenoid" not in x and ".txt" in x
-        ]
+        ends_with_number = re.compile(r"_(\d+)\.txt$")
+
+        self.trial_numbers = {}
+        files_by_number = {}
+        for filename in self.session_index.trial_files:
+            m = ends_with_number.search(filename)
+            trial_num = int(m.group(1)) if m else 0
 
-        # sorts the file names according to 000-001, etc
-        file_names = sorted(data_files, key=lambda x: x[-7:-4])
+            if trial_num in files_by_number:
+                raise Exception(
+                    f"{files_by_number[trial_num]} and {filename} are both "
+                    f"trial {str(trial_num).zfill(3)}"
+                )
+            files_by_number[trial_num] = filename
+            self.trial_numbers[filename] = trial_num
 
-        # check whether the first trial txt exists
-        if os.path.isfile(
-            Path(self.session_path, f"{self._exp_name}_000.txt")
+        if not verbose:
+            return
+
+        if all(
+            filename == self.get_canonical_name(trial_num)
+            for filename, trial_num in self.trial_numbers.items()
         ):
             st.write(".txt files are already in the correct format.")
-
         else:
-            st.write("Renaming .txt files to the correct format.")
-            # renames text files
-            _ext = ".txt"
-            endsWithNumber = re.compile(r"(\d+)" + (re.escape(_ext)) + "$")
-            for filename in file_names:
-                m = endsWithNumber.search(filename)
+            st.write(".txt files matched to trials, leaving file names as is.")
+
+    def rename_txt(self):
+        """Renames .txt files on disk to the _000.txt, _001.txt etc. format,
+        using the trial #s from map_trial_files().
+        """
 
-                if m:
-                    self.rename_correct_format(m, filename, _ext)
+        to_rename = {
+            filename: self.get_canonical_name(trial_num)
+            for filename, trial_num in self.trial_numbers.items()
+            if filename != self.get_canonical_name(trial_num)
+        }
 
-                # this renames the first trial text file and adds 000
-                else:
-                    self.rename_correct_format(m, filename, _ext, first=True)
-            st.write(".txt files renamed.")
+        if not to_rename:
+            return
+
+        st.write("Renaming .txt files to the correct format.")
+        for filename, new_name in to_rename.items():
+            new_path = self.session_index.get_path(new_name)
+            if os.path.exists(new_path):
+                raise Exception(f"Can't rename {filename}, {new_name} exists")
+            os.rename(self.session_index.get_path(filename), new_path)
+        st.write(".txt files renamed.")
+
+        # lists the folder again to pick up the new file names
+        self.session_index = SessionIndex(self.session_path)
+        self.trial_numbers = {
+            self.get_canonical_name(trial_num): trial_num
+            for trial_num in self.trial_numbers.values()
+        }
 
     def get_txt_file_paths(self) -> list:
         """Creates list of paths for all text files, excluding solenoid info.
 
         Returns:
-            A list of all the .txt files.
+            A list of all the .txt files, sorted by trial #.
         """
 
+        if self.trial_numbers is None:
+            self.map_trial_files()
+
+        file_names = sorted(self.trial_numbers, key=self.trial_numbers.get)
         paths_list = [
-            str(path)
-            for path in Path(self.session_path).rglob("*.txt")
-            if "solenoid" not in path.stem
+            str(self.session_index.get_path(filename))
+            for filename in file_names
         ]
 
         return paths_list
 
-    def iterate_txt_files(self, txt_paths: str) -> pd.DataFrame:
-        """Collects all .txt files data into one dataframe.
+    def get_fingerprints(self, txt_paths: list) -> dict:
+        """Gets the fingerprints of the trial .txt files and solenoid file.
+
+        Args:
+            txt_paths: The paths to all the .txt files in the directory.
+
+        Returns:
+            A dict with "trials" and "solenoid" as keys, holding dicts of file
+            name to [size, mtime] fingerprints.
+        """
+
+        index = self.session_index
+        trial_names = sorted(Path(path).name for path in txt_paths)
+        solenoid_names = []
+        if self.solenoid_path:
+            solenoid_names.append(Path(self.solenoid_path).name)
+
+        fingerprints = {
+            "trials": {x: index.get_fingerprint(x) for x in trial_names},
+            "solenoid": {x: index.get_fingerprint(x) for x in solenoid_names},
+        }
+
+        return fingerprints
+
+    def load_trial_cube(self, txt_paths: list) -> np.ndarray:
+        """Loads all .txt files data from the session cache, or parses the
+        .txt files and updates the cache if it is missing or out of date.
+
+        When only some .txt files are new or have changed since the cache was
+        saved, only those files are parsed.
+
+        Args:
+            txt_paths: The paths to all the .txt files in the directory.
+
+        Returns:
+            trial_cube: An array holding fluorescence values from all
+                frames and trials for each sample, with shape
+                (trials, frames, samples).
+        """
+
+        if not self.use_cache:
+            return self.iterate_txt_files(txt_paths)
+
+        fingerprints = self.get_fingerprints(txt_paths)
+        self.fingerprints = fingerprints
+
+        cached_trials, trial_cube = self.read_session_cache(fingerprints)
+        if trial_cube is not None:
+            st.write("Loaded trial data from cache.")
+            return trial_cube
+
+        if cached_trials:
+            st.write(
+                f"Loaded {len(cached_trials)} unchanged trials from cache, "
+                f"reading {len(txt_paths) - len(cached_trials)} .txt files."
+            )
+        trial_cube = self.iterate_txt_files(txt_paths, cached_trials)
+        self.write_session_cache(trial_cube, fingerprints)
+
+        return trial_cube
+
+    def read_session_cache(
+        self, fingerprints: dict
+    ) -> tuple[dict, np.ndarray | None]:
+        """Memory-maps the cached trial_cube and finds the trials in it that
+        match the current files.
+
+        Args:
+            fingerprints: The fingerprints of the current trial .txt files and
+                solenoid file.
+
+        Returns:
+            A tuple containing the cached values of each unchanged .txt file,
+            with file names as keys, and the whole cached trial_cube as a
+            read-only memory map if none of the files have changed, else
+            None.
+        """
+
+        try:
+            with open(self._cache_manifest_path) as f:
+                manifest = json.load(f)
+            if manifest.get("version") != CACHE_VERSION:
+                return {}, None
+            trial_cube = np.load(self._cache_cube_path, mmap_mode="r")
+            if trial_cube.dtype != self.precision:
+                return {}, None
+            cached_fingerprints = manifest["fingerprints"]
+
+            if cached_fingerprints == fingerprints:
+                self.solenoid_order = manifest["solenoid_order"]
+                self.trial_files = manifest["trial_files"]
+                self.trial_frames = manifest["trial_frames"]
+                self.trial_ids = np.array(
+                    manifest["trial_ids"], dtype=np.int16
+                )
+                self.odor_ids = np.array(manifest["odor_ids"], dtype=np.int16)
+
+                return {}, trial_cube
+
+            # a different solenoid order changes every trial's odor
+            if cached_fingerprints["solenoid"] != fingerprints["solenoid"]:
+                return {}, None
+
+            cached_trials = {
+                filename: trial_cube[trial_num, :n_frames]
+                for trial_num, (filename, n_frames) in enumerate(
+                    zip(manifest["trial_files"], manifest["trial_frames"])
+                )
+                if fingerprints["trials"].get(filename)
+                == cached_fingerprints["trials"][filename]
+            }
+        except (OSError, ValueError, KeyError):
+            return {}, None
+
+        return cached_trials, None
+
+    def write_session_cache(self, trial_cube: np.ndarray, fingerprints: dict):
+        """Saves trial_cube and its fingerprints to the session cache.
+
+        The manifest is written last, so an interrupted write leaves the
+        cache invalid rather than wrong. Sessions in read-only folders are
+        simply not cached.
+
+        Args:
+            trial_cube: The array holding all trials.
+            fingerprints: The fingerprints of the trial .txt files and
+                solenoid file used to build trial_cube.
+        """
+
+        manifest = {
+            "version": CACHE_VERSION,
+            "fingerprints": fingerprints,
+            "solenoid_order": [int(x) for x in self.solenoid_order],
+            "trial_files": self.trial_files,
+            "trial_frames": self.trial_frames,
+            "trial_ids": self.trial_ids.tolist(),
+            "odor_ids": self.odor_ids.tolist(),
+        }
+
+        try:
+            self._cache_dir.mkdir(exist_ok=True)
+            self._cache_manifest_path.unlink(missing_ok=True)
+
+            temp_cube_path = self._cache_cube_path.with_suffix(".tmp.npy")
+            np.save(temp_cube_path, trial_cube)
+            os.replace(temp_cube_path, self._cache_cube_path)
+
+            temp_manifest_path = self._cache_manifest_path.with_suffix(".tmp")
+            with open(temp_manifest_path, "w") as f:
+                json.dump(manifest, f)
+            os.replace(temp_manifest_path, self._cache_manifest_path)
+        except OSError:
+            st.write("Could not write session cache, continuing without it.")
+
+    def iterate_txt_files(
+        self, txt_paths: str, cached_trials: dict = None
+    ) -> np.ndarray:
+        """Collects all .txt files data into one preallocated array.
+
+        The trial # and odor # of each row in the array are stored in
+        trial_ids and odor_ids.
 
         Args:
             txt_paths: The paths to all the .txt files in the directory.
+            cached_trials: The cached values of unchanged .txt files, with
+                file names as keys. These files aren't parsed again.
 
         Returns:
-            all_data_df: A DataFrame holding fluorescence values from all
-                frames and trials for each odor, from all .txt files.
+            trial_cube: An array holding fluorescence values from all
+                frames and trials for each sample, from all .txt files, with
+                shape (trials, frames, samples).
         """
 
         if not txt_paths:
             raise Exception("No .txt files in directory")
 
-        # sorts the paths according to 000-001, etc
-        paths = sorted(txt_paths, key=lambda x: int(x[-7:-4]))
+        # sorts the paths by trial #
+        paths = sorted(
+            txt_paths, key=lambda x: self.trial_numbers[Path(x).name]
+        )
+
+        if len(paths) > len(self.solenoid_order):
+            raise Exception(
+                f"{len(paths)} .txt files found but solenoid order only has "
+                f"{len(self.solenoid_order)} trials"
+            )
 
-        # makes one big df containing all txt data from all trials
-        all_data_df = pd.DataFrame()
+        self.trial_files = [Path(x).name for x in paths]
+        self.trial_frames = [0] * len(paths)
 
-        for trial_num, path in enumerate(paths):
-            df = read_txt_file(path)
-            odor_num = self.solenoid_order[trial_num]
+        # only files without cached values are parsed
+        cached_trials = cached_trials or {}
+        cached = (
+            (trial_num, cached_trials[filename])
+            for trial_num, filename in enumerate(self.trial_files)
+            if filename in cached_trials
+        )
+        read_nums = [
+            trial_num
+            for trial_num, filename in enumerate(self.trial_files)
+            if filename not in cached_trials
+        ]
+        parsed = (
+            (read_nums[read_ct], values)
+            for read_ct, values in read_txt_files(
+                [paths[x] for x in read_nums], self.n_workers, self.pool_type
+            )
+        )
 
-            # add columns for trial # and odor #
-            df["Frame"] = list(range(1, len(df) + 1))
-            df["Trial"] = trial_num + 1
-            df["Odor"] = odor_num
+        # array is allocated once the first file gives the frame and sample
+        # counts
+        trial_cube = None
 
-            # reorder columns
-            cols_to_move = ["Frame", "Trial", "Odor"]
-            df = df[
-                cols_to_move
-                + [col for col in df.columns if col not in cols_to_move]
-            ]
+        # files may finish parsing out of order, so each one is placed by its
+        # sorted position
+        for trial_num, values in chain(cached, parsed):
+            if trial_cube is None:
+                trial_cube = np.full(
+                    (len(paths), *values.shape), np.nan, dtype=self.precision
+                )
+
+            trial_cube = self.insert_trial(
+                trial_cube, trial_num, values, paths[trial_num]
+            )
+            self.trial_frames[trial_num] = values.shape[0]
+
+        self.trial_ids = np.arange(1, len(paths) + 1, dtype=np.int16)
+        self.odor_ids = np.array(
+            self.solenoid_order[: len(paths)], dtype=np.int16
+        )
+
+        return trial_cube
+
+    def insert_trial(
+        self, trial_cube: np.ndarray, trial_num: int, values: np.ndarray, path
+    ) -> np.ndarray:
+        """Places the values from one .txt file into the trial array.
+
+        Trials with fewer frames than the others are padded with NaN, and the
+        array is grown if a trial has more frames than previous ones.
+
+        Args:
+            trial_cube: The array holding all trials.
+            trial_num: The position of the trial in the array.
+            values: The fluorescence values from one .txt file, with shape
+                (frames, samples).
+            path: The path to the .txt file, for error messages.
+
+        Returns:
+            The array holding all trials, with the new trial added.
+        """
+
+        if values.shape[1] != trial_cube.shape[2]:
+            raise Exception(
+                f"{Path(path).name} has {values.shape[1]} samples, expected "
+                f"{trial_cube.shape[2]}"
+            )
+
+        if values.shape[0] > trial_cube.shape[1]:
+            extra_frames = values.shape[0] - trial_cube.shape[1]
+            trial_cube = np.pad(
+                trial_cube,
+                ((0, 0), (0, extra_frames), (0, 0)),
+                constant_values=np.nan,
+            )
+
+        trial_cube[trial_num, : values.shape[0]] = values
+
+        return trial_cube
+
+    def stream_trial_files(self, txt_paths: list):
+        """Reads the .txt files one at a time into running per-odor sums, so
+        peak memory grows with samples x odors x frames instead of with the
+        number of trials.
+
+        Dropped trials are skipped. Trials are added to the sums in trial
+        order, which gives the same avg means as averaging the whole
+        trial_cube. If raw means are saved, the trials are also written to
+        a memory-mapped file in the cache folder, sorted by odor # then
+        trial #, and trial_cube views that file.
+
+        Args:
+            txt_paths: The paths to all the .txt files in the directory.
+        """
+
+        if not txt_paths:
+            raise Exception("No .txt files in directory")
+
+        # sorts the paths by trial #
+        paths = sorted(
+            txt_paths, key=lambda x: self.trial_numbers[Path(x).name]
+        )
+
+        if len(paths) > len(self.solenoid_order):
+            raise Exception(
+                f"{len(paths)} .txt files found but solenoid order only has "
+                f"{len(self.solenoid_order)} trials"
+            )
+
+        self.trial_files = [Path(x).name for x in paths]
+        self.trial_frames = [0] * len(paths)
+
+        trial_ids = np.arange(1, len(paths) + 1, dtype=np.int16)
+        odor_ids = np.array(self.solenoid_order[: len(paths)], dtype=np.int16)
+        keep = ~np.isin(trial_ids, self.drop_trials_list)
+        if not keep.any():
+            raise Exception("All trials are dropped")
+        self.trial_ids = trial_ids[keep]
+        self.odor_ids = odor_ids[keep]
+        kept_paths = [paths[x] for x in np.flatnonzero(keep)]
+
+        # the row of each trial in the raw trials file, sorted by odor
+        order = np.lexsort((self.trial_ids, self.odor_ids))
+        sorted_rows = np.empty_like(order)
+        sorted_rows[order] = np.arange(len(order))
+
+        self.remove_raw_cube()
+        self.trial_cube = None
+        self.running_means = None
+        self.trial_results = None
+
+        for read_ct, values in read_txt_files_in_order(
+            kept_paths, self.n_workers, self.pool_type
+        ):
+            self.add_streamed_trial(
+                values,
+                self.odor_ids[read_ct],
+                sorted_rows[read_ct],
+                kept_paths[read_ct],
+            )
+            trial_num = self.trial_ids[read_ct] - 1
+            self.trial_frames[trial_num] = values.shape[0]
+
+        self.total_n = self.running_means.sums.shape[2]
+        self.n_column_labels = [
+            f"{self.sample_type} {i}" for i in range(1, self.total_n + 1)
+        ]
+
+    def add_streamed_trial(
+        self, values: np.ndarray, odor: int, sorted_row: int, path
+    ):
+        """Adds one trial to the running per-odor sums, and to the raw
+        trials file if raw means are saved.
+
+        Args:
+            values: The fluorescence values from one .txt file, with shape
+                (frames, samples).
+            odor: The odor # delivered in the trial.
+            sorted_row: The row of the trial in the raw trials file.
+            path: The path to the .txt file, for error messages.
+        """
+
+        if self.running_means is None:
+            self.running_means = RunningOdorMeans(
+                np.unique(self.odor_ids), *values.shape
+            )
+            if self.save_raw_means:
+                self.trial_cube = self.open_raw_cube(
+                    len(self.odor_ids), *values.shape
+                )
+            if self._needs_trial_results:
+                self.trial_results = np.empty(
+                    (len(self.odor_ids), values.shape[1]), dtype=TRIAL_DTYPE
+                )
+
+        # rounds the values the same way as a compact trial_cube
+        values = values.astype(self.precision, copy=False)
+        self.running_means.add_trial(odor, values, Path(path).name)
+
+        if self.trial_results is not None:
+            self.trial_results[sorted_row] = analyze_trials(
+                values[np.newaxis],
+                self.sustained_frames,
+                self.analysis_config,
+            )[0]
+
+        if self.trial_cube is not None:
+            if values.shape[0] > self.trial_cube.shape[1]:
+                self.grow_raw_cube(values.shape[0])
+            self.trial_cube[sorted_row, : values.shape[0]] = values
+
+    def open_raw_cube(
+        self, n_trials: int, n_frames: int, n_samples: int
+    ) -> np.memmap:
+        """Creates a memory-mapped .npy file in the cache folder for the raw
+        trials, filled with NaN.
+
+        Args:
+            n_trials: The number of trials.
+            n_frames: The number of frames in a trial.
+            n_samples: The number of samples.
+
+        Returns:
+            The memory-mapped array, with shape (trials, frames, samples).
+        """
+
+        self._cache_dir.mkdir(exist_ok=True)
+        raw_cube_path = Path(
+            self._cache_dir, self._raw_cube_glob.replace("*", str(n_frames))
+        )
+        raw_cube = np.lib.format.open_memmap(
+            raw_cube_path,
+            mode="w+",
+            dtype=self.precision,
+            shape=(n_trials, n_frames, n_samples),
+        )
+        raw_cube[:] = np.nan
+
+        return raw_cube
+
+    def grow_raw_cube(self, n_frames: int):
+        """Moves the raw trials to a larger memory-mapped file when a trial
+        has more frames than the earlier ones.
+
+        Args:
+            n_frames: The new number of frames.
+        """
+
+        old_cube = self.trial_cube
+        n_trials, old_frames, n_samples = old_cube.shape
+        self.trial_cube = self.open_raw_cube(n_trials, n_frames, n_samples)
+        for row in range(n_trials):
+            self.trial_cube[row, :old_frames] = old_cube[row]
+
+        old_path = Path(old_cube.filename)
+        del old_cube
+        old_path.unlink(missing_ok=True)
 
-            all_data_df = pd.concat([all_data_df, df], axis=0)
+    def remove_raw_cube(self):
+        """Deletes the memory-mapped raw trial files made in low-memory mode,
+        once the raw means have been saved."""
 
-        return all_data_df
+        if self.low_memory and isinstance(self.trial_cube, np.memmap):
+            self.trial_cube = None
+            self.trial_groups = None
 
-    def organize_all_data_df(self, all_data_df: pd.DataFrame):
-        """Formats the df containing raw data for all .txt files.
+        if not self._cache_dir.exists():
+            return
+
+        for raw_cube_path in self._cache_dir.glob(self._raw_cube_glob):
+            try:
+                raw_cube_path.unlink(missing_ok=True)
+            except OSError:
+                # e.g. still mapped on Windows, deleted by the next run
+                pass
+
+    def organize_all_data_df(self, trial_cube: np.ndarray):
+        """Stores the array containing raw data for all .txt files.
 
         Creates column names based on selected sample type.
 
         Args:
-            all_data_df: A DataFrame holding fluorescence values from all
-                frames and trials for each odor, from all .txt files.
+            trial_cube: An array holding fluorescence values from all
+                frames and trials for each sample, from all .txt files.
         """
 
-        # keep first three column names
-        old_cols = all_data_df.columns[:3].tolist()
-        mean_cols = len(all_data_df.columns) - 3
+        mean_cols = trial_cube.shape[2]
 
         # make new column names based on sample type
         new_cols = [f"{self.sample_type} {i}" for i in range(1, mean_cols + 1)]
 
-        all_data_df.columns = old_cols + new_cols
-
-        self.total_n = sum(
-            self.sample_type in col for col in all_data_df.columns
-        )
+        self.total_n = mean_cols
         self.n_column_labels = new_cols
 
-        self.all_data_df = all_data_df.copy()
+        self.trial_cube = trial_cube
+
+        # keeps dropped trials too, so they can be restored later
+        self.all_trial_cube = trial_cube
+        self.all_trial_ids = self.trial_ids
+        self.all_odor_ids = self.odor_ids
 
     def process_txt_data(self, n_count: int, sample_type: str) -> str:
-        """Performs and saves analyses on the raw data from .txt files.
+        """Saves the collected data and analyses for one sample.
 
-        Analysis will generate three .xlsx files:
-            _analysis.xlsx, containing experiment analysis values
-            _avg_means.xlsx, containing the avg fluorescence intensity values
-                for each odor
-            _raw_means.xlsx, containing the raw fluorescence intensity values
-                for all trials for each odor
+        Sheets are written to the .xlsx files opened by open_workbooks().
 
         Args:
-            n_count: The trial number currently being analyzed (for iterating)
+            n_count: The sample number currently being saved (for iterating)
             sample_type: The selected sample type.
 
         Returns:
@@ -289,415 +920,743 @@ class RawFolder(object):
 
         """
 
-        raw_means, avg_means = self.collect_per_sample(
-            self.all_data_df, self.n_column_labels[n_count]
-        )
+        raw_means, avg_means = self.collect_per_sample(n_count)
 
-        # performs analysis for each sample
-        analysis_df = self.analyze_signal(avg_means)
+        sample_test_results = None
+        if self.test_results is not None:
+            sample_test_results = self.test_results[n_count]
+        analysis_df = self.make_analysis_df(
+            self.analysis_results[n_count],
+            self.trial_groups.odors,
+            sample_test_results,
+        )
 
         # Saving to Excel
         sheet_name = self.n_column_labels[n_count]
 
-        # Save raw means to xlsx file
-        save_to_excel(
-            self.session_path,
-            self.n_column_labels[n_count],
-            f"{self.file_prefix}_raw_means.xlsx",
-            raw_means,
-        )
+        if self.save_raw_means:
+            self.workbooks["raw_means"].write_sheet(sheet_name, raw_means)
+        self.workbooks["avg_means"].write_sheet(sheet_name, avg_means)
+        self.workbooks["analysis"].write_sheet(sheet_name, analysis_df)
+
+        bar_txt = f"Analyzing {sample_type} {n_count+1}"
 
-        # save avg_means to xlxs file
-        avgmeans_fname = f"{self.file_prefix}_avg_means.xlsx"
-        save_to_excel(self.session_path, sheet_name, avgmeans_fname, avg_means)
+        return bar_txt
+
+    @contextmanager
+    def open_workbooks(self):
+        """Opens the .xlsx files for saving all samples in one pass.
 
-        # save analyses values to xlxs file
-        analysis_fname = f"{self.file_prefix}_analysis.xlsx"
-        save_to_excel(
-            self.session_path, sheet_name, analysis_fname, analysis_df
+        Analysis will generate three .xlsx files:
+            _analysis.xlsx, containing experiment analysis values
+            _avg_means.xlsx, containing the avg fluorescence intensity values
+                for each odor
+            _raw_means.xlsx, containing the raw fluorescence intensity values
+                for all trials for each odor
+
+        Each file is written from scratch and saved once when the with block
+        exits. The _raw_means.xlsx file is skipped if raw means aren't saved.
+        """
+
+        outputs = ["avg_means", "analysis"]
+        if self.save_raw_means:
+            outputs.insert(0, "raw_means")
+
+        self.workbooks = {
+            output: ExcelSheetWriter(
+                self.session_path, f"{self.file_prefix}_{output}.xlsx"
+            )
+            for output in outputs
+        }
+
+        try:
+            yield self.workbooks
+        finally:
+            for writer in self.workbooks.values():
+                writer.close()
+            self.workbooks = None
+
+    def save_columnar_outputs(self):
+        """Saves the raw means, avg means and analysis values of all samples
+        as .parquet files next to the .xlsx files.
+
+        The .parquet files keep the dtypes of the values and are much faster
+        to load than the .xlsx files:
+            _raw_means.parquet, with Odor, Trial and Frame columns and one
+                column of raw fluorescence values per sample
+            _avg_means.parquet, with Odor and Frame columns and one column of
+                avg fluorescence values per sample
+            _analysis.parquet, with Sample and Odor columns and one column per
+                analysis measurement
+
+        The raw means are written one trial at a time, so a memory-mapped
+        trial_cube is never loaded into memory all at once.
+        """
+
+        groups = self.trial_groups
+        n_samples, n_odors, n_frames = groups.avg_cube.shape
+        frames = np.arange(1, n_frames + 1, dtype=np.int16)
+
+        if self.save_raw_means:
+            save_blocks_to_parquet(
+                f"{self.file_prefix}_raw_means.parquet",
+                self.session_path,
+                (
+                    self.make_raw_means_block(row, frames)
+                    for row in range(len(groups.trial_ids))
+                ),
+            )
+
+        avg_means = pd.DataFrame(
+            {
+                "Odor": np.repeat(groups.odors, n_frames),
+                "Frame": np.tile(frames, n_odors),
+            }
+        )
+        avg_values = pd.DataFrame(
+            groups.avg_cube.transpose(1, 2, 0).reshape(
+                n_odors * n_frames, n_samples
+            ),
+            columns=self.n_column_labels,
+        )
+        avg_means = pd.concat([avg_means, avg_values], axis=1)
+
+        results = self.analysis_results.reshape(-1)
+        significant = results["significant"]
+        analysis = pd.DataFrame(
+            {
+                "Sample": np.repeat(self.n_column_labels, n_odors),
+                "Odor": np.tile(groups.odors, n_samples),
+            }
         )
+        for field, label in ANALYSIS_LABELS.items():
+            values = results[field]
+            if field in SIG_ONLY_FIELDS:
+                values = np.where(significant, values, np.nan)
+            analysis[label] = values
+        if self.test_results is not None:
+            test_results = self.test_results.reshape(-1)
+            for field, label in TEST_LABELS.items():
+                analysis[label] = test_results[field]
+
+        for output, df in [("avg_means", avg_means), ("analysis", analysis)]:
+            save_to_parquet(
+                f"{self.file_prefix}_{output}.parquet", self.session_path, df
+            )
 
-        bar_txt = f"Analyzing {sample_type} {n_count+1}"
+        if self.save_trial_metrics:
+            save_to_parquet(
+                f"{self.file_prefix}_trial_metrics.parquet",
+                self.session_path,
+                self.make_trial_metrics_df(),
+            )
 
-        return bar_txt
+    def make_trial_metrics_df(self) -> pd.DataFrame:
+        """Places the analysis values of every trial into a long table.
 
-    def drop_trials(self):
-        """Drops excluded trials from all_data_df."""
+        Returns:
+            A DataFrame with Sample, Odor and Trial columns and one column
+            per measurement, with one row per sample and trial.
+        """
 
-        self.all_data_df = self.all_data_df.loc[
-            ~self.all_data_df["Trial"].isin(self.drop_trials_list)
-        ]
+        groups = self.trial_groups
+        n_trials, n_samples = self.trial_results.shape
+
+        trial_metrics = pd.DataFrame(
+            {
+                "Sample": pd.Categorical(
+                    np.repeat(self.n_column_labels, n_trials),
+                    categories=self.n_column_labels,
+                ),
+                "Odor": np.tile(groups.odor_ids, n_samples),
+                "Trial": np.tile(groups.trial_ids, n_samples),
+            }
+        )
 
-    def collect_per_sample(
-        self, all_data_df: pd.DataFrame, sample: str
-    ) -> tuple[pd.DataFrame, pd.DataFrame]:
-        """Collects the mean values from all trials for one sample.
+        # one row per sample, then per trial
+        results = self.trial_results.T.reshape(-1)
+        for field, label in TRIAL_LABELS.items():
+            trial_metrics[label] = results[field]
+
+        return trial_metrics
+
+    def make_raw_means_block(
+        self, row: int, frames: np.ndarray
+    ) -> pd.DataFrame:
+        """Makes the rows of the _raw_means.parquet file for one trial.
 
         Args:
-            all_data_df: A DataFrame holding fluorescence values from all
-                    frames and trials for each odor, from all .txt files.
-            sample: The sample currently being collected.
+            row: The row of the trial in the grouped trial data.
+            frames: The frame #s.
 
         Returns:
-            A tuple (sorted_df, means), where sorted_df contains the raw mean
-            fluorescence values for each sample, and means, which contains the
-            mean of means.
+            A DataFrame with Odor, Trial and Frame columns and one column of
+            raw fluorescence values per sample.
         """
 
-        n_df = all_data_df[["Frame", "Trial", "Odor", sample]]
+        groups = self.trial_groups
+        n_frames = len(frames)
 
-        # pivots n_df to sort by odor #
-        sorted_df = n_df.pivot(
-            index="Frame",
-            columns=["Odor", "Trial"],
-            values=sample,
+        raw_means = pd.DataFrame(
+            {
+                "Odor": np.repeat(groups.odor_ids[row], n_frames),
+                "Trial": np.repeat(groups.trial_ids[row], n_frames),
+                "Frame": frames,
+            }
         )
+        raw_values = pd.DataFrame(
+            np.asarray(groups.sorted_cube[row]), columns=self.n_column_labels
+        )
+
+        return pd.concat([raw_means, raw_values], axis=1)
+
+    def group_trials(self):
+        """Sorts the trials by odor and averages them for all samples.
+
+        If the session was analyzed before with the same solenoid order, only
+        the odors whose trials have changed since then are averaged again. In
+        low-memory mode, the trials were already averaged while being read.
+        """
+
+        if self.running_means is not None:
+            self.trial_groups = OdorGroups(
+                self.trial_cube,
+                self.trial_ids,
+                self.odor_ids,
+                avg_cube=self.running_means.avg_cube,
+                is_sorted=True,
+            )
+            self.avg_cube = self.trial_groups.avg_cube
+            return
+
+        if self.use_cache:
+            self.last_run = self.read_last_run()
+        self.changed_odors = self.get_changed_odors()
 
-        sorted_df.sort_index(
-            axis=1, level=[0, 1], ascending=[True, True], inplace=True
+        if self.changed_odors is None:
+            self.trial_groups = OdorGroups(
+                self.trial_cube, self.trial_ids, self.odor_ids
+            )
+        else:
+            st.write(
+                f"Updating the {len(self.changed_odors)} odors changed since "
+                "the last run."
+            )
+            self.trial_groups = OdorGroups(
+                self.trial_cube,
+                self.trial_ids,
+                self.odor_ids,
+                avg_cube=self.last_run["avg_cube"],
+                changed_odors=self.changed_odors,
+            )
+        self.avg_cube = self.trial_groups.avg_cube
+
+    def analyze_all_samples(self):
+        """Analyzes the mean fluorescence values of all samples at once.
+
+        The results are kept in analysis_results, with one row per sample.
+        Only the odors changed since the last run are analyzed again, if any.
+        Every trial is also analyzed if trial metrics are saved or the
+        trials are tested against the blank. With more than one analysis
+        worker, blocks of samples are analyzed across a process pool.
+        """
+
+        if self._needs_trial_results:
+            self.analyze_all_trials()
+        if self.significance_test is not None:
+            self.test_all_samples()
+
+        if self.changed_odors is None:
+            self.analysis_results = analyze_sample_blocks(
+                analyze_responses,
+                self.avg_cube,
+                sample_axis=0,
+                result_axis=0,
+                args=(self.sustained_frames, self.analysis_config),
+                n_workers=self.analysis_workers,
+            )
+        else:
+            self.analysis_results = update_responses(
+                self.last_run["analysis_results"],
+                self.avg_cube,
+                np.isin(self.trial_groups.odors, self.changed_odors),
+                self.sustained_frames,
+                self.analysis_config,
+            )
+
+    def analyze_all_trials(self):
+        """Analyzes every trial of every sample at once, without averaging.
+
+        The results are kept in trial_results, in the order of the grouped
+        trials. In low-memory mode, trials are analyzed as they are read.
+        """
+
+        if self.running_means is not None:
+            return
+
+        self.trial_results = analyze_sample_blocks(
+            analyze_trials,
+            self.trial_groups.sorted_cube,
+            sample_axis=2,
+            result_axis=1,
+            args=(self.sustained_frames, self.analysis_config),
+            n_workers=self.analysis_workers,
         )
-        means = sorted_df.groupby(level=0, axis=1).mean()
 
-        return sorted_df, means
+    def test_all_samples(self):
+        """Tests each odor's trial deltaF values against the blank's for all
+        samples at once, with the settings in significance_test.
 
-    def analyze_signal(self, avg_means: pd.DataFrame) -> pd.DataFrame:
-        """A wrapper function for analyzing mean fluorescence values.
+        The results are kept in test_results, with one row per sample. All
+        odors are tested again on every run, since the test depends on the
+        trials of the blank too.
+        """
 
-        Args:
-            avg_means: The mean of mean fluorescence values from one sample.
+        st.write(
+            f"Running the {self.significance_test.method} test with "
+            f"{self.significance_test.n_resamples} resamples."
+        )
+        self.test_results = test_against_blank(
+            self.trial_results["deltaF"],
+            self.trial_groups.odor_ids,
+            self.trial_groups.odors,
+            self.significance_test,
+        )
+
+    def get_changed_odors(self) -> np.ndarray | None:
+        """Compares this run's inputs to the last run's to find the odors
+        whose trials were added, changed, removed or newly (un)dropped.
 
         Returns:
-            A DataFrame containing all the analysis values gathered for one
-                sample.
-        """
-
-        (
-            baseline,
-            peak,
-            deltaF,
-            baseline_stdx3,
-            deltaF_blank,
-            blank_sub_deltaF,
-            blank_sub_deltaF_F_perc,
-            baseline_subtracted,
-        ) = self.calculate_initial_nums(avg_means)
-
-        # Determines whether response is significant by checking whether
-        # blank_sub_deltaF is greater than baseline_stdx3.
-        significance_bool = blank_sub_deltaF > baseline_stdx3
-        sig_odors = significance_bool[significance_bool].index.values
-
-        significance_report = significance_bool.copy()
-        significance_report[sig_odors] = blank_sub_deltaF_F_perc[sig_odors]
-        significance_report = pd.Series(significance_report)
-
-        auc, auc_blank = self.calc_auc(avg_means, baseline=baseline)
-
-        (
-            blank_sub_auc,
-            peak_times,
-            odor_onset,
-            response_onset,
-            latency,
-            time_to_peak,
-        ) = self.analyze_sig_responses(
-            sig_odors=sig_odors,
-            avg_means=avg_means,
-            auc=auc,
-            auc_blank=auc_blank,
-            deltaF=deltaF,
-            baseline_subtracted=baseline_subtracted,
-        )
-
-        response_analyses_df = self.make_analysis_df(
-            avg_means,
-            baseline=baseline,
-            peak=peak,
-            deltaF=deltaF,
-            baseline_stdx3=baseline_stdx3,
-            deltaF_blank=deltaF_blank,
-            blank_sub_deltaF=blank_sub_deltaF,
-            blank_sub_deltaF_F_perc=blank_sub_deltaF_F_perc,
-            significance_report=significance_report,
-            auc=auc,
-            auc_blank=auc_blank,
-            blank_sub_auc=blank_sub_auc,
-            peak_times=peak_times,
-            odor_onset=odor_onset,
-            response_onset=response_onset,
-            latency=latency,
-            time_to_peak=time_to_peak,
+            The changed odor #s, or None if all odors need to be analyzed
+            again, e.g. when there is no last run or the solenoid order or
+            onset settings changed.
+        """
+
+        if self.last_run is None or self.fingerprints is None:
+            return None
+
+        last_inputs = self.last_run["inputs"]
+        n_frames, n_samples = self.trial_cube.shape[1:]
+        if (
+            last_inputs["solenoid"] != self.fingerprints["solenoid"]
+            or last_inputs["sustained_frames"] != self.sustained_frames
+            or last_inputs.get("precision") != self.precision
+            or last_inputs.get("analysis_config")
+            != self.analysis_config.to_dict()
+            or last_inputs["odors"] != np.unique(self.odor_ids).tolist()
+            or last_inputs["shape"] != [n_samples, n_frames]
+        ):
+            return None
+
+        last_trials = last_inputs["trials"]
+        trials = self.get_trial_inputs()
+
+        changed_trials = {
+            trial_ct + 1
+            for trial_ct in range(max(len(trials), len(last_trials)))
+            if trial_ct >= len(trials)
+            or trial_ct >= len(last_trials)
+            or trials[trial_ct] != last_trials[trial_ct]
+        }
+        changed_trials |= set(last_inputs["drop_trials"]) ^ set(
+            self.drop_trials_list
         )
 
-        return response_analyses_df
+        changed_odors = {
+            self.solenoid_order[trial - 1]
+            for trial in changed_trials
+            if trial <= len(self.solenoid_order)
+        }
 
-    def calculate_initial_nums(
-        self, avg_means: pd.DataFrame
-    ) -> tuple[
-        pd.Series,
-        pd.Series,
-        pd.Series,
-        pd.Series,
-        pd.Series,
-        pd.Series,
-        pd.Series,
-        pd.DataFrame,
-    ]:
-        """Performs initial calculations for mean fluorescence values.
+        return np.array(sorted(changed_odors), dtype=np.int16)
 
-        Args:
-            avg_means: The mean of mean fluorescence values from one sample.
+    def get_trial_inputs(self) -> list:
+        """Gets the file name and fingerprint of each trial, in trial order.
 
         Returns:
-            A tuple containing the following pd.Series/DataFrame (one value
-            per odor):
-                baseline: The fluorescence values from defined baseline period.
-                peak: The max fluorescence value during trial period.
-                deltaF: The change in fluorescence value from peak and baseline.
-                baseline_stdx3: Three standard deviations of baseline.
-                deltaF_blank: The deltaF value of the blank odor (last odor).
-                blank_sub_deltaF: The deltaF value with the blank odor's
-                    deltaF subtracted to remove blank response.
-                blank_sub_deltaF_F_perc: The blank-subtracted deltaF as a
-                    percent of baseline.
-                baseline_subtracted: The average fluorescence value, with
-                    baseline subtracted.
-        """
-        baseline = avg_means[:52].mean()
-
-        # Calculates peak using max value from frames #53-300
-        peak = avg_means[52:300].max()
-        deltaF = peak - baseline
-        baseline_stdx3 = avg_means[:52].std() * 3
-
-        deltaF_blank = deltaF[avg_means.columns[-1]]
-        blank_sub_deltaF = deltaF - deltaF_blank
-        blank_sub_deltaF_F_perc = blank_sub_deltaF / baseline * 100
-        baseline_subtracted = avg_means - baseline
-
-        return (
-            baseline,
-            peak,
-            deltaF,
-            baseline_stdx3,
-            deltaF_blank,
-            blank_sub_deltaF,
-            blank_sub_deltaF_F_perc,
-            baseline_subtracted,
-        )
-
-    def calc_auc(
-        self, avg_means: pd.DataFrame, baseline: pd.Series
-    ) -> tuple[pd.Series, np.float64]:
-        """Calculates area under curve (AUC).
+            A list of [file name, fingerprint] for each trial.
+        """
 
-        Args:
-            avg_means: The mean of mean fluorescence values from one sample.
-            baseline: Baseline fluorescence values.
+        return [
+            [filename, self.fingerprints["trials"][filename]]
+            for filename in self.trial_files
+        ]
+
+    def read_last_run(self) -> dict | None:
+        """Reads the inputs and results saved by the last run.
 
         Returns:
-            A tuple containing a pd.Series (AUC values for each odor) and
-            a np.float64 value (AUC value for blank odor).
+            A dict holding the last run's "inputs", "avg_cube" and
+            "analysis_results", or None if there is no valid last run.
+        """
 
+        try:
+            with open(self._last_run_path) as f:
+                inputs = json.load(f)
+            if inputs.get("version") != CACHE_VERSION:
+                return None
+            last_run = {
+                "inputs": inputs,
+                "avg_cube": np.load(self._last_avg_cube_path),
+                "analysis_results": np.load(self._last_analysis_path),
+            }
+        except (OSError, ValueError):
+            return None
+
+        if last_run["analysis_results"].dtype != ANALYSIS_DTYPE:
+            return None
+
+        return last_run
+
+    def save_last_run(self):
+        """Saves this run's inputs and results, so the next run only has to
+        update the odors that changed.
+
+        Nothing is saved if the session cache isn't used. The .json file is
+        written last, so an interrupted write leaves no last run rather than
+        a wrong one.
         """
 
-        # Calculates AUC using sum of values from frames # 1-300
-        auc = (avg_means[:300].sum() - (baseline * 300)) * 0.0661
-        auc.clip(lower=0, inplace=True)  # Sets negative AUC values to 0
+        if not self.use_cache or self.fingerprints is None:
+            return
+
+        inputs = {
+            "version": CACHE_VERSION,
+            "trials": self.get_trial_inputs(),
+            "solenoid": self.fingerprints["solenoid"],
+            "drop_trials": sorted(self.drop_trials_list),
+            "sample_type": self.sample_type,
+            "sustained_frames": self.sustained_frames,
+            "precision": self.precision,
+            "analysis_config": self.analysis_config.to_dict(),
+            "odors": self.trial_groups.odors.tolist(),
+            "shape": [self.total_n, self.avg_cube.shape[2]],
+        }
 
-        # Gets AUC_blank from AUC of the last odor
-        auc_blank = auc[avg_means.columns[-1]]
+        try:
+            self._cache_dir.mkdir(exist_ok=True)
+            self._last_run_path.unlink(missing_ok=True)
 
-        return auc, auc_blank
+            np.save(self._last_avg_cube_path, self.avg_cube)
+            np.save(self._last_analysis_path, self.analysis_results)
 
-    def analyze_sig_responses(
-        self,
-        sig_odors: np.ndarray,
-        avg_means: pd.DataFrame,
-        auc: pd.Series,
-        auc_blank: np.float64,
-        deltaF: pd.Series,
-        baseline_subtracted: pd.DataFrame,
-    ) -> tuple[pd.Series, pd.Series, float, pd.Series, pd.Series, pd.Series]:
-        """Analyzes odor responses for significant responses only.
+            temp_inputs_path = self._last_run_path.with_suffix(".tmp")
+            with open(temp_inputs_path, "w") as f:
+                json.dump(inputs, f)
+            os.replace(temp_inputs_path, self._last_run_path)
+        except OSError:
+            st.write("Could not save this run for updating later runs.")
+
+    def make_precision_report(self) -> pd.DataFrame:
+        """Reads the analyzed trials again in float64, one at a time, and
+        finds the largest differences from this run's values.
+
+        Trials are averaged and analyzed the same way as a float64 run, so
+        the differences are those a float64 run would have given. The report
+        is saved as a _precision_report.csv file.
+
+        Returns:
+            A DataFrame with the largest absolute and relative differences of
+            the raw values, avg means and each analysis value, and the
+            number of responses whose significance changed.
+        """
+
+        paths = [
+            self.session_index.get_path(self.trial_files[trial_id - 1])
+            for trial_id in self.trial_ids
+        ]
+
+        running_means = None
+        raw_diffs = []
+        for read_ct, values in read_txt_files_in_order(
+            paths, self.n_workers, self.pool_type
+        ):
+            if running_means is None:
+                running_means = RunningOdorMeans(
+                    self.trial_groups.odors, *values.shape
+                )
+            running_means.add_trial(
+                self.odor_ids[read_ct], values, Path(paths[read_ct]).name
+            )
+            raw_diffs.append(
+                get_max_differences(values, values.astype(self.precision))
+            )
+
+        full_avg_cube = running_means.avg_cube
+        full_results = analyze_responses(
+            full_avg_cube, self.sustained_frames, self.analysis_config
+        )
+
+        report = {
+            "Raw values": np.nanmax(raw_diffs, axis=0),
+            "Avg means": get_max_differences(full_avg_cube, self.avg_cube),
+        }
+        for field, label in ANALYSIS_LABELS.items():
+            if field == "significant":
+                n_changed = np.sum(
+                    full_results[field] != self.analysis_results[field]
+                )
+                report[f"{label} (responses changed)"] = [n_changed, np.nan]
+            else:
+                report[label] = get_max_differences(
+                    full_results[field], self.analysis_results[field]
+                )
+
+        self.precision_report = pd.DataFrame.from_dict(
+            report,
+            orient="index",
+            columns=["Max abs difference", "Max rel difference"],
+        )
+        self.precision_report.index.name = "Value"
+
+        save_to_csv(
+            f"{self.file_prefix}_precision_report.csv",
+            self.session_path,
+            self.precision_report.reset_index(),
+        )
+
+        return self.precision_report
+
+    def drop_trials(self):
+        """Drops excluded trials from trial_cube."""
+
+        keep = ~np.isin(self.trial_ids, self.drop_trials_list)
+
+        self.trial_cube = self.trial_cube[keep]
+        self.trial_ids = self.trial_ids[keep]
+        self.odor_ids = self.odor_ids[keep]
+
+    def update_dropped_trials(self, drop_trials_list: list) -> np.ndarray:
+        """Drops or restores trials of an analyzed session using the loaded
+        trials, so only the odors whose trials changed are averaged and
+        analyzed again.
+
+        The trial metrics of trials that were already analyzed are kept, and
+        the resampling test is run again only for the changed odors. The
+        outputs aren't saved.
 
         Args:
-            sig_odors: Odors with significant responses.
-            avg_means: The mean of mean fluorescence values from one sample.
-            auc: The area under curve values for all odor.
-            auc_blank: The area under curve values for the blank odor.
-            deltaF: The deltaF values for all odors.
-            baseline_subtracted: The baseline-subtracted fluorescence values.
+            drop_trials_list: The trial #s to drop, replacing the current
+                list.
 
         Returns:
-            blank_sub_auc: The AUC, minus the blank AUC.
-            peak_times: The times of peak fluorescence for all odors.
-            odor_onset: The odor onset time for all odors (frame 57).
-            response_onset: The response onset times for all odors.
-            latency: The latency to response onset from odor onset.
-            time_to_peak: The times from response onset to response peak.
+            The odor #s whose trials changed.
         """
 
-        # Creates 'N/A' template for non-significant odor responses
-        na_template = pd.Series("N/A", index=avg_means.columns)
+        if self.all_trial_cube is None:
+            raise Exception("Trials can't be changed in low-memory mode")
 
-        # Calculates blank-subtracted AUC only if response is present
-        blank_sub_auc = na_template.copy()
-        blank_sub_auc[sig_odors] = auc[sig_odors] - auc_blank
+        changed_trials = list(
+            set(drop_trials_list) ^ set(self.drop_trials_list)
+        )
+        changed_odors = np.unique(
+            self.all_odor_ids[np.isin(self.all_trial_ids, changed_trials)]
+        )
+        if len(changed_odors) == 0:
+            return changed_odors
+
+        keep = ~np.isin(self.all_trial_ids, drop_trials_list)
+        if not keep.any():
+            raise Exception("All trials are dropped")
+
+        last_groups = self.trial_groups
+        self.drop_trials_list = sorted(drop_trials_list)
+        self.trial_cube = self.all_trial_cube[keep]
+        self.trial_ids = self.all_trial_ids[keep]
+        self.odor_ids = self.all_odor_ids[keep]
+
+        # all odors are analyzed again if an odor lost or regained all of its
+        # trials
+        same_odors = np.array_equal(
+            np.unique(self.odor_ids), last_groups.odors
+        )
+        if same_odors:
+            self.trial_groups = OdorGroups(
+                self.trial_cube,
+                self.trial_ids,
+                self.odor_ids,
+                avg_cube=last_groups.avg_cube,
+                changed_odors=changed_odors,
+            )
+            odor_mask = np.isin(self.trial_groups.odors, changed_odors)
+            self.analysis_results = update_responses(
+                self.analysis_results,
+                self.trial_groups.avg_cube,
+                odor_mask,
+                self.sustained_frames,
+                self.analysis_config,
+            )
+        else:
+            self.trial_groups = OdorGroups(
+                self.trial_cube, self.trial_ids, self.odor_ids
+            )
+            self.analysis_results = analyze_sample_blocks(
+                analyze_responses,
+                self.trial_groups.avg_cube,
+                sample_axis=0,
+                result_axis=0,
+                args=(self.sustained_frames, self.analysis_config),
+                n_workers=self.analysis_workers,
+            )
+        self.avg_cube = self.trial_groups.avg_cube
 
-        # Calculates time at signal peak using all the frames
-        # why does excel sheet have - 2??
-        max_frames = avg_means[52:300].idxmax()
-        peak_times = na_template.copy()
-        peak_times[sig_odors] = max_frames[sig_odors] * 0.0661
+        if self.trial_results is not None:
+            last_rows = pd.Index(last_groups.trial_ids).get_indexer(
+                self.trial_groups.trial_ids
+            )
+            is_new = last_rows < 0
+            trial_results = np.empty(
+                (len(last_rows), self.total_n), dtype=TRIAL_DTYPE
+            )
+            trial_results[~is_new] = self.trial_results[last_rows[~is_new]]
+            if is_new.any():
+                trial_results[is_new] = analyze_trials(
+                    self.trial_groups.sorted_cube[is_new],
+                    self.sustained_frames,
+                    self.analysis_config,
+                )
+            self.trial_results = trial_results
+
+        if self.test_results is not None and same_odors:
+            self.test_results = update_tests(
+                self.test_results,
+                self.trial_results["deltaF"],
+                self.trial_groups.odor_ids,
+                self.trial_groups.odors,
+                odor_mask,
+                self.significance_test,
+            )
+        elif self.test_results is not None:
+            self.test_results = test_against_blank(
+                self.trial_results["deltaF"],
+                self.trial_groups.odor_ids,
+                self.trial_groups.odors,
+                self.significance_test,
+            )
 
-        # Get odor onset - Frame 57
-        odor_onset = 57 * 0.0661
+        return changed_odors
 
-        # Calculate response onset only for significant odors
-        response_onset = na_template.copy()
-        onset_amp = deltaF * 0.05
+    def make_trial_table(self) -> pd.DataFrame:
+        """Lists every loaded trial with whether it is dropped.
 
-        for sig_odor in sig_odors:
-            # Window doesn't start at frame 53 because it can't precede
-            #  odor onset
-            window = baseline_subtracted[56:300][sig_odor]
-            onset_idx = np.argmax(window >= onset_amp[sig_odor])
-            onset_time = window.index[onset_idx] * 0.0661
-            response_onset[sig_odor] = onset_time
+        Returns:
+            A DataFrame with Trial, Odor, File, Frames and Dropped columns,
+            with one row per trial in trial order.
+        """
 
-        latency = na_template.copy()
-        latency[sig_odors] = response_onset[sig_odors] - odor_onset
+        trial_nums = self.all_trial_ids - 1
 
-        time_to_peak = na_template.copy()
-        time_to_peak[sig_odors] = (
-            peak_times[sig_odors] - response_onset[sig_odors]
+        return pd.DataFrame(
+            {
+                "Trial": self.all_trial_ids,
+                "Odor": self.all_odor_ids,
+                "File": [self.trial_files[x] for x in trial_nums],
+                "Frames": [self.trial_frames[x] for x in trial_nums],
+                "Dropped": np.isin(self.all_trial_ids, self.drop_trials_list),
+            }
         )
 
-        return (
-            blank_sub_auc,
-            peak_times,
-            odor_onset,
-            response_onset,
-            latency,
-            time_to_peak,
+    def get_trial_traces(self, n_count: int, odor: int) -> pd.DataFrame:
+        """Gets the fluorescence values of every loaded trial of one odor for
+        one sample, including dropped trials.
+
+        Args:
+            n_count: The index of the sample.
+            odor: The odor #.
+
+        Returns:
+            A DataFrame with Frame as index and Trial # as columns.
+        """
+
+        rows = np.flatnonzero(self.all_odor_ids == odor)
+        n_frames = self.all_trial_cube.shape[1]
+
+        return pd.DataFrame(
+            self.all_trial_cube[rows, :, n_count].T,
+            index=pd.RangeIndex(1, n_frames + 1, name="Frame"),
+            columns=pd.Index(self.all_trial_ids[rows], name="Trial"),
         )
 
-    def make_analysis_df(
-        self,
-        avg_means: pd.DataFrame,
-        baseline: pd.Series,
-        peak: pd.Series,
-        deltaF: pd.Series,
-        baseline_stdx3: pd.Series,
-        deltaF_blank: pd.Series,
-        blank_sub_deltaF: pd.Series,
-        blank_sub_deltaF_F_perc: pd.Series,
-        significance_report: pd.Series,
-        auc: pd.Series,
-        auc_blank: np.float64,
-        blank_sub_auc: pd.Series,
-        peak_times: pd.Series,
-        odor_onset: float,
-        response_onset: pd.Series,
-        latency: pd.Series,
-        time_to_peak: pd.Series,
-    ) -> pd.DataFrame:
-        """Places analysis results into a df.
+    def collect_per_sample(
+        self, n_count: int
+    ) -> tuple[pd.DataFrame, pd.DataFrame]:
+        """Collects the mean values from all trials for one sample.
 
         Args:
-            avg_means: The mean of mean fluorescence values from one sample.
-            baseline: The fluorescence values from defined baseline period.
-            peak: The max fluorescence value during the trial period.
-            deltaF: The change in fluorescence value from peak and baseline.
-            baseline_stdx3: Three standard deviations of baseline.
-            deltaF_blank: deltaF value of the blank odor (last odor).
-            blank_sub_deltaF: deltaF values with the blank odor's deltaF
-                subtracted to remove blank response.
-            blank_sub_deltaF_F_perc: The blank-subtracted deltaF as a
-                percent of baseline.
-            significance report: A Series of denoting whether an odor had a
-                significant response; if yes, print blank_sub_deltaF_F_perc,
-                else print FALSE.
-            auc: The area under curve values for all odor.
-            auc_blank: The area under curve values for the blank odor.
-            blank_sub_auc: The AUC, minus the blank AUC.
-            peak_times: The times of peak fluorescence for all odors.
-            odor_onset: The odor onset time for all odors (frame 57).
-            response_onset: The response onset times for all odors.
-            latency: The latency to response onset from odor onset.
-            time_to_peak: The times from response onset to response peak.
+            n_count: The index of the sample currently being collected.
 
         Returns:
-            All the analysis results in a DataFrame, with rows as measurement
-            labels and columns as Odor #.
+            A tuple (sorted_df, means), where sorted_df contains the raw mean
+            fluorescence values for each sample, or None if raw means aren't
+            saved, and means, which contains the mean of means. Both are
+            views of the grouped trial data.
         """
 
-        col_names = [
-            "Odor",
-            "Baseline",
-            "Peak",
-            "DeltaF",
-            "3 std of baseline",
-            "DeltaF(BLANK)",
-            "Blank-subtracted DeltaF",
-            "Blank-subtracted DeltaF/F(%)",
-            "Significant response?",
-            "Area under curve",
-            "Blank area under curve",
-            "Blank sub AUC",
-            "Time at peak (s)",
-            "Odor onset",
-            "Response onset (s)",
-            "Latency (s)",
-            "Time to peak (s)",
-        ]
+        sorted_df = None
+        if self.save_raw_means:
+            sorted_df = self.trial_groups.raw_means(n_count)
+        means = self.trial_groups.avg_means(n_count)
 
-        num_odors = len(avg_means.columns)
-        series_axis = range(1, num_odors + 1)
+        return sorted_df, means
 
-        odor_labels = pd.Series([f"Odor {x}" for x in series_axis]).set_axis(
-            series_axis
-        )
+    def make_analysis_df(
+        self,
+        sample_results: np.ndarray,
+        odors: np.ndarray,
+        sample_test_results: np.ndarray = None,
+    ) -> pd.DataFrame:
+        """Places analysis results for one sample into a df.
 
-        deltaF_blank_series = pd.Series([deltaF_blank] * num_odors).set_axis(
-            series_axis
-        )
+        Values that are only calculated for significant responses are
+        reported as "N/A" for non-significant responses, and the significance
+        report shows the blank-subtracted deltaF/F(%) if the response is
+        significant, else FALSE.
 
-        auc_blank_series = pd.Series([auc_blank] * num_odors).set_axis(
-            series_axis
-        )
+        Args:
+            sample_results: The analysis values of one sample, a structured
+                array with ANALYSIS_DTYPE and one value per odor.
+            odors: The odor #s of the analysis values.
+            sample_test_results: The resampling test values of the sample,
+                a structured array with TEST_DTYPE and one value per odor,
+                added as extra rows if given.
 
-        odor_onset_series = pd.Series([odor_onset] * num_odors).set_axis(
-            series_axis
-        )
+        Returns:
+            All the analysis results in a DataFrame, with rows as measurement
+            labels and columns as Odor #.
+        """
 
-        series_list = [
-            odor_labels,
-            baseline,
-            peak,
-            deltaF,
-            baseline_stdx3,
-            deltaF_blank_series,
-            blank_sub_deltaF,
-            blank_sub_deltaF_F_perc,
-            significance_report,
-            auc,
-            auc_blank_series,
-            blank_sub_auc,
-            peak_times,
-            odor_onset_series,
-            response_onset,
-            latency,
-            time_to_peak,
-        ]
+        significant = sample_results["significant"]
 
-        response_analyses_df = pd.concat(
-            series_list, axis=1, ignore_index=True
-        )
+        def sig_only(values):
+            return pd.Series(values, index=odors, dtype=object).where(
+                significant, "N/A"
+            )
 
-        response_analyses_df.columns = col_names
-        response_analyses_df = response_analyses_df.T
+        significance_report = pd.Series(
+            sample_results["blank_sub_deltaF_F_perc"],
+            index=odors,
+            dtype=object,
+        ).where(significant, False)
+
+        rows = {"Odor": pd.Series([f"Odor {x}" for x in odors], index=odors)}
+        for field, label in ANALYSIS_LABELS.items():
+            if field == "significant":
+                rows[label] = significance_report
+            elif field in SIG_ONLY_FIELDS:
+                rows[label] = sig_only(sample_results[field])
+            else:
+                rows[label] = sample_results[field]
+        if sample_test_results is not None:
+            for field, label in TEST_LABELS.items():
+                rows[label] = sample_test_results[field]
+
+        response_analyses_df = pd.DataFrame(
+            {
+                label: pd.Series(values, index=odors)
+                for label, values in rows.items()
+            }
+        ).T
 
         return response_analyses_df
 
@@ -720,9 +1679,8 @@ class ExperimentFile(object):
         ROI_id (str): The ROI imaged in the experiment.
         exp_name (str): The name of the experiment imaging session.
         sample_type (str): The sample type, e.g. "Cell", "Glomerulus", or "Grid".
-        tuple_dict (dict): A dictionary containing tuples  of
-            (sample #, odor #) as keys and the analysis values of that sample
-            and odor pair as the values.
+        long_df (pd.DataFrame): The analysis values in long format, with one
+            row per sample, odor and measurement.
     """
 
     def __init__(self, file: str, dataset_type: str):
@@ -736,9 +1694,8 @@ class ExperimentFile(object):
             ROI_id (str): The ROI imaged in the experiment.
             exp_name (str): The name of the experiment imaging session.
             sample_type (str): The sample type, e.g. "Cell", "Glomerulus", or "Grid".
-            tuple_dict (dict): A dictionary containing tuples  of
-                (sample #, odor #) as keys and the analysis values of that sample
-                and odor pair as the values.
+            long_df (pd.DataFrame): The analysis values in long format, with
+                one row per sample, odor and measurement.
         """
 
         self.file = file
@@ -748,15 +1705,23 @@ class ExperimentFile(object):
         self.exp_name = "_".join(file_parts)
 
         self.sample_type = None
-        self.tuple_dict = None
+        self.long_df = None
 
     def import_excel(self) -> dict:
         """Imports data from each .xlsx file into a dictionary.
 
+        The analysis.parquet file is read instead when it was uploaded, or
+        when it is saved next to the analysis.xlsx file.
+
         Returns:
             A dictionary containing measurement values from the analysis.xlsx
             file, with sample # as keys.
         """
+
+        parquet_file = find_parquet_file(self.file)
+        if parquet_file is not None:
+            return self.import_parquet(parquet_file)
+
         data_dict = pd.read_excel(
             self.file,
             sheet_name=None,
@@ -768,6 +1733,40 @@ class ExperimentFile(object):
 
         return data_dict
 
+    def import_parquet(self, parquet_file) -> dict:
+        """Imports data from an analysis.parquet file into a dictionary laid
+        out like the sheets of the analysis.xlsx file.
+
+        Args:
+            parquet_file: The path to the .parquet file, or the uploaded file.
+
+        Returns:
+            A dictionary containing measurement values from the
+            analysis.parquet file, with sample # as keys.
+        """
+
+        analysis = pd.read_parquet(parquet_file)
+        significant = analysis.pop("Significant response?")
+        perc_label = ANALYSIS_LABELS["blank_sub_deltaF_F_perc"]
+
+        # Significance report is blank-subtracted deltaF/F(%), else False
+        analysis.insert(
+            analysis.columns.get_loc(perc_label) + 1,
+            "Significant response?",
+            analysis[perc_label].astype(object).where(significant, False),
+        )
+
+        data_dict = {}
+        for sample, sample_df in analysis.groupby("Sample", sort=False):
+            sample_df = sample_df.drop(columns="Sample").astype(object)
+            sample_df["Odor"] = [f"Odor {x}" for x in sample_df["Odor"]]
+            sample_df = sample_df.set_index("Odor").T
+            sample_df.index.name = "Odor"
+            sample_df.columns.name = None
+            data_dict[sample] = sample_df
+
+        return data_dict
+
     # def shared_method(self):
     #     do stuff
 
@@ -776,64 +1775,112 @@ class ExperimentFile(object):
     #     elif acute:
     #         do other stuff
 
-    def sort_data(self, data_dict: dict, df_list: list) -> list:
-        """Converts dicts containing .analysis data into DataFrames for each
-        measurement (e.g. "Time to peak (s)").
+    def make_long_df(self, data_dict: dict) -> pd.DataFrame:
+        """Reshapes the sheets of the analysis.xlsx file into one long-format
+        table, with one row per sample, odor and measurement.
 
         Args:
             data_dict: A dictionary containing measurement values from
                 the analysis.xlsx file, with sample # as keys.
-            df_list: A list of DataFrames to hold the values for each
-                measurement.
 
         Returns:
-            A list of a list of DataFrames, one list for each measurement.
-                Values from each new .xlsx file are appended as new rows in the
-                DataFrames in df_list.
+            A DataFrame with "Sample", "Odor", "Measure", "Value" and
+            "Significant" columns, with a row for every sample, odor and
+            measurement even if its value is empty. "Significant" is False
+            for the sample and odor pairs whose "Significant response?" value
+            is False.
         """
 
-        self.tuple_dict = {
-            (outerKey, innerKey): values
-            for outerKey, innerDict in data_dict.items()
-            for innerKey, values in innerDict.items()
-        }
+        self.sample_type = next(iter(data_dict)).split(" ")[0]
+
+        wide_df = pd.concat(data_dict, names=["Sample", "Measure"])
+        wide_df.columns.name = "Odor"
+
+        # Non-sig responses have False instead of the response size
+        significant = (
+            wide_df.xs("Significant response?", level="Measure") != False
+        )
+
+        long_df = (
+            wide_df.stack(dropna=False)
+            .rename("Value")
+            .reset_index()
+            .join(
+                significant.stack().rename("Significant"),
+                on=["Sample", "Odor"],
+            )
+        )
+
+        # Renaming sample names for better sorting
+        long_df["Sample"] = (
+            long_df["Sample"].str.split(" ").str[1].astype(int)
+        )
+
+        self.long_df = long_df
+
+        return long_df
+
+    def get_measure_df(self, measure: str) -> pd.DataFrame:
+        """Gets the values of one measurement from the long-format table,
+        with samples as rows and odors as columns.
 
-        mega_df = pd.DataFrame(self.tuple_dict)
-        self.sample_type = mega_df.columns[0][0].split(" ")[0]
+        Args:
+            measure: The name of the measurement, e.g. "Time to peak (s)".
+
+        Returns:
+            A DataFrame with (measure, odor) columns and sample # as index.
+        """
+
+        measure_df = self.long_df[self.long_df["Measure"] == measure]
+        values = measure_df["Value"]
 
         # Replaces values with "" for non-sig responses if not already NaN
-        temp_mega_df = mega_df.T
-        # temp_mega_df.loc[
-        #     temp_mega_df["Significant response?"] == False, "Blank sub AUC"
-        # ] = ""
-        temp_mega_df.loc[
-            temp_mega_df["Significant response?"] == False,
-            "Blank-subtracted DeltaF/F(%)",
-        ] = ""
+        if measure == "Blank-subtracted DeltaF/F(%)":
+            values = values.where(measure_df["Significant"], "")
+
+        measure_df = measure_df.assign(Value=values).pivot(
+            index="Sample", columns="Odor", values="Value"
+        )
+
+        # Keeps every sample, but drops odors with no values for this measure
+        measure_df.dropna(axis=1, how="all", inplace=True)
+        measure_df.columns = pd.MultiIndex.from_product(
+            [[measure], measure_df.columns.tolist()]
+        )
+        measure_df.index.name = self.sample_type
 
-        mega_df = temp_mega_df.copy().T
-        appended_df_list = [[] for x in range(5)]
+        return measure_df
 
-        for measure_ct, measure in enumerate(st.session_state.measures):
-            temp_measure_df = pd.DataFrame(mega_df.loc[measure]).T.stack().T
+    def sort_data(self, data_dict: dict, measures: list) -> list:
+        """Converts dicts containing .analysis data into DataFrames for each
+        measurement (e.g. "Time to peak (s)").
+
+        Args:
+            data_dict: A dictionary containing measurement values from
+                the analysis.xlsx file, with sample # as keys.
+            measures: A list of the measurement names.
+
+        Returns:
+            A list of DataFrames, one for each measurement, holding the values
+                from this .xlsx file. The DataFrames from all files are
+                concatenated once by import_all_excel_data().
+        """
+
+        self.make_long_df(data_dict)
+        measure_dfs = []
+
+        for measure in measures:
+            measure_df = self.get_measure_df(measure)
 
             if self.dataset_type == "chronic":
-                temp_measure_df["Date"] = self.date
+                measure_df["Date"] = self.date
             else:
-                temp_measure_df["Animal ID"] = self.animal_id
-                temp_measure_df["ROI"] = self.roi
+                measure_df["Animal ID"] = self.animal_id
+                measure_df["ROI"] = self.roi
 
-            # Renaming sample names for better sorting
-            temp_measure_df.rename(
-                index=lambda x: int(x.split(" ")[1]), inplace=True
-            )
-            temp_measure_df.index.rename(self.sample_type, inplace=True)
+            measure_dfs.append(measure_df)
 
-            # Append values from this analysis.xlsx file
-            concat_pd = pd.concat([df_list[measure_ct], temp_measure_df])
-            appended_df_list[measure_ct] = concat_pd
-
-        return appended_df_list
+        return measure_dfs
 
     def make_plotting_dfs(self, data_dict: dict) -> tuple[list, pd.DataFrame]:
         """Makes the DataFrames used for plotting measurements.
@@ -848,7 +1895,7 @@ class ExperimentFile(object):
                 significant responses.
         """
 
-        sig_data_df = pd.DataFrame()
+        sig_data_dfs = []
         sig_odors = []
 
         # drop non-significant colums from each df using NaN values
@@ -866,7 +1913,7 @@ class ExperimentFile(object):
                 ]
             ]
 
-            sig_data_df = pd.concat([sig_data_df, data_df], axis=1)
+            sig_data_dfs.append(data_df)
 
             # gets list of remaining significant odors
             if len(data_df.columns.values) == 0:
@@ -875,4 +1922,6 @@ class ExperimentFile(object):
                 df_sig_odors = data_df.columns.values.tolist()
                 sig_odors.append(df_sig_odors)
 
+        sig_data_df = pd.concat(sig_data_dfs, axis=1)
+
         return sig_odors, sig_data_df
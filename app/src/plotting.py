@@ -68,6 +68,60 @@ def plot_avg_amps(
     return fig
 
 
+def plot_trial_traces(
+    traces_df: pd.DataFrame, dropped_trials: list, avg_trace: pd.Series
+) -> go.Figure:
+    """Plots every trial of one odor for one sample, to spot trials with
+    e.g. motion artifacts.
+
+    Args:
+        traces_df: DataFrame containing the fluorescence values of each
+            trial, with Frame as index and Trial # as columns.
+        dropped_trials: The trial #s that are dropped, drawn as dashed grey
+            lines.
+        avg_trace: The mean of the kept trials, or None if all are dropped.
+
+    Returns:
+        A plot containing one trace per trial and one for their mean.
+    """
+
+    fig = go.Figure()
+
+    for trial in traces_df.columns:
+        is_dropped = trial in dropped_trials
+        fig.add_trace(
+            go.Scatter(
+                x=traces_df.index,
+                y=traces_df[trial],
+                line=dict(
+                    color="#A9AABC" if is_dropped else None,
+                    dash="dash" if is_dropped else None,
+                    width=1,
+                ),
+                name=f"Trial {trial}" + (" (dropped)" if is_dropped else ""),
+            )
+        )
+
+    if avg_trace is not None:
+        fig.add_trace(
+            go.Scatter(
+                x=avg_trace.index,
+                y=avg_trace,
+                line=dict(color="black", width=3),
+                name="Mean of kept trials",
+            )
+        )
+
+    fig.update_xaxes(
+        title_text="Frame",
+    )
+    fig.update_yaxes(
+        title_text="Mean amplitude",
+    )
+
+    return fig
+
+
 def set_color_scales(dataset_type: str) -> dict:
     """Creates fixed color scales used for plotting.
 
@@ -1,5 +1,10 @@
 """Contains functions for processing the data loaded from .xlsx files."""
 
+import io
+import hashlib
+import json
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, as_completed
 import numpy as np
 import pandas as pd
 from collections import defaultdict
@@ -7,7 +12,7 @@ from stqdm import stqdm
 import streamlit as st
 from datetime import datetime
 
-from src.utils import save_to_excel
+from src.utils import ExcelSheetWriter, find_parquet_file
 
 from src.plotting import (
     get_acute_plot_params,
@@ -20,11 +25,107 @@ from src.experiment import ExperimentFile
 
 import pdb
 
+# The number of parsed files kept in memory across reruns
+MAX_CACHED_FILES = 1000
+
+
+class ParsedFileCache(object):
+    """Keeps the results of load_file for uploaded .xlsx files in memory
+    across reruns, keyed by a hash of each file's name and contents.
+
+    Attributes:
+        max_entries (int): The number of files whose results are kept. The
+            least recently used results are dropped first.
+    """
+
+    def __init__(self, max_entries: int = MAX_CACHED_FILES):
+        """Initializes an empty instance of ParsedFileCache().
+
+        Args:
+            max_entries: The number of files whose results are kept.
+        """
+
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+
+    @staticmethod
+    def make_key(
+        file_name: str, file_bytes: bytes, dataset_type: str, measures: list
+    ) -> str:
+        """Makes the cache key of an uploaded file.
+
+        The file name is part of the key because the date, animal ID and ROI
+        in the results are taken from it.
+
+        Args:
+            file_name: The name of the uploaded file.
+            file_bytes: The contents of the uploaded file.
+            dataset_type: Chronic or acute experiment type.
+            measures: A list of the measurement names.
+
+        Returns:
+            The SHA-256 hex digest of the file contents and settings.
+        """
+
+        settings = json.dumps([file_name, dataset_type, list(measures)])
+        hasher = hashlib.sha256(file_bytes)
+        hasher.update(settings.encode())
+
+        return hasher.hexdigest()
+
+    def get(self, key: str) -> tuple | None:
+        """Gets the cached results of a file.
+
+        Args:
+            key: The cache key of the file, from make_key().
+
+        Returns:
+            The results of load_file, or None if the file isn't cached.
+        """
+
+        if key not in self._entries:
+            return None
+
+        self._entries.move_to_end(key)
+
+        return self._entries[key]
+
+    def put(self, key: str, results: tuple):
+        """Caches the results of a file.
+
+        Args:
+            key: The cache key of the file, from make_key().
+            results: The results of load_file.
+        """
+
+        self._add(key, results)
+
+    def _add(self, key: str, results: tuple):
+        """Adds results to the in-memory cache, dropping the least recently
+        used results if it is full.
+
+        Args:
+            key: The cache key of the file.
+            results: The results of load_file.
+        """
+
+        self._entries[key] = results
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+
+# Shared by all reruns and pages, as Streamlit only imports this module once
+parsed_file_cache = ParsedFileCache()
+
 
 def load_avg_means(file: str) -> tuple[dict, list]:
     """Loads the average means from an experiment into a dictionary, with sheet
     names/sample # as keys, DataFrame as values.
 
+    The avg_means.parquet file is read instead when it was uploaded, or when
+    it is saved next to the avg_means.xlsx file.
+
     Args:
         file: The path to the .xlsx file containing the average means.
 
@@ -34,7 +135,11 @@ def load_avg_means(file: str) -> tuple[dict, list]:
         odor_list: The list of odors found in the .xlsx file.
     """
 
-    avg_means_dict = pd.read_excel(file, sheet_name=None)
+    parquet_file = find_parquet_file(file)
+    if parquet_file is not None:
+        avg_means_dict = load_avg_means_parquet(parquet_file)
+    else:
+        avg_means_dict = pd.read_excel(file, sheet_name=None)
     st.info(
         f"Avg means loaded successfully for {len(avg_means_dict)} " "samples."
     )
@@ -47,6 +152,33 @@ def load_avg_means(file: str) -> tuple[dict, list]:
     return avg_means_dict, odor_list
 
 
+def load_avg_means_parquet(file: str) -> dict:
+    """Loads the average means from an avg_means.parquet file, laid out like
+    the sheets of the avg_means.xlsx file.
+
+    Args:
+        file: The path to the .parquet file, or the uploaded file.
+
+    Returns:
+        Dict containing the average means of each sample, with Frame and
+            odor # columns.
+    """
+
+    avg_means = pd.read_parquet(file)
+    sample_names = avg_means.columns.drop(["Odor", "Frame"])
+
+    avg_means_dict = {}
+    for sample in sample_names:
+        sample_df = avg_means.pivot(
+            index="Frame", columns="Odor", values=sample
+        )
+        sample_df.columns = [int(x) for x in sample_df.columns]
+        sample_df.index = sample_df.index.astype(int)
+        avg_means_dict[sample] = sample_df.reset_index()
+
+    return avg_means_dict
+
+
 def make_empty_containers(dataset_type: str) -> list:
     """Makes a list of empty lists and dicts to hold experimental data and the
     ids of significant vs. non-significant experiments and odors.
@@ -83,32 +215,113 @@ def make_empty_containers(dataset_type: str) -> list:
 
 
 def load_file(
-    file: str,
-    df_list: list,
-    dict_list: list,
+    file_name: str,
+    file_bytes: bytes,
     dataset_type: str,
-) -> tuple[list, list, str]:
-    """Creates an ExperimentFile object for each imported file, then processes
+    measures: list,
+) -> tuple[list, list, pd.DataFrame]:
+    """Creates an ExperimentFile object for an imported file, then processes
     the file for Excel saving and plotting.
 
+    Runs in a worker process when files are loaded across a pool, so it is
+    given the name and contents of the uploaded file instead of the file.
+
+    Args:
+        file_name: The name of the uploaded file.
+        file_bytes: The contents of the uploaded file.
+        dataset_type: Chronic or acute experiment type.
+        measures: A list of the measurement names.
+
+    Returns:
+        measure_dfs: A list of DataFrames, one for each measurement
+            contained in analysis.xlsx, holding the values from this file via
+            ExperimentFile.sort_data().
+        sig_odors: A list of all the significant odors from the experiment.
+        sig_data_df: A DataFrame containing only measurements for
+            significant responses.
+    """
+
+    file = io.BytesIO(file_bytes)
+    file.name = file_name
+
+    loaded_file = ExperimentFile(file, dataset_type)
+    excel_dict = loaded_file.import_excel()
+    measure_dfs = loaded_file.sort_data(excel_dict, measures)
+    sig_odors, sig_data_df = loaded_file.make_plotting_dfs(excel_dict)
+
+    return measure_dfs, sig_odors, sig_data_df
+
+
+def load_files(
+    files: list, dataset_type: str, measures: list, n_workers: int = 1
+):
+    """Loads uploaded .xlsx files via load_file, optionally across a process
+    pool.
+
+    Results are yielded as soon as each file has been loaded, so they may
+    not arrive in the order of files; the index of each file is yielded with
+    its results. If a file fails to load, the remaining files are cancelled
+    and the error is raised straight away.
+
     Args:
-        file: streamlit.runtime.uploaded_file_manager.UploadedFile, csv file
-        df_list: A list of DataFrames to hold the DataFrames for each
-            analysis measurement.
+        files: A list of .xlsx files uploaded to Streamlit.
+        dataset_type: Chronic or acute experiment type.
+        measures: A list of the measurement names.
+        n_workers: The number of files to load at the same time. 1 loads
+            the files one after another.
+
+    Yields:
+        A tuple (index, results) with the position of the file in files and
+        the results of load_file.
+    """
+
+    if n_workers <= 1 or len(files) <= 1:
+        for file_ct, file in enumerate(files):
+            yield file_ct, load_file(
+                file.name, file.getvalue(), dataset_type, measures
+            )
+        return
+
+    executor = ProcessPoolExecutor(max_workers=n_workers)
+
+    try:
+        futures = {
+            executor.submit(
+                load_file, file.name, file.getvalue(), dataset_type, measures
+            ): file_ct
+            for file_ct, file in enumerate(files)
+        }
+        for future in as_completed(futures):
+            yield futures[future], future.result()
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+def add_file_data(
+    loaded_file: ExperimentFile,
+    sig_odors: list,
+    sig_data_df: pd.DataFrame,
+    dict_list: list,
+    dataset_type: str,
+) -> list:
+    """Adds the significant odors and data of a loaded file to the
+    experiment and odor ids of the dataset.
+
+    Args:
+        loaded_file: The ExperimentFile of the loaded file.
+        sig_odors: A list of all the significant odors from the experiment.
+        sig_data_df: A DataFrame containing only measurements for
+            significant responses.
         dict_list: A list of lists and dictionary that contains experimental
         data and the ids of significant experiments and odors.
         dataset_type: Chronic or acute experiment type.
 
     Returns:
-        appended_df_list: A list of a list of DataFrames, one list for each
-            measurement contained in analysis.xlsx. Values from each file are
-            appended as new rows in the DataFrames via ExperimentFile.sort_data().
-        appended_dict_list: A list of lists and dictionary containing experimental
-            data and the ids of significant experiments and odors. Experiment
-            and odor ids from each file are appended as new items in the list,
-            and significant data are appended with the experiment name as keys
-            in the dictionary, all done via ExperimentFile.sort_data().
-        bar_text: The text to display on the progress bar.
+        A list of lists and dictionary containing experimental data and the
+            ids of significant experiments and odors. Experiment and odor ids
+            from the file are appended as new items in the list, and
+            significant data are added with the experiment name as keys in the
+            dictionary.
     """
 
     if dataset_type == "acute":
@@ -116,13 +329,6 @@ def load_file(
     elif dataset_type == "chronic":
         nosig_exps, all_sig_odors, data_dict, all_exps = dict_list
 
-    loaded_file = ExperimentFile(file, dataset_type)
-    bar_text = f"Loading data from {loaded_file.exp_name}"
-
-    excel_dict = loaded_file.import_excel()
-    appended_df_list = loaded_file.sort_data(excel_dict, df_list)
-    sig_odors, sig_data_df = loaded_file.make_plotting_dfs(excel_dict)
-
     all_sig_odors.append(sig_odors)
 
     if dataset_type == "chronic":
@@ -143,48 +349,93 @@ def load_file(
     elif dataset_type == "chronic":
         appended_dict_list = nosig_exps, all_sig_odors, data_dict, all_exps
 
-    return appended_df_list, appended_dict_list, bar_text
+    return appended_dict_list
 
 
-def import_all_excel_data(dataset_type: str, files: list) -> tuple[list, list]:
-    """A wrapper for looping through all selected .xlsx files for importing
-    and processing via load_file.
-
-    New data for each .xlsx file are appended onto existing DataFrames and
-    dictionary via ExperimentFile.sort_data(), called by load_file.
+def import_all_excel_data(
+    dataset_type: str,
+    files: list,
+    n_workers: int = 1,
+) -> tuple[list, list]:
+    """A wrapper for loading all selected .xlsx files via load_files, then
+    collecting their data.
+
+    Files whose contents were already loaded are taken from
+    parsed_file_cache, so only new or changed files are parsed. The
+    DataFrames for each .xlsx file are collected in lists and concatenated
+    once per measurement after all files are loaded, and new data are
+    appended onto the dictionary via add_file_data, in the order of the
+    files (by date for chronic datasets).
 
     Args:
         dataset_type: Chronic or acute experiment type.
         files: A list of .xlsx files uploaded to Streamlit.
+        n_workers: The number of files to load at the same time.
 
     Returns:
         appended_df_list: A list of a list of DataFrames, one list for each
             measurement contained in analysis.xlsx
         appended_dict_list: A list of dictionaries containing experimental
             data and the ids of significant experiments and odors.
-        bar_text: The text to display on the progress bar.
     """
 
     dict_list = make_empty_containers(dataset_type)
 
-    # makes df for each measurement, for summary csv
-    df_list = [pd.DataFrame() for x in range(5)]
+    # collects dfs for each measurement, for summary csv
+    measure_df_lists = [[] for x in range(5)]
 
     if dataset_type == "chronic":
         files = sort_files_by_date(files)
 
-    # adds progress bar
-    load_bar = stqdm(files, desc="Loading ")
-    for file in load_bar:
-        # Get and append new values for each .xlsx file
-        appended_df_list, appended_dict_list, bar_text = load_file(
-            file, df_list, dict_list, dataset_type
+    measures = st.session_state.measures
+    loaded_files = [ExperimentFile(file, dataset_type) for file in files]
+    cache_keys = [
+        parsed_file_cache.make_key(
+            file.name, file.getvalue(), dataset_type, measures
         )
-        load_bar.set_description(bar_text, refresh=True)
+        for file in files
+    ]
+    all_results = [parsed_file_cache.get(key) for key in cache_keys]
+    new_file_cts = [
+        file_ct
+        for file_ct, results in enumerate(all_results)
+        if results is None
+    ]
+
+    # adds progress bar, updated as each file finishes loading
+    load_bar = stqdm(total=len(files), desc="Loading ")
+    load_bar.update(len(files) - len(new_file_cts))
+    for new_ct, results in load_files(
+        [files[file_ct] for file_ct in new_file_cts],
+        dataset_type,
+        measures,
+        n_workers,
+    ):
+        file_ct = new_file_cts[new_ct]
+        all_results[file_ct] = results
+        parsed_file_cache.put(cache_keys[file_ct], results)
+        load_bar.set_description(
+            f"Loaded data from {loaded_files[file_ct].exp_name}",
+            refresh=False,
+        )
+        load_bar.update()
+    load_bar.close()
+
+    # Get and append new values for each .xlsx file
+    for loaded_file, results in zip(loaded_files, all_results):
+        measure_dfs, sig_odors, sig_data_df = results
+
+        for measure_df_list, measure_df in zip(measure_df_lists, measure_dfs):
+            measure_df_list.append(measure_df)
 
-        # Save new data to be passed in again via the next loop
-        df_list = appended_df_list
-        dict_list = appended_dict_list
+        dict_list = add_file_data(
+            loaded_file, sig_odors, sig_data_df, dict_list, dataset_type
+        )
+
+    df_list = [
+        pd.concat(measure_df_list) if measure_df_list else pd.DataFrame()
+        for measure_df_list in measure_df_lists
+    ]
 
     return dict_list, df_list
 
@@ -292,6 +543,8 @@ def sort_measurements_df(
 
     odors_list = [f"Odor {x}" for x in range(1, 8)]
 
+    writer = ExcelSheetWriter(dir_path, xlsx_fname)
+
     for df_ct, df in enumerate(df_list):
         measure = measures[df_ct]
         if dataset_type == "chronic":
@@ -318,9 +571,9 @@ def sort_measurements_df(
         if dataset_type == "chronic":
             add_label = True
 
-        save_to_excel(
-            dir_path, sheetname, xlsx_fname, df, animal_id, add_label
-        )
+        writer.write_sheet(sheetname, df, animal_id, add_label)
+
+    writer.close()
 
 
 def generate_plots(
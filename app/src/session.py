@@ -0,0 +1,94 @@
+"""Contains the class for listing and classifying the files of an imaging
+session folder in one pass."""
+
+import os
+from pathlib import Path
+
+# Extensions of the files saved by the analysis
+OUTPUT_EXTENSIONS = (".xlsx", ".parquet", ".csv")
+
+
+class SessionIndex(object):
+    """Lists the files in a session folder once with os.scandir and sorts
+    them by type, so the folder doesn't have to be listed again for each step
+    of the analysis. Subfolders are not searched.
+
+    Attributes:
+        session_path (str): The path to the session folder.
+        trial_files (list): The names of the raw .txt files, one per trial,
+            sorted by name.
+        solenoid_files (list): The names of the solenoid_order .csv or
+            solenoid_info.txt files, sorted by name.
+        temp_files (list): The names of lock files made by Excel/LibreOffice
+            and ._ files made by macOS, which are never read.
+        output_files (list): The names of the .xlsx, .parquet and .csv files
+            saved by earlier analyses.
+        entries (dict): The os.DirEntry of each file, with file names as keys.
+    """
+
+    def __init__(self, session_path: str):
+        """Initializes an instance of SessionIndex() by listing the folder.
+
+        Args:
+            session_path: The path to the session folder.
+        """
+
+        self.session_path = session_path
+        self.trial_files = []
+        self.solenoid_files = []
+        self.temp_files = []
+        self.output_files = []
+        self.entries = {}
+
+        with os.scandir(session_path) as dir_entries:
+            for entry in dir_entries:
+                if entry.is_file():
+                    self.entries[entry.name] = entry
+
+        for filename in sorted(self.entries):
+            if ".~lock" in filename or filename.startswith("._"):
+                self.temp_files.append(filename)
+            elif "solenoid_order" in filename or (
+                "solenoid_info.txt" in filename
+            ):
+                self.solenoid_files.append(filename)
+            elif "solenoid" not in filename and filename.endswith(".txt"):
+                self.trial_files.append(filename)
+            elif filename.endswith(OUTPUT_EXTENSIONS):
+                self.output_files.append(filename)
+
+    @property
+    def solenoid_file(self):
+        """Path: The path to the solenoid order file, or None if there isn't
+        one. The last file by name is used if there are several."""
+        if not self.solenoid_files:
+            return None
+        return Path(self.session_path, self.solenoid_files[-1])
+
+    def get_path(self, filename: str) -> Path:
+        """Gets the full path of a file in the session folder.
+
+        Args:
+            filename: The name of the file.
+
+        Returns:
+            The path to the file.
+        """
+
+        return Path(self.session_path, filename)
+
+    def get_fingerprint(self, filename: str) -> list:
+        """Gets a fingerprint for detecting whether a file has changed, from
+        the stat info saved by os.scandir where the OS provides it.
+
+        Args:
+            filename: The name of the file.
+
+        Returns:
+            A list of the file's size in bytes and modification time in
+            nanoseconds.
+        """
+
+        stat = self.entries[filename].stat()
+
+        return [stat.st_size, stat.st_mtime_ns]
@@ -0,0 +1,450 @@
+"""Contains the resampling test of whether each odor's trial responses are
+larger than the blank's, for all samples at once.
+
+Each odor's per-trial deltaF values are compared to the blank's with either
+a trial-label permutation test or a bootstrap test of the difference of
+means. Resamples are drawn as label or weight matrices so that the means of
+all samples are taken in one matrix product, and blocks of resamples are
+spread over a process pool that reads the trial values from shared memory.
+p-values are corrected for the number of samples x odors tested with the
+Benjamini-Hochberg false discovery rate.
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from src.utils import attach_shared_array, share_array
+
+# Structured dtype holding the test values for one sample and odor
+TEST_DTYPE = np.dtype(
+    [
+        ("p_value", np.float64),
+        ("q_value", np.float64),
+        ("significant", np.bool_),
+    ]
+)
+
+# Labels of the test values in the _analysis output files
+TEST_LABELS = {
+    "p_value": "Trial test p-value",
+    "q_value": "Trial test FDR q-value",
+    "significant": "Trial test significant?",
+}
+
+# Number of resamples drawn at once by one worker
+BLOCK_SIZE = 1000
+
+
+class SignificanceTest(object):
+    """The settings of the resampling test against the blank.
+
+    Attributes:
+        method (str): "permutation" to shuffle the odor and blank labels of
+            the trials, or "bootstrap" to resample each group's trials with
+            replacement.
+        n_resamples (int): The number of permutations or bootstrap
+            resamples.
+        alpha (float): The false discovery rate at which a response is
+            significant.
+        seed (int): The seed of the random resamples.
+        n_workers (int): The number of processes drawing resamples.
+    """
+
+    def __init__(
+        self,
+        method: str = "permutation",
+        n_resamples: int = 10000,
+        alpha: float = 0.05,
+        seed: int = 0,
+        n_workers: int = 1,
+    ):
+        """Initializes an instance of SignificanceTest().
+
+        Args:
+            method: "permutation" or "bootstrap".
+            n_resamples: The number of permutations or bootstrap resamples.
+            alpha: The false discovery rate at which a response is
+                significant.
+            seed: The seed of the random resamples.
+            n_workers: The number of processes drawing resamples.
+        """
+
+        if method not in ["permutation", "bootstrap"]:
+            raise ValueError(f"Unknown test method {method}")
+        self.method = method
+        self.n_resamples = int(n_resamples)
+        self.alpha = float(alpha)
+        self.seed = int(seed)
+        self.n_workers = int(n_workers)
+
+        if self.n_resamples < 1:
+            raise ValueError("n_resamples must be >= 1")
+        if not 0 < self.alpha < 1:
+            raise ValueError("alpha must be between 0 and 1")
+
+    def to_dict(self) -> dict:
+        """Gets the settings that change the results as a dict that can be
+        saved as JSON.
+
+        Returns:
+            The settings, with attribute names as keys.
+        """
+
+        return {
+            "method": self.method,
+            "n_resamples": self.n_resamples,
+            "alpha": self.alpha,
+            "seed": self.seed,
+        }
+
+
+def test_against_blank(
+    trial_values: np.ndarray,
+    odor_ids: np.ndarray,
+    odors: np.ndarray,
+    test: SignificanceTest,
+) -> np.ndarray:
+    """Tests whether each odor's trial values are larger than the blank's,
+    for all samples and odors.
+
+    The statistic is the mean of the odor's trials minus the mean of the
+    blank's trials, skipping NaN values, and the p-value is one-sided.
+
+    Args:
+        trial_values: The value of each trial, e.g. its deltaF, with shape
+            (trials, samples).
+        odor_ids: The odor # of each trial.
+        odors: The odor #s, in order, with the blank last.
+        test: The settings of the test.
+
+    Returns:
+        A structured array with TEST_DTYPE and shape (samples, odors). The
+        blank has NaN p- and q-values.
+    """
+
+    p_values = get_p_values(trial_values, odor_ids, odors, test)
+
+    return make_test_results(p_values, test.alpha)
+
+
+def update_tests(
+    results: np.ndarray,
+    trial_values: np.ndarray,
+    odor_ids: np.ndarray,
+    odors: np.ndarray,
+    odor_mask: np.ndarray,
+    test: SignificanceTest,
+) -> np.ndarray:
+    """Tests again only the odors selected by odor_mask, keeping earlier
+    p-values for the others, and corrects all p-values again.
+
+    Since each odor has its own seeds, the kept p-values are the same as
+    testing all odors again. If the blank is selected, all odors are tested
+    again.
+
+    Args:
+        results: The earlier test values, a structured array with
+            TEST_DTYPE and shape (samples, odors).
+        trial_values: The value of each trial, with shape (trials, samples).
+        odor_ids: The odor # of each trial.
+        odors: The odor #s, in order, with the blank last.
+        odor_mask: Which odors to test again.
+        test: The settings of the test.
+
+    Returns:
+        The updated test values, with the same shape as results.
+    """
+
+    if odor_mask[-1]:
+        return test_against_blank(trial_values, odor_ids, odors, test)
+
+    p_values = results["p_value"].copy()
+    odor_cols = np.append(np.flatnonzero(odor_mask), len(odors) - 1)
+    p_values[:, odor_cols] = get_p_values(
+        trial_values, odor_ids, odors[odor_cols], test
+    )
+
+    return make_test_results(p_values, test.alpha)
+
+
+def get_p_values(
+    trial_values: np.ndarray,
+    odor_ids: np.ndarray,
+    odors: np.ndarray,
+    test: SignificanceTest,
+) -> np.ndarray:
+    """Draws the resamples of every odor and calculates the p-values.
+
+    The p-values don't depend on n_workers, since each block of resamples
+    has its own seed.
+
+    Args:
+        trial_values: The value of each trial, with shape (trials, samples).
+        odor_ids: The odor # of each trial.
+        odors: The odor #s to test, in order, with the blank last.
+        test: The settings of the test.
+
+    Returns:
+        The p-values with shape (samples, odors), NaN for the blank and
+        where the odor or blank has no values.
+    """
+
+    trial_values = np.ascontiguousarray(trial_values, dtype=np.float64)
+    n_samples = trial_values.shape[1]
+
+    block_sizes = [BLOCK_SIZE] * (test.n_resamples // BLOCK_SIZE)
+    if test.n_resamples % BLOCK_SIZE:
+        block_sizes.append(test.n_resamples % BLOCK_SIZE)
+    seeds = np.random.SeedSequence(test.seed).spawn(len(block_sizes))
+    block_args = [
+        (odor_ids, odors, test.method, n_block, block_seed)
+        for n_block, block_seed in zip(block_sizes, seeds)
+    ]
+
+    counts = np.zeros((n_samples, len(odors)), dtype=np.int64)
+    if test.n_workers <= 1 or len(block_args) <= 1:
+        for args in block_args:
+            counts += count_extreme_resamples(trial_values, *args)
+    else:
+        with share_array(trial_values) as handle, ProcessPoolExecutor(
+            max_workers=test.n_workers
+        ) as executor:
+            futures = [
+                executor.submit(count_shared_resamples, handle, *args)
+                for args in block_args
+            ]
+            for future in futures:
+                counts += future.result()
+
+    # counts the observed labels as one of the resamples
+    p_values = (counts + 1) / (test.n_resamples + 1)
+    p_values[:, -1] = np.nan
+
+    observed = get_mean_differences(trial_values, odor_ids, odors)
+    p_values[np.isnan(observed)] = np.nan
+
+    return p_values
+
+
+def make_test_results(p_values: np.ndarray, alpha: float) -> np.ndarray:
+    """Corrects the p-values of all samples and odors together and finds
+    the significant responses.
+
+    Args:
+        p_values: The p-values with shape (samples, odors).
+        alpha: The false discovery rate at which a response is significant.
+
+    Returns:
+        A structured array with TEST_DTYPE and the shape of p_values.
+    """
+
+    results = np.empty(p_values.shape, dtype=TEST_DTYPE)
+    results["p_value"] = p_values
+    results["q_value"] = fdr_correct(p_values)
+    results["significant"] = results["q_value"] <= alpha
+
+    return results
+
+
+def count_shared_resamples(
+    handle: dict,
+    odor_ids: np.ndarray,
+    odors: np.ndarray,
+    method: str,
+    n_resamples: int,
+    seed: np.random.SeedSequence,
+) -> np.ndarray:
+    """Runs count_extreme_resamples() in a worker process on trial values
+    held in shared memory.
+
+    Args:
+        handle: The dict describing the shared trial values, with shape
+            (trials, samples).
+        odor_ids: The odor # of each trial.
+        odors: The odor #s, in order, with the blank last.
+        method: "permutation" or "bootstrap".
+        n_resamples: The number of resamples to draw.
+        seed: The seed of this block of resamples.
+
+    Returns:
+        The counts of resamples at least as extreme as the observed
+        difference, with shape (samples, odors).
+    """
+
+    trial_values, shm = attach_shared_array(handle)
+    try:
+        counts = count_extreme_resamples(
+            trial_values, odor_ids, odors, method, n_resamples, seed
+        )
+    finally:
+        del trial_values
+        if shm is not None:
+            shm.close()
+
+    return counts
+
+
+def count_extreme_resamples(
+    trial_values: np.ndarray,
+    odor_ids: np.ndarray,
+    odors: np.ndarray,
+    method: str,
+    n_resamples: int,
+    seed: np.random.SeedSequence,
+) -> np.ndarray:
+    """Draws one block of resamples for every odor and counts those with a
+    difference of means at least as large as the observed one.
+
+    For the permutation test, each resample is a 0/1 matrix of which trials
+    are labelled as the odor. For the bootstrap test, each resample is a
+    matrix of how many times each trial is drawn, and the difference is
+    taken from the observed means of each group so that it is centered on
+    no difference. The means of all samples are then matrix products of the
+    resamples with the trial values and with their non-NaN mask. Each odor
+    draws from its own seed, made from the block's seed and the odor #.
+
+    Args:
+        trial_values: The value of each trial, with shape (trials, samples).
+        odor_ids: The odor # of each trial.
+        odors: The odor #s, in order, with the blank last.
+        method: "permutation" or "bootstrap".
+        n_resamples: The number of resamples to draw.
+        seed: The seed of this block of resamples.
+
+    Returns:
+        The counts with shape (samples, odors). The blank's counts are 0.
+    """
+
+    is_valid = ~np.isnan(trial_values)
+    values = np.where(is_valid, trial_values, 0.0)
+    is_valid = is_valid.astype(np.float64)
+
+    blank_rows = np.flatnonzero(odor_ids == odors[-1])
+    n_blank = len(blank_rows)
+    counts = np.zeros((trial_values.shape[1], len(odors)), dtype=np.int64)
+
+    for odor_ct, odor in enumerate(odors[:-1]):
+        odor_rows = np.flatnonzero(odor_ids == odor)
+        n_odor = len(odor_rows)
+        rows = np.concatenate([odor_rows, blank_rows])
+        rng = np.random.default_rng(
+            np.random.SeedSequence(
+                seed.entropy, spawn_key=(*seed.spawn_key, int(odor))
+            )
+        )
+        observed = weighted_mean(
+            np.ones((1, n_odor)), values[odor_rows], is_valid[odor_rows]
+        ) - weighted_mean(
+            np.ones((1, n_blank)), values[blank_rows], is_valid[blank_rows]
+        )
+
+        if method == "permutation":
+            # the n_odor trials with the smallest keys get the odor label
+            keys = rng.random((n_resamples, n_odor + n_blank))
+            kth = np.partition(keys, n_odor - 1, axis=1)[:, [n_odor - 1]]
+            odor_weights = (keys <= kth).astype(np.float64)
+            blank_weights = 1.0 - odor_weights
+            odor_means = weighted_mean(
+                odor_weights, values[rows], is_valid[rows]
+            )
+            blank_means = weighted_mean(
+                blank_weights, values[rows], is_valid[rows]
+            )
+            differences = odor_means - blank_means
+        else:
+            odor_weights = rng.multinomial(
+                n_odor, np.full(n_odor, 1 / n_odor), size=n_resamples
+            ).astype(np.float64)
+            blank_weights = rng.multinomial(
+                n_blank, np.full(n_blank, 1 / n_blank), size=n_resamples
+            ).astype(np.float64)
+            odor_means = weighted_mean(
+                odor_weights, values[odor_rows], is_valid[odor_rows]
+            )
+            blank_means = weighted_mean(
+                blank_weights, values[blank_rows], is_valid[blank_rows]
+            )
+            differences = odor_means - blank_means - observed
+
+        counts[:, odor_ct] = np.sum(differences >= observed, axis=0)
+
+    return counts
+
+
+def weighted_mean(
+    weights: np.ndarray, values: np.ndarray, is_valid: np.ndarray
+) -> np.ndarray:
+    """Takes the weighted means of the trials of all samples for many sets
+    of weights at once, skipping NaN values.
+
+    Args:
+        weights: The weight of each trial, with shape (resamples, trials).
+        values: The trial values with NaN set to 0, with shape
+            (trials, samples).
+        is_valid: 1.0 where the trial value isn't NaN, else 0.0.
+
+    Returns:
+        The means with shape (resamples, samples), NaN where no weighted
+        trial has a value.
+    """
+
+    totals = weights @ values
+    n_obs = weights @ is_valid
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return np.where(n_obs > 0, totals / n_obs, np.nan)
+
+
+def get_mean_differences(
+    trial_values: np.ndarray, odor_ids: np.ndarray, odors: np.ndarray
+) -> np.ndarray:
+    """Calculates each odor's mean trial value minus the blank's.
+
+    Args:
+        trial_values: The value of each trial, with shape (trials, samples).
+        odor_ids: The odor # of each trial.
+        odors: The odor #s, in order, with the blank last.
+
+    Returns:
+        The differences with shape (samples, odors), 0 for the blank.
+    """
+
+    is_valid = ~np.isnan(trial_values)
+    values = np.where(is_valid, trial_values, 0.0)
+    weights = (odor_ids[np.newaxis, :] == odors[:, np.newaxis]).astype(
+        np.float64
+    )
+    means = weighted_mean(weights, values, is_valid.astype(np.float64))
+
+    return (means - means[-1]).T
+
+
+def fdr_correct(p_values: np.ndarray) -> np.ndarray:
+    """Corrects p-values for multiple comparisons with the
+    Benjamini-Hochberg false discovery rate.
+
+    Args:
+        p_values: The p-values of all tests, any shape. NaN values aren't
+            counted as tests.
+
+    Returns:
+        The q-values, with the shape of p_values and NaN where p_values is
+        NaN.
+    """
+
+    flat_p = p_values.reshape(-1)
+    tested = np.flatnonzero(~np.isnan(flat_p))
+    q_values = np.full(flat_p.shape, np.nan)
+    if len(tested) == 0:
+        return q_values.reshape(p_values.shape)
+
+    order = tested[np.argsort(flat_p[tested], kind="stable")]
+    ranks = np.arange(1, len(order) + 1)
+    scaled = flat_p[order] * len(order) / ranks
+    # q-values can't decrease with p, so takes the running min from the top
+    q_values[order] = np.minimum(
+        np.minimum.accumulate(scaled[::-1])[::-1], 1.0
+    )
+
+    return q_values.reshape(p_values.shape)
@@ -0,0 +1,227 @@
+"""Tries a grid of analysis window settings on one analyzed imaging session
+in one batched sweep, without reading the .txt files again.
+
+The avg means are read from the session's _avg_means.parquet file, and the
+baseline, peak, deltaF/F, significance and AUC of every sample and odor are
+calculated for every combination of settings. The results are saved to a
+_window_sweep.csv file in the session folder, with one row per setting,
+sample and odor.
+
+Run from the app folder, e.g.:
+    python -m src.sweep /Users/Bob/Documents/GCaMP6s/231017--123456-7-8_ROI1
+        --baseline-last 40 52 --peak-last 200 300
+"""
+
+import argparse
+from itertools import product
+
+import numpy as np
+import pandas as pd
+
+from src.analysis import (
+    AnalysisConfig,
+    ANALYSIS_LABELS,
+    SWEEP_DTYPE,
+    sweep_windows,
+)
+from src.session import SessionIndex
+from src.utils import save_to_csv
+
+# Column labels of the settings in the _window_sweep.csv file
+SETTING_LABELS = [
+    "Last baseline frame",
+    "First peak frame",
+    "Last peak frame",
+    "Last AUC frame",
+    "Frame period (s)",
+]
+
+
+def load_avg_cube(session_path: str) -> tuple[str, np.ndarray, list, list]:
+    """Reads the avg means of an analyzed session into one array.
+
+    Args:
+        session_path: Path to the session folder.
+
+    Returns:
+        A tuple containing the file prefix of the session, the avg means
+        with shape (samples, odors, frames), the sample labels and the
+        odor #s.
+    """
+
+    session_index = SessionIndex(session_path)
+    avg_means_files = [
+        x
+        for x in session_index.output_files
+        if x.endswith("_avg_means.parquet")
+    ]
+    if not avg_means_files:
+        raise Exception(
+            "No _avg_means.parquet file found, analyze the session first"
+        )
+
+    avg_means_file = avg_means_files[-1]
+    file_prefix = avg_means_file.removesuffix("_avg_means.parquet")
+
+    avg_means = pd.read_parquet(session_index.get_path(avg_means_file))
+    avg_means.sort_values(by=["Odor", "Frame"], inplace=True)
+    odors = avg_means["Odor"].unique().tolist()
+    samples = [x for x in avg_means.columns if x not in ["Odor", "Frame"]]
+
+    n_frames = len(avg_means) // len(odors)
+    avg_cube = (
+        avg_means[samples]
+        .to_numpy(dtype=np.float64)
+        .reshape(len(odors), n_frames, len(samples))
+        .transpose(2, 0, 1)
+    )
+
+    return file_prefix, avg_cube, samples, odors
+
+
+def make_configs(
+    baseline_lasts: list,
+    peak_firsts: list,
+    peak_lasts: list,
+    auc_lasts: list,
+    frame_periods: list,
+) -> list:
+    """Makes the analysis settings for every combination of windows and
+    frame rates.
+
+    Args:
+        baseline_lasts: The last baseline frames to try.
+        peak_firsts: The first frames of the peak window to try.
+        peak_lasts: The last frames of the peak window to try.
+        auc_lasts: The last frames of the area under curve to try.
+        frame_periods: The times between frames to try, in seconds.
+
+    Returns:
+        A list of AnalysisConfig, one per combination.
+    """
+
+    combinations = product(
+        baseline_lasts, peak_firsts, peak_lasts, auc_lasts, frame_periods
+    )
+
+    return [
+        AnalysisConfig(
+            baseline_frames=(1, baseline_last),
+            peak_frames=(peak_first, peak_last),
+            auc_frames=(1, auc_last),
+            frame_period=frame_period,
+        )
+        for baseline_last, peak_first, peak_last, auc_last, frame_period in (
+            combinations
+        )
+    ]
+
+
+def sweep_session(session_path: str, configs: list) -> pd.DataFrame:
+    """Calculates the window-based values of an analyzed session for
+    several analysis settings and saves them as a _window_sweep.csv file.
+
+    Args:
+        session_path: Path to the session folder.
+        configs: The AnalysisConfig of each setting to try.
+
+    Returns:
+        A DataFrame with the settings, Sample and Odor columns and one
+        column per value, with one row per setting, sample and odor.
+    """
+
+    file_prefix, avg_cube, samples, odors = load_avg_cube(session_path)
+    results = sweep_windows(avg_cube, configs)
+    n_configs, n_samples, n_odors = results.shape
+
+    settings = np.array(
+        [
+            [
+                x.baseline_frames[1],
+                x.peak_frames[0],
+                x.peak_frames[1],
+                x.auc_frames[1],
+                x.frame_period,
+            ]
+            for x in configs
+        ],
+        dtype=object,
+    )
+    sweep_df = pd.DataFrame(
+        np.repeat(settings, n_samples * n_odors, axis=0),
+        columns=SETTING_LABELS,
+    )
+    sweep_df["Sample"] = np.tile(np.repeat(samples, n_odors), n_configs)
+    sweep_df["Odor"] = np.tile(odors, n_configs * n_samples)
+
+    results = results.reshape(-1)
+    for field in SWEEP_DTYPE.names:
+        sweep_df[ANALYSIS_LABELS[field]] = results[field]
+
+    save_to_csv(f"{file_prefix}_window_sweep.csv", session_path, sweep_df)
+
+    return sweep_df
+
+
+def main():
+    defaults = AnalysisConfig()
+    parser = argparse.ArgumentParser(
+        description="Try several analysis windows and frame rates on an "
+        "analyzed session."
+    )
+    parser.add_argument("session_path", help="Path to the session folder.")
+    parser.add_argument(
+        "--baseline-last",
+        type=int,
+        nargs="+",
+        default=[defaults.baseline_frames[1]],
+        help="Last baseline frames to try, counting from 1.",
+    )
+    parser.add_argument(
+        "--peak-first",
+        type=int,
+        nargs="+",
+        default=[defaults.peak_frames[0]],
+        help="First frames of the peak window to try.",
+    )
+    parser.add_argument(
+        "--peak-last",
+        type=int,
+        nargs="+",
+        default=[defaults.peak_frames[1]],
+        help="Last frames of the peak window to try.",
+    )
+    parser.add_argument(
+        "--auc-last",
+        type=int,
+        nargs="+",
+        default=[defaults.auc_frames[1]],
+        help="Last frames of the area under curve to try.",
+    )
+    parser.add_argument(
+        "--frame-period",
+        type=float,
+        nargs="+",
+        default=[defaults.frame_period],
+        help="Times between frames to try, in seconds.",
+    )
+    args = parser.parse_args()
+
+    configs = make_configs(
+        args.baseline_last,
+        args.peak_first,
+        args.peak_last,
+        args.auc_last,
+        args.frame_period,
+    )
+    sweep_df = sweep_session(args.session_path, configs)
+
+    summary = sweep_df.groupby(SETTING_LABELS, sort=False)[
+        ANALYSIS_LABELS["significant"]
+    ].sum()
+    print(f"Significant responses for {len(configs)} settings:")
+    print(summary.to_string())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,283 @@
+"""Contains the class for grouping the trials of an imaging session by odor."""
+
+import numpy as np
+import pandas as pd
+
+
+def add_compensated(
+    sums: np.ndarray,
+    compensation: np.ndarray,
+    n_obs: np.ndarray,
+    values: np.ndarray,
+) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Adds values to running sums with Kahan compensation, skipping NaN
+    values.
+
+    Args:
+        sums: The running sums.
+        compensation: The Kahan compensation of each running sum.
+        n_obs: The number of values added to each running sum.
+        values: The values to add, with the same shape as sums.
+
+    Returns:
+        A tuple containing the updated sums, compensation and n_obs.
+    """
+
+    is_value = ~np.isnan(values)
+    values = np.where(is_value, values, 0.0)
+
+    y = values - compensation
+    t = sums + y
+    new_compensation = t - sums - y
+    # compensation is NaN if values are infinite
+    new_compensation[np.isnan(new_compensation)] = 0
+
+    sums = np.where(is_value, t, sums)
+    compensation = np.where(is_value, new_compensation, compensation)
+
+    return sums, compensation, n_obs + is_value
+
+
+class OdorGroups(object):
+    """Sorts the trials of a session by odor once and averages each odor's
+    trials for every sample in one pass.
+
+    Attributes:
+        sorted_cube (np.ndarray): The fluorescence values of all trials,
+            sorted by odor # then trial #, with shape (trials, frames,
+            samples), or None if the trials weren't kept.
+        trial_ids (np.ndarray): The trial # of each row in sorted_cube.
+        odor_ids (np.ndarray): The odor # of each row in sorted_cube.
+        odors (np.ndarray): The odor #s delivered in the session, in order.
+        starts (np.ndarray): The first row of each odor in sorted_cube.
+        counts (np.ndarray): The number of trials for each odor.
+        avg_cube (np.ndarray): The mean of mean fluorescence values for each
+            odor, with shape (samples, odors, frames).
+        frames (pd.Index): The frame #s, used as the index of per-sample
+            DataFrames.
+        raw_columns (pd.MultiIndex): The (Odor, Trial) columns of per-sample
+            raw means.
+        avg_columns (pd.Index): The Odor columns of per-sample avg means.
+    """
+
+    def __init__(
+        self,
+        trial_cube: np.ndarray,
+        trial_ids: np.ndarray,
+        odor_ids: np.ndarray,
+        avg_cube: np.ndarray = None,
+        changed_odors: np.ndarray = None,
+        is_sorted: bool = False,
+    ):
+        """Initializes an instance of OdorGroups() for one session.
+
+        Args:
+            trial_cube: The fluorescence values of all trials, with shape
+                (trials, frames, samples). Can be None if avg_cube is given
+                without changed_odors.
+            trial_ids: The trial # of each row in trial_cube.
+            odor_ids: The odor # of each row in trial_cube.
+            avg_cube: The avg means from an earlier run with the same odors,
+                to reuse for odors that haven't changed, or the avg means of
+                all odors if changed_odors is None.
+            changed_odors: The odor #s to average again when avg_cube is
+                given.
+            is_sorted: Whether the rows of trial_cube are already sorted by
+                odor # then trial #, e.g. in a memory-mapped file, so it is
+                used as is instead of being copied in sorted order.
+        """
+
+        # sorts trials by odor #, then trial #
+        order = np.lexsort((trial_ids, odor_ids))
+        if trial_cube is None or is_sorted:
+            self.sorted_cube = trial_cube
+        else:
+            self.sorted_cube = trial_cube[order]
+        self.trial_ids = trial_ids[order]
+        self.odor_ids = odor_ids[order]
+
+        self.odors, self.starts, self.counts = np.unique(
+            self.odor_ids, return_index=True, return_counts=True
+        )
+
+        if avg_cube is None:
+            self.avg_cube = self.average_trials()
+        elif changed_odors is None:
+            self.avg_cube = avg_cube
+        else:
+            odor_mask = np.isin(self.odors, changed_odors)
+            self.avg_cube = np.array(avg_cube, dtype=np.float64)
+            self.avg_cube[:, odor_mask] = self.average_trials(odor_mask)
+
+        self.frames = pd.RangeIndex(
+            1, self.avg_cube.shape[2] + 1, name="Frame"
+        )
+        self.raw_columns = pd.MultiIndex.from_arrays(
+            [self.odor_ids, self.trial_ids], names=["Odor", "Trial"]
+        )
+        self.avg_columns = pd.Index(self.odors, name="Odor")
+
+    def average_trials(self, odor_mask: np.ndarray = None) -> np.ndarray:
+        """Averages the trials of each odor for all samples at once.
+
+        Trials are summed in order with Kahan compensation and NaN values are
+        skipped, which gives the same numbers as a pandas groupby mean.
+
+        Args:
+            odor_mask: Which odors to average, all odors if None.
+
+        Returns:
+            The mean of mean fluorescence values for each selected odor, with
+            shape (samples, odors, frames).
+        """
+
+        starts, counts = self.starts, self.counts
+        if odor_mask is not None:
+            starts, counts = starts[odor_mask], counts[odor_mask]
+
+        n_frames, n_samples = self.sorted_cube.shape[1:]
+        shape = (len(counts), n_frames, n_samples)
+        sums = np.zeros(shape)
+        compensation = np.zeros(shape)
+        n_obs = np.zeros(shape, dtype=np.int64)
+
+        # adds the k-th trial of every odor that has at least k trials
+        for trial_ct in range(counts.max(initial=0)):
+            has_trial = counts > trial_ct
+            rows = starts[has_trial] + trial_ct
+            (
+                sums[has_trial],
+                compensation[has_trial],
+                n_obs[has_trial],
+            ) = add_compensated(
+                sums[has_trial],
+                compensation[has_trial],
+                n_obs[has_trial],
+                self.sorted_cube[rows],
+            )
+
+        with np.errstate(invalid="ignore", divide="ignore"):
+            means = sums / n_obs
+
+        return np.ascontiguousarray(means.transpose(2, 0, 1))
+
+    def raw_means(self, n_count: int) -> pd.DataFrame:
+        """Gets the raw mean fluorescence values of one sample.
+
+        Args:
+            n_count: The index of the sample.
+
+        Returns:
+            A DataFrame viewing sorted_cube, with Frame as index and
+            (Odor, Trial) as columns.
+        """
+
+        return pd.DataFrame(
+            self.sorted_cube[:, :, n_count].T,
+            index=self.frames,
+            columns=self.raw_columns,
+            copy=False,
+        )
+
+    def avg_means(self, n_count: int) -> pd.DataFrame:
+        """Gets the mean of mean fluorescence values of one sample.
+
+        Args:
+            n_count: The index of the sample.
+
+        Returns:
+            A DataFrame viewing avg_cube, with Frame as index and Odor as
+            columns.
+        """
+
+        return pd.DataFrame(
+            self.avg_cube[n_count].T,
+            index=self.frames,
+            columns=self.avg_columns,
+            copy=False,
+        )
+
+
+class RunningOdorMeans(object):
+    """Keeps running per-odor sums of trial fluorescence values, so trials can
+    be added one at a time, e.g. while a session is being acquired, without
+    keeping the trials in memory.
+
+    Trials are summed with Kahan compensation, so adding each odor's trials
+    in trial order gives the same means as OdorGroups.average_trials().
+
+    Attributes:
+        odors (np.ndarray): The odor #s of the session, in order. The last
+            odor is the blank.
+        sums (np.ndarray): The sum of each odor's trials, with shape (odors,
+            frames, samples).
+        compensation (np.ndarray): The Kahan compensation of each sum.
+        n_obs (np.ndarray): The number of non-NaN values in each sum.
+        trial_counts (np.ndarray): The number of trials added for each odor.
+    """
+
+    def __init__(self, odors: np.ndarray, n_frames: int, n_samples: int):
+        """Initializes an instance of RunningOdorMeans() with no trials.
+
+        Args:
+            odors: The odor #s of the session, in order.
+            n_frames: The number of frames in a trial.
+            n_samples: The number of samples in a trial.
+        """
+
+        self.odors = np.asarray(odors)
+        shape = (len(self.odors), n_frames, n_samples)
+        self.sums = np.zeros(shape)
+        self.compensation = np.zeros(shape)
+        self.n_obs = np.zeros(shape, dtype=np.int64)
+        self.trial_counts = np.zeros(len(self.odors), dtype=np.int64)
+
+    def add_trial(self, odor: int, values: np.ndarray, filename: str):
+        """Adds one trial to the running sums of its odor.
+
+        The running sums are grown if the trial has more frames than previous
+        ones, and NaN values are skipped.
+
+        Args:
+            odor: The odor # delivered in the trial.
+            values: The fluorescence values of the trial, with shape (frames,
+                samples).
+            filename: The name of the trial's .txt file, for error messages.
+        """
+
+        if values.shape[1] != self.sums.shape[2]:
+            raise Exception(
+                f"{filename} has {values.shape[1]} samples, expected "
+                f"{self.sums.shape[2]}"
+            )
+
+        if values.shape[0] > self.sums.shape[1]:
+            extra_frames = ((0, 0), (0, values.shape[0] - self.sums.shape[1]))
+            self.sums = np.pad(self.sums, (*extra_frames, (0, 0)))
+            self.compensation = np.pad(
+                self.compensation, (*extra_frames, (0, 0))
+            )
+            self.n_obs = np.pad(self.n_obs, (*extra_frames, (0, 0)))
+
+        odor_ct = np.searchsorted(self.odors, odor)
+        n_frames = values.shape[0]
+        (
+            self.sums[odor_ct, :n_frames],
+            self.compensation[odor_ct, :n_frames],
+            self.n_obs[odor_ct, :n_frames],
+        ) = add_compensated(
+            self.sums[odor_ct, :n_frames],
+            self.compensation[odor_ct, :n_frames],
+            self.n_obs[odor_ct, :n_frames],
+            values,
+        )
+        self.trial_counts[odor_ct] += 1
+
+    @property
+    def avg_cube(self):
+        """np.ndarray: The running mean of each odor's trials, with shape
+        (samples, odors, frames). Odors without trials yet are NaN."""
+        with np.errstate(invalid="ignore", divide="ignore"):
+            means = self.sums / self.n_obs
+
+        return np.ascontiguousarray(means.transpose(2, 0, 1))
@@ -2,9 +2,19 @@
 """
 
 from pathlib import Path
+from contextlib import contextmanager
+from multiprocessing import shared_memory
+import mmap
+from concurrent.futures import (
+    ThreadPoolExecutor,
+    ProcessPoolExecutor,
+    as_completed,
+)
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
 import os
-import openpyxl
 import streamlit as st
 import tkinter as tk
 from tkinter.filedialog import askdirectory
@@ -13,21 +23,19 @@ from tkinter.filedialog import askdirectory
 import pdb
 
 
-def check_solenoid_file(session_path):
+def check_solenoid_file(session_index):
     """Checks that solenoid. txt file is named properly and present.
 
     Args:
-        session_path (str): Path to the session directory.
+        session_index (SessionIndex): The listed files of the session
+            directory.
 
     Returns:
         A string containing the path to the solenoid file.
     """
 
-    solenoid_file = None
-    for filename in os.listdir(session_path):
-        # for new code with solenoid_order.csv file
-        if "solenoid_order" in filename or "solenoid_info.txt" in filename:
-            solenoid_file = Path(session_path, filename)
+    # for new code with solenoid_order.csv file or old solenoid_info.txt
+    solenoid_file = session_index.solenoid_file
 
     if solenoid_file is None:
         st.error(
@@ -40,7 +48,8 @@ def check_solenoid_file(session_path):
 
 
 def check_uploaded_files(files):
-    """Checks that all uploaded files end in _analysis.xlsx.
+    """Checks that all uploaded files are _analysis.xlsx or _analysis.parquet
+    files.
 
     Args:
         files (list): A list of file objects to check for correctness.
@@ -53,7 +62,8 @@ def check_uploaded_files(files):
     for file in files:
         if "_analysis" not in file.name:
             st.error(
-                "Please make sure all uploaded files end in '_analysis.xlsx'"
+                "Please make sure all uploaded files end in '_analysis.xlsx' "
+                "or '_analysis.parquet'"
             )
             files_correct = False
             break
@@ -63,73 +73,75 @@ def check_uploaded_files(files):
     return files_correct
 
 
-def save_to_excel(
-    dir_path,
-    sheetname,
-    xlsx_fname,
-    df,
-    animal_id=None,
-    add_label=False,
-):
-    """Saves measurement dfs as one sheet per measurement type into Excel file.
+class ExcelSheetWriter(object):
+    """Writes DataFrames as sheets of one .xlsx file in a single pass.
 
-    By default, to_excel sets NaN values to "" using na_rep="".
+    Sheets are written with pandas' bold, bordered header and index cells,
+    and one conditional format borders the other cells, so the file never
+    has to be reloaded for formatting. Any existing file with the same name
+    is replaced when the writer is closed.
 
-    Args:
-        dir_path (str): A path to directory to save file.
-        sheetname (str): The name of sheet to save df to.
-        xlsx_fname (str): The name of the xlsx file to save df to.
-        df (pd.DataFrame): The df to save.
-        animal_id (str): The animal id to use for file name formating.
-        add_label (bool): If True add label to sheet (default False).
+    Attributes:
+        xlsx_path (Path): The path of the .xlsx file.
+        writer (pd.ExcelWriter): The open xlsxwriter-backed Excel file.
+        border_format (xlsxwriter.format.Format): Bordered format for the
+            cells that aren't header or index cells.
     """
 
-    xlsx_path = Path(dir_path, xlsx_fname)
-    if os.path.isfile(xlsx_path):  # if it does, write to existing file
-        # if sheet already exists, overwrite it
-        with pd.ExcelWriter(
-            xlsx_path, mode="a", if_sheet_exists="replace"
-        ) as writer:
-            df.to_excel(writer, sheetname)
-    else:  # otherwise, write to new file
-        df.to_excel(xlsx_path, sheetname)
+    def __init__(self, dir_path, xlsx_fname):
+        """Opens a new .xlsx file for writing.
 
-    format_workbook(xlsx_path, animal_id, add_label)
+        Args:
+            dir_path (str): A path to directory to save file.
+            xlsx_fname (str): The name of the xlsx file to save to.
+        """
 
+        self.xlsx_path = Path(dir_path, xlsx_fname)
+        self.writer = pd.ExcelWriter(self.xlsx_path, engine="xlsxwriter")
 
-def format_workbook(xlsx_path, animal_id=None, add_label=False):
-    """Adds borders to Excel spreadsheets.
+        # Initialize formatting styles
+        self.border_format = self.writer.book.add_format({"border": 1})
 
-    Args:
-        xlsx_path (str): Path to the Excel file to be formatted.
-        animal_id (str): ID of the animal to be used in the format.
-        add_label (bool): If True adds label to A1 cell.
-    """
+    def write_sheet(self, sheetname, df, animal_id=None, add_label=False):
+        """Writes a df as one bordered sheet.
+
+        By default, NaN values are written as "" using na_rep="".
 
-    wb = openpyxl.load_workbook(xlsx_path)
+        Args:
+            sheetname (str): The name of sheet to save df to.
+            df (pd.DataFrame): The df to save.
+            animal_id (str): The animal id to use for file name formating.
+            add_label (bool): If True add label to sheet (default False).
+        """
 
-    # Initialize formatting styles
-    no_fill = openpyxl.styles.PatternFill(fill_type=None)
-    side = openpyxl.styles.Side(border_style="thin")
-    border = openpyxl.styles.borders.Border(
-        left=side,
-        right=side,
-        top=side,
-        bottom=side,
-    )
+        df.to_excel(self.writer, sheetname)
+        worksheet = self.writer.sheets[sheetname]
 
-    # Loop through all cells in all worksheets
-    for sheet in wb.worksheets:
         if add_label:
-            sheet["A1"] = animal_id
-        for row in sheet:
-            for cell in row:
-                # Apply colorless and borderless styles
-                cell.fill = no_fill
-                cell.border = border
+            worksheet.write(0, 0, animal_id, self.border_format)
+
+        # Borders also go on empty cells within the written area. Index
+        # names get their own row below multi-level column headers
+        last_row = len(df) + df.columns.nlevels - 1
+        if df.columns.nlevels > 1 and any(df.index.names):
+            last_row += 1
+        last_col = len(df.columns) + df.index.nlevels - 1
+        worksheet.conditional_format(
+            0,
+            0,
+            last_row,
+            last_col,
+            {
+                "type": "formula",
+                "criteria": "TRUE",
+                "format": self.border_format,
+            },
+        )
 
-    # Save workbook
-    wb.save(xlsx_path)
+    def close(self):
+        """Saves and closes the .xlsx file."""
+
+        self.writer.close()
 
 
 def check_sig_odors(odors_list, nosig_exps, files):
@@ -269,6 +281,196 @@ def read_txt_file(path: str) -> pd.DataFrame:
     return txt_df
 
 
+def read_txt_values(path: str) -> np.ndarray:
+    """Reads the fluorescence values of a single trial txt file.
+
+    Args:
+        path: Path to the txt file.
+
+    Returns:
+        An array of the txt file's values, with shape (frames, samples).
+
+    Raises:
+        ValueError: If the file can't be parsed into numeric values. The
+            message contains the name of the file.
+    """
+
+    try:
+        values = read_txt_file(path).to_numpy(dtype=np.float64)
+    except Exception as error_msg:
+        raise ValueError(f"Could not read {Path(path).name}: {error_msg}")
+
+    return values
+
+
+def read_txt_files(
+    paths: list, n_workers: int = 1, pool_type: str = "thread"
+):
+    """Reads trial txt files, optionally across a pool of workers.
+
+    Values are yielded as soon as each file has been parsed, so they may not
+    arrive in the order of paths; the index of each path is yielded with its
+    values. If a file fails to parse, the remaining files are cancelled and
+    the error is raised straight away.
+
+    Args:
+        paths: Paths to the txt files.
+        n_workers: The number of files to parse at the same time. 1 reads
+            the files one after another.
+        pool_type: "thread" or "process" pool for parsing files.
+
+    Yields:
+        A tuple (index, values) with the position of the file in paths and
+        its values, with shape (frames, samples).
+    """
+
+    if n_workers <= 1 or len(paths) <= 1:
+        for path_ct, path in enumerate(paths):
+            yield path_ct, read_txt_values(path)
+        return
+
+    if pool_type == "process":
+        executor = ProcessPoolExecutor(max_workers=n_workers)
+    else:
+        executor = ThreadPoolExecutor(max_workers=n_workers)
+
+    try:
+        futures = {
+            executor.submit(read_txt_values, path): path_ct
+            for path_ct, path in enumerate(paths)
+        }
+        for future in as_completed(futures):
+            yield futures[future], future.result()
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+def read_txt_files_in_order(
+    paths: list, n_workers: int = 1, pool_type: str = "thread"
+):
+    """Reads trial txt files like read_txt_files(), but yields them in the
+    order of paths.
+
+    Files that finish parsing early are held until every earlier file has
+    been yielded, e.g. so trials are summed in trial order.
+
+    Args:
+        paths: Paths to the txt files.
+        n_workers: The number of files to parse at the same time.
+        pool_type: "thread" or "process" pool for parsing files.
+
+    Yields:
+        A tuple (index, values) with the position of the file in paths and
+        its values, with shape (frames, samples).
+    """
+
+    waiting = {}
+    next_ct = 0
+    for path_ct, values in read_txt_files(paths, n_workers, pool_type):
+        waiting[path_ct] = values
+        while next_ct in waiting:
+            yield next_ct, waiting.pop(next_ct)
+            next_ct += 1
+
+
+def get_max_differences(
+    values: np.ndarray, other_values: np.ndarray
+) -> tuple[float, float]:
+    """Finds the largest absolute and relative differences between two
+    arrays, skipping NaN values.
+
+    Args:
+        values: The reference values.
+        other_values: The values to compare, with the same shape.
+
+    Returns:
+        A tuple containing the largest absolute difference and the largest
+        difference relative to the reference value, or NaN if there are no
+        values to compare.
+    """
+
+    values = np.asarray(values, dtype=np.float64)
+    diffs = np.abs(values - np.asarray(other_values, dtype=np.float64))
+    is_value = ~np.isnan(diffs)
+    if not is_value.any():
+        return np.nan, np.nan
+
+    nonzero = is_value & (values != 0)
+    max_rel_diff = 0.0
+    if nonzero.any():
+        max_rel_diff = np.max(diffs[nonzero] / np.abs(values[nonzero]))
+
+    return float(np.max(diffs[is_value])), float(max_rel_diff)
+
+
+@contextmanager
+def share_array(array: np.ndarray):
+    """Makes an array readable by worker processes without pickling a copy
+    of it for each task.
+
+    A memory-mapped .npy file is shared by its path, so workers map the same
+    file. Other arrays are copied once into a shared memory block, which is
+    removed when the with block exits.
+
+    Args:
+        array: The array to share.
+
+    Yields:
+        A dict describing the array, to pass to attach_shared_array() in the
+        workers.
+    """
+
+    handle = {"shape": array.shape, "dtype": array.dtype.str}
+
+    # only whole memory maps, not views of part of one, are shared by path
+    if isinstance(array, np.memmap) and isinstance(array.base, mmap.mmap):
+        handle.update(filename=array.filename, offset=array.offset)
+        yield handle
+        return
+
+    shm = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+    shared_array = np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf)
+    try:
+        shared_array[:] = array
+        del shared_array
+        handle.update(name=shm.name)
+        yield handle
+    finally:
+        shm.close()
+        shm.unlink()
+
+
+def attach_shared_array(
+    handle: dict,
+) -> tuple[np.ndarray, shared_memory.SharedMemory | None]:
+    """Opens an array shared by share_array() in a worker process.
+
+    Args:
+        handle: The dict describing the array.
+
+    Returns:
+        A tuple containing the read-only array and the shared memory block
+        to close once the array is no longer used, or None if the array is
+        memory-mapped from a file.
+    """
+
+    if "filename" in handle:
+        array = np.memmap(
+            handle["filename"],
+            dtype=handle["dtype"],
+            mode="r",
+            offset=handle["offset"],
+            shape=handle["shape"],
+        )
+        return array, None
+
+    shm = shared_memory.SharedMemory(name=handle["name"])
+    array = np.ndarray(handle["shape"], dtype=handle["dtype"], buffer=shm.buf)
+    array.flags.writeable = False
+
+    return array, shm
+
+
 def save_to_csv(fname: str, path: str, df: pd.DataFrame):
     """Saves a dataframe to a csv file.
 
@@ -281,3 +483,67 @@ def save_to_csv(fname: str, path: str, df: pd.DataFrame):
     csv_path = Path(path, fname)
 
     df.to_csv(csv_path, index=False)
+
+
+def save_to_parquet(fname: str, path: str, df: pd.DataFrame):
+    """Saves a dataframe to a Parquet file, keeping its column dtypes.
+
+    Args:
+        fname: The name of the Parquet file.
+        path: The path to save the Parquet file to.
+        df: The dataframe to save to the Parquet file.
+    """
+
+    parquet_path = Path(path, fname)
+
+    df.to_parquet(parquet_path, index=False)
+
+
+def save_blocks_to_parquet(fname: str, path: str, dfs):
+    """Saves dataframes with the same columns to one Parquet file, one row
+    group at a time, so the whole table is never held in memory.
+
+    Args:
+        fname: The name of the Parquet file.
+        path: The path to save the Parquet file to.
+        dfs: An iterable of the dataframes to save, in row order.
+    """
+
+    parquet_path = Path(path, fname)
+
+    writer = None
+    try:
+        for df in dfs:
+            table = pa.Table.from_pandas(df, preserve_index=False)
+            if writer is None:
+                writer = pq.ParquetWriter(parquet_path, table.schema)
+            writer.write_table(table)
+    finally:
+        if writer is not None:
+            writer.close()
+
+
+def find_parquet_file(file):
+    """Finds the Parquet file to read in place of an .xlsx output file.
+
+    Args:
+        file: The path to an .xlsx or .parquet file, or an uploaded file
+            object.
+
+    Returns:
+        The file itself if it is a .parquet file, the path to the .parquet
+        file saved next to it if the file is a path to an .xlsx file that has
+        one, else None.
+    """
+
+    fname = getattr(file, "name", str(file))
+    if fname.endswith(".parquet"):
+        return file
+
+    # uploaded files have no folder to look for a Parquet file in
+    if isinstance(file, (str, os.PathLike)):
+        parquet_path = Path(file).with_suffix(".parquet")
+        if parquet_path.is_file():
+            return parquet_path
+
+    return None
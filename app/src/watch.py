@@ -0,0 +1,157 @@
+"""Contains the class for analyzing the trials of an imaging session as they
+are saved during acquisition."""
+
+import numpy as np
+import pandas as pd
+
+from src.analysis import analyze_responses
+from src.experiment import RawFolder
+from src.session import SessionIndex
+from src.trials import RunningOdorMeans
+from src.utils import read_txt_values
+
+
+class LiveSession(object):
+    """Watches a session folder by polling it, folds each new trial .txt file
+    into running per-odor means, and analyzes the running means of all
+    samples.
+
+    Polling is used instead of file system events so that folders on network
+    drives, where events often aren't delivered, can be watched too. A trial
+    file is only read once its size and modification time are the same on two
+    polls in a row, so files still being saved aren't read.
+
+    Attributes:
+        data (RawFolder): The session being watched, with its solenoid order
+            already read.
+        odors (np.ndarray): The odor #s in the solenoid order, in order.
+        running_means (RunningOdorMeans): The running per-odor sums, or None
+            until the first trial is read.
+        added_files (list): The names of the trial files already read or
+            dropped, in the order they were added.
+        pending_files (dict): The fingerprints of trial files seen but not yet
+            read, with file names as keys.
+        analysis_results (np.ndarray): The analysis values of the running
+            means for each sample and odor, a structured array with shape
+            (samples, odors).
+    """
+
+    def __init__(self, data: RawFolder):
+        """Initializes an instance of LiveSession() for one session.
+
+        Args:
+            data: The session to watch, with get_solenoid_order() already
+                run.
+        """
+
+        if not data.solenoid_order:
+            raise Exception("No solenoid order found for this session")
+
+        self.data = data
+        self.odors = np.unique(data.solenoid_order)
+        self.running_means = None
+        self.added_files = []
+        self.pending_files = {}
+        self.analysis_results = None
+
+    @property
+    def n_trials(self):
+        """int: The number of trials in the solenoid order."""
+        return len(self.data.solenoid_order)
+
+    @property
+    def is_complete(self):
+        """bool: Whether every trial in the solenoid order has been added."""
+        return len(self.added_files) >= self.n_trials
+
+    def poll(self) -> list:
+        """Lists the session folder and adds any trial files that have
+        finished saving, then analyzes the updated running means.
+
+        Returns:
+            The names of the trial files added in this poll, sorted by
+            trial #.
+        """
+
+        self.data.session_index = SessionIndex(self.data.session_path)
+        self.data.map_trial_files(verbose=False)
+
+        new_files = []
+        for filename in sorted(
+            self.data.trial_numbers, key=self.data.trial_numbers.get
+        ):
+            if filename in self.added_files:
+                continue
+
+            # waits until the file is unchanged since the last poll
+            fingerprint = self.data.session_index.get_fingerprint(filename)
+            if self.pending_files.get(filename) != fingerprint:
+                self.pending_files[filename] = fingerprint
+                continue
+            del self.pending_files[filename]
+
+            trial_num = self.data.trial_numbers[filename]
+            if trial_num >= self.n_trials:
+                raise Exception(
+                    f"{filename} is trial {trial_num + 1} but solenoid order "
+                    f"only has {self.n_trials} trials"
+                )
+
+            self.added_files.append(filename)
+            if trial_num + 1 in self.data.drop_trials_list:
+                continue
+
+            self.add_trial(filename, self.data.solenoid_order[trial_num])
+            new_files.append(filename)
+
+        if new_files:
+            self.analysis_results = analyze_responses(
+                self.running_means.avg_cube,
+                self.data.sustained_frames,
+                self.data.analysis_config,
+            )
+
+        return new_files
+
+    def add_trial(self, filename: str, odor: int):
+        """Reads one trial file and adds it to the running means of its odor.
+
+        Args:
+            filename: The name of the trial .txt file.
+            odor: The odor # delivered in the trial.
+        """
+
+        values = read_txt_values(self.data.session_index.get_path(filename))
+
+        if self.running_means is None:
+            self.running_means = RunningOdorMeans(self.odors, *values.shape)
+            self.data.total_n = values.shape[1]
+            self.data.n_column_labels = [
+                f"{self.data.sample_type} {i}"
+                for i in range(1, self.data.total_n + 1)
+            ]
+
+        self.running_means.add_trial(odor, values, filename)
+
+    def make_tables(self) -> tuple[pd.DataFrame, pd.DataFrame]:
+        """Makes tables of the running analysis values for display.
+
+        Returns:
+            A tuple containing the blank-subtracted DeltaF/F(%) and whether
+            each response is significant, as DataFrames with samples as
+            index and odors as columns.
+        """
+
+        index = pd.Index(self.data.n_column_labels, name=self.data.sample_type)
+        columns = pd.Index(self.odors, name="Odor")
+
+        deltaF_F_df = pd.DataFrame(
+            self.analysis_results["blank_sub_deltaF_F_perc"],
+            index=index,
+            columns=columns,
+        )
+        significance_df = pd.DataFrame(
+            self.analysis_results["significant"], index=index, columns=columns
+        )
+
+        return deltaF_F_df, significance_df